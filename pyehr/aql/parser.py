@@ -7,6 +7,18 @@ from pyehr.aql.model import QueryModel, NodePredicate, Predicate, ArchetypePredi
 from pyehr.utils import get_logger
 
 
+# regular expressions are compiled once and match keywords ignoring case, so
+# there is no need to build upper case copies of the statement
+SELECT_RE = re.compile('SELECT ', re.IGNORECASE)
+CLAUSES_RE = re.compile(' (FROM|WHERE|ORDER BY|TIMEWINDOW)(?= )', re.IGNORECASE)
+OPERATOR_RE = re.compile('>=|>|<=|<|!=|=')
+IDENTIFIED_PATH_RE = re.compile('/|\[')
+TOP_RE = re.compile('TOP ', re.IGNORECASE)
+CLASS_NAME_RE = re.compile('EHR |COMPOSITION |OBSERVATION ', re.IGNORECASE)
+CONTAINS_RE = re.compile('CONTAINS ', re.IGNORECASE)
+LOCATION_CONTAINS_RE = re.compile(' CONTAINS ', re.IGNORECASE)
+
+
 class Parser(object):
 
     KEYWORDS = ('EHR', 'COMPOSITION', 'OBSERVATION', 'CONTAINS')
@@ -27,52 +39,38 @@ class Parser(object):
         self.time_constraints = None
         self.logger.debug('Parser resetted')
 
+    def _split_clauses(self, text):
+        # a single scan of the statement, each clause ends where the next one begins
+        clauses = list()
+        keywords = set()
+        for match in CLAUSES_RE.finditer(text):
+            keyword = match.group(1)
+            # only the first occurrence of each keyword is considered
+            if keyword.upper() not in keywords:
+                keywords.add(keyword.upper())
+                clauses.append((keyword.upper(), match.start(), match.end() + 1))
+        if 'FROM' not in keywords:
+            raise InvalidAQLError('AQL statements must contain the FROM clause')
+        clauses_map = dict()
+        for i, (keyword, keyword_start, clause_start) in enumerate(clauses):
+            clause_end = clauses[i+1][1] if i < len(clauses) - 1 else len(text)
+            if keyword == 'FROM':
+                clauses_map['SELECT'] = text[7:keyword_start]
+            clauses_map[keyword] = text[clause_start:clause_end]
+        return clauses_map
+
     def parse(self, statement):
         self.reset()
         try:
             text = statement.replace('\n', ' ').strip()
-            if not re.match('SELECT ', text.upper()):
+            if not SELECT_RE.match(text):
                 raise InvalidAQLError('AQL statements must begin with the SELECT keyword')
-            result = re.search(' FROM ', text.upper())
-            if not result:
-                raise InvalidAQLError('AQL statements must contain the FROM clause')
-            else:
-                self.selection = text[7:result.start()]
-                location_start = result.start()+6
-                option_result = re.search(' WHERE | ORDER BY | TIMEWINDOW ', text.upper())
-                if option_result:
-                    location_end = option_result.start()
-                    self.location = text[location_start:location_end]
-                    optional_text = text[location_end:]
-                    where_result = re.search(' WHERE ', optional_text.upper())
-                    if where_result:
-                        condition_start = where_result.start()+7
-                        other_option_result = re.search(' ORDER BY | TIMEWINDOW ', optional_text.upper())
-                        if other_option_result and other_option_result.start() > condition_start:
-                            condition_stop = other_option_result.start()
-                            self.condition = optional_text[condition_start:condition_stop]
-                        else:
-                            self.condition = optional_text[condition_start:]
-                    order_result = re.search(' ORDER BY ', optional_text.upper())
-                    if order_result:
-                        order_start = order_result.start()+7
-                        other_option_result = re.search(' WHERE | TIMEWINDOW ', optional_text.upper())
-                        if other_option_result and other_option_result.start() > order_start:
-                            order_stop = other_option_result.start()
-                            self.order_rules = optional_text[order_start:order_stop]
-                        else:
-                            self.order_rules = optional_text[order_start:]
-                    time_result = re.search(' TIMEWINDOW ', optional_text.upper())
-                    if time_result:
-                        time_start = time_result.start()+7
-                        other_option_result = re.search(' WHERE | ORDER BY ', optional_text.upper())
-                        if other_option_result and other_option_result.start() > time_start:
-                            time_stop = other_option_result.start()
-                            self.time_constraints = optional_text[time_start:time_stop]
-                        else:
-                            self.time_constraints = optional_text[time_start:]
-                else:
-                    self.location = text[location_start:]
+            clauses = self._split_clauses(text)
+            self.selection = clauses['SELECT']
+            self.location = clauses['FROM']
+            self.condition = clauses.get('WHERE')
+            self.order_rules = clauses.get('ORDER BY')
+            self.time_constraints = clauses.get('TIMEWINDOW')
         except Exception as e:
             self.logger.error("Parse Error: %s" % str(e))
             raise ParsingError(e)
@@ -112,7 +110,7 @@ class Parser(object):
         """
         if expression:
             predicate_expr = PredicateExpression()
-            operator = re.search('>=|>|<=|<|!=|=', expression)
+            operator = OPERATOR_RE.search(expression)
             if operator:
                 predicate_expr.left_operand = expression[:operator.start()].strip()
                 predicate_expr.operand = expression[operator.start():operator.end()].strip()
@@ -124,7 +122,7 @@ class Parser(object):
             raise ParsePredicateExpressionError("No valid expression found")
 
     def parse_predicate(self, predicate_string):
-        operator = re.search('>=|>|<=|<|!=|=', predicate_string)
+        operator = OPERATOR_RE.search(predicate_string)
         if operator:
             # is a Standard predicate
             tokens = predicate_string.split()
@@ -146,11 +144,11 @@ class Parser(object):
         token_list = path_string.lstrip('/').split('/')
         for token in token_list:
             node = NodePath()
-            predicate_start = re.search('\[', token)
-            predicate_end = re.search('\]', token)
-            if predicate_start and predicate_end:
-                node.attribute_name = token[0:predicate_start.start()]
-                node.predicate_value = self.parse_predicate(token[predicate_start.start()+1:predicate_end.start()-1])
+            predicate_start = token.find('[')
+            predicate_end = token.find(']')
+            if predicate_start > -1 and predicate_end > -1:
+                node.attribute_name = token[0:predicate_start]
+                node.predicate_value = self.parse_predicate(token[predicate_start+1:predicate_end-1])
             else:
                 node.attribute_name = token
             path.node_list.append(node)
@@ -160,7 +158,7 @@ class Parser(object):
     # These functions are defined to parse the selection part of the query
     def parse_identified_path(self, identified_path_string):
         path = IdentifiedPath()
-        sr = re.search('/|\[', identified_path_string)
+        sr = IDENTIFIED_PATH_RE.search(identified_path_string)
         var = identified_path_string[0:sr.start()]
 
         # AQL identified path has the following forms:
@@ -172,10 +170,10 @@ class Parser(object):
             st = identified_path_string[len(var):]
             # calculating case 2 and 3
             if st.startswith('['):
-                end = re.search(']', st)
-                if end:
-                    path.predicate = st[1:end.start()]
-                    path.path = self.parse_path(st[end.start()+1:])
+                end = st.find(']')
+                if end > -1:
+                    path.predicate = st[1:end]
+                    path.path = self.parse_path(st[end+1:])
             else:
                 # case 1
                 path.path = self.parse_path(st)
@@ -186,7 +184,7 @@ class Parser(object):
     def parse_selection(self, sel):
         try:
             selection = Selection()
-            top_result = re.match('TOP ', sel.upper())
+            top_result = TOP_RE.match(sel)
             class_list = sel
             if top_result:
                 top_split = sel.split(' ')
@@ -225,7 +223,7 @@ class Parser(object):
         def is_openehr_variable(token):
             return 'openEHR-EHR' in token
 
-        matching_obj = re.match('EHR |COMPOSITION |OBSERVATION ', text.upper())
+        matching_obj = CLASS_NAME_RE.match(text)
         if matching_obj:
             class_expression = ClassExpression()
             end = matching_obj.end()
@@ -238,11 +236,11 @@ class Parser(object):
                 class_expression.predicate = self.parse_predicate(tokens[0].lstrip('[').rstrip(']'))
             else:
                 # ... otherwise is a variable definition...
-                pred = re.search('\[', tokens[0])
-                if pred:
+                pred = tokens[0].find('[')
+                if pred > -1:
                     # ... followed by a predicate expression.
-                    class_expression.variable_name = tokens[0][:pred.start()]
-                    predicate = tokens[0][pred.start():]
+                    class_expression.variable_name = tokens[0][:pred]
+                    predicate = tokens[0][pred:]
                     if not is_openehr_variable(tokens[0]):
                         predicate = predicate.lstrip('[').rstrip(']')
                     class_expression.predicate = self.parse_predicate(predicate)
@@ -258,7 +256,7 @@ class Parser(object):
             raise ParsingError(msg)
 
     def parse_containers(self, text):
-        conts = list(re.finditer('CONTAINS ', text.upper()))
+        conts = list(CONTAINS_RE.finditer(text))
         containers = []
         for i in xrange(len(conts)):
             c = conts[i]
@@ -285,11 +283,11 @@ class Parser(object):
             # class expression and/or containment constraints.
             #
             # Checking the keyword expression
-            matching_obj = re.match('EHR |COMPOSITION |OBSERVATION ', location_string.upper())
+            matching_obj = CLASS_NAME_RE.match(location_string)
             if matching_obj:
                 location = Location()
                 # Looking for containment expressions
-                c = re.search(' CONTAINS ', location_string.upper())
+                c = LOCATION_CONTAINS_RE.search(location_string)
                 if c:
                     cpos = c.start()
                     # retrieving the containment expression
@@ -1,12 +1,14 @@
 from pyehr.ehr.services.dbmanager.drivers.factory import DriversFactory
 from pyehr.utils import get_logger
-from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+from pyehr.ehr.services.dbmanager.dbservices.index_service import get_index_service
 from pyehr.ehr.services.dbmanager.dbservices.wrappers import PatientRecord, ClinicalRecord
 from pyehr.ehr.services.dbmanager.errors import CascadeDeleteError, RedundantUpdateError,\
     RecordRestoreUnnecessaryError, OperationNotAllowedError, ConfigurationError
 from pyehr.ehr.services.dbmanager.dbservices.version_manager import VersionManager
 
 from collections import Counter
+from contextlib import contextmanager
+from itertools import izip, islice
 
 
 class DBServices(object):
@@ -44,6 +46,8 @@ class DBServices(object):
         self.passwd = passwd
         self.index_service = None
         self.logger = logger or get_logger('db_services')
+        # driver specific arguments, changed while a bulk ingest is running
+        self.driver_options = dict()
         self.version_manager = self._set_version_manager()
 
     def _get_drivers_factory(self, repository):
@@ -56,7 +60,8 @@ class DBServices(object):
             user=self.user,
             passwd=self.passwd,
             index_service=self.index_service,
-            logger=self.logger
+            logger=self.logger,
+            driver_options=self.driver_options
         )
 
     def _set_version_manager(self):
@@ -78,7 +83,9 @@ class DBServices(object):
         if not self.index_service:
             raise ConfigurationError('Operation not allowed, missing IndexService')
 
-    def set_index_service(self, url, database, user, passwd):
+    def set_index_service(self, url, database, user, passwd, persistent_session=False,
+                          engine='basex', cache_size=1000, contains_cache_size=500,
+                          generation_check_interval=5):
         """
         Add a :class:`IndexService` to the current :class:`DBService` that will be used
         to index clinical records
@@ -90,11 +97,65 @@ class DBServices(object):
         :type user: str
         :param passwd: the password to access the :class:`IndexService`
         :type passwd: str
-        """
-        self.index_service = IndexService(database, url, user, passwd, self.logger)
+        :param persistent_session: if True, the :class:`IndexService` will keep its session
+          open and reuse it for all the requests
+        :type persistent_session: bool
+        :param engine: the index engine, 'basex' (default) or 'local'; when using the 'local'
+          engine *url* is the directory where the index file will be stored
+        :type engine: str
+        :param cache_size: the number of structure IDs cached by the :class:`IndexService`,
+          0 disables the cache
+        :type cache_size: int
+        :param contains_cache_size: the number of CONTAINS statements whose results are cached
+          by the :class:`IndexService`, 0 disables the cache
+        :type contains_cache_size: int
+        :param generation_check_interval: the number of seconds after which the caches of the
+          :class:`IndexService` are checked against changes made by other processes
+        :type generation_check_interval: int
+        """
+        self.index_service = get_index_service(engine, url, database, user, passwd, self.logger,
+                                               persistent_session, cache_size, contains_cache_size,
+                                               generation_check_interval)
         # update version manager as well
         self.version_manager = self._set_version_manager()
 
+    @contextmanager
+    def bulk_ingest(self, disable_refresh_interval=True, replicas=None, prepare_database=True):
+        """
+        Context manager used to load a large number of records: while it is active the
+        drivers skip the operations that make each write immediately visible (like the
+        index refresh of ElasticSearch) and the database can be tuned for the load.
+        The original configuration is restored at exit, when all loaded records become
+        available.
+
+        >>> with dbs.bulk_ingest():
+        ...     for patient, ehr_records in dataset:
+        ...         dbs.save_ehr_records(ehr_records, dbs.save_patient(patient))
+
+        :param disable_refresh_interval: if True, disable the periodic refresh of the
+          database during the load
+        :type disable_refresh_interval: bool
+        :param replicas: if not None, the number of replicas used during the load
+        :type replicas: int
+        :param prepare_database: if False, only the options of the drivers are changed, use
+          it when the database has been prepared by another process that is running the load
+        :type prepare_database: bool
+        """
+        drf = self._get_drivers_factory(self.ehr_repository)
+        ingest_state = None
+        with drf.get_driver() as driver:
+            if prepare_database:
+                ingest_state = driver.start_bulk_ingest(disable_refresh_interval, replicas)
+            ingest_options = driver.BULK_INGEST_OPTIONS
+        self.driver_options = dict(ingest_options)
+        try:
+            yield self
+        finally:
+            self.driver_options = dict()
+            if prepare_database:
+                with drf.get_driver() as driver:
+                    driver.stop_bulk_ingest(ingest_state)
+
     def save_patient(self, patient_record):
         """
         Save a patient record to the DB.
@@ -113,6 +174,12 @@ class DBServices(object):
         structure_id = self.index_service.get_structure_id(ehr_data)
         ehr_record.structure_id = structure_id
 
+    def _set_structure_ids(self, ehr_records):
+        ehr_data = [r.ehr_data.to_json() for r in ehr_records]
+        structure_ids = self.index_service.get_structure_ids(ehr_data)
+        for ehr_record, structure_id in izip(ehr_records, structure_ids):
+            ehr_record.structure_id = structure_id
+
     def save_ehr_record(self, ehr_record, patient_record, record_moved=False):
         """
         Save a clinical record into the DB and link it to a patient record
@@ -152,7 +219,8 @@ class DBServices(object):
         patient_record = self._add_ehr_record(patient_record, ehr_record)
         return ehr_record, patient_record
 
-    def save_ehr_records(self, ehr_records, patient_record, skip_existing_duplicated=False):
+    def save_ehr_records(self, ehr_records, patient_record, skip_existing_duplicated=False,
+                         batch_size=None):
         """
         Save a batch of clinical records into the DB and link them to a patient record
 
@@ -164,35 +232,39 @@ class DBServices(object):
         :param skip_existing_duplicated: if True, continue with the save operation even if one
           or more DuplicatedKeyError occur, if False raise an error
         :type skip_existing_duplicated: bool
+        :param batch_size: the number of records saved with a single bulk request, if None the
+          default value of the driver will be used
+        :type batch_size: int
         :return: a list with the saved :class:`ClinicalRecord`, the updated :class:`PatientRecord`
           and a list containing any records that caused a duplicated key error
         """
         self._check_index_service()
         drf = self._get_drivers_factory(self.ehr_repository)
+        # calculate and set the structure IDs for the given records
+        self._set_structure_ids(ehr_records)
         with drf.get_driver() as driver:
             for r in ehr_records:
-                # calculate and set the structure ID for the given record
-                self._set_structure_id(r)
                 r.bind_to_patient(patient_record)
                 if not r.is_persistent:
                     r.increase_version()
             encoded_records = [driver.encode_record(r) for r in ehr_records]
             try:
-                saved, errors = driver.add_records(encoded_records, skip_existing_duplicated)
+                saved, errors = driver.add_records(encoded_records, skip_existing_duplicated, batch_size)
             except Exception, exc:
-                for ehr in ehr_records:
-                    self.index_service.check_structure_counter(ehr.structure_id)
+                # if new structures were created, delete them (reference counter is 0)
+                self.index_service.update_structure_counters(
+                    dict.fromkeys([ehr.structure_id for ehr in ehr_records], 0)
+                )
                 raise exc
             errors = [driver.decode_record(e) for e in errors]
-        saved_struct_counter = Counter()
+        struct_counter = Counter()
         for rec in ehr_records:
             if rec.record_id in saved:
-                saved_struct_counter[rec.structure_id] += 1
-        error_struct_counter = set([rec.record_id for rec in errors])
-        for struct, counter in saved_struct_counter.iteritems():
-            self.index_service.increase_structure_counter(struct, counter)
-        for struct in error_struct_counter:
-            self.index_service.check_structure_counter(struct)
+                struct_counter[rec.structure_id] += 1
+        # structures of records that were not saved are only checked
+        for rec in errors:
+            struct_counter.setdefault(rec.structure_id, 0)
+        self.index_service.update_structure_counters(struct_counter)
         saved_ehr_records = [ehr for ehr in ehr_records if ehr.record_id in saved]
         patient_record = self._add_ehr_records(patient_record, saved_ehr_records)
         return saved_ehr_records, patient_record, errors
@@ -388,23 +460,73 @@ class DBServices(object):
     def _get_active_records(self, driver):
         return driver.get_records_by_value('active', True)
 
+    def _get_ehr_documents(self, driver, ehr_ids, fetch_ehr_records=True):
+        # fetch clinical records in bulk, if EHR data are not needed only the fields
+        # used to decode the records are retrieved
+        fields = None if fetch_ehr_records else driver.CLINICAL_RECORD_SUMMARY_FIELDS
+        return dict((doc['_id'], doc) for doc in driver.get_records_by_ids(ehr_ids, fields))
+
+    def _fetch_patients_data_full(self, patient_docs, fetch_ehr_records=True,
+                                  fetch_hidden_ehr=False):
+        drf = self._get_drivers_factory(self.ehr_repository)
+        with drf.get_driver() as driver:
+            patient_records = [driver.decode_record(p) for p in patient_docs]
+            ehr_docs = self._get_ehr_documents(driver, [ehr.record_id for p in patient_records
+                                                        for ehr in p.ehr_records], fetch_ehr_records)
+            for patient_record in patient_records:
+                ehr_records = []
+                for ehr in patient_record.ehr_records:
+                    ehr_doc = ehr_docs.get(ehr.record_id)
+                    if ehr_doc is None:
+                        self.logger.warn('Unable to find EHR record %r', ehr.record_id)
+                    elif fetch_hidden_ehr or (not fetch_hidden_ehr and ehr_doc['active']):
+                        self.logger.debug('fetch_hidden_ehr: %s --- ehr_doc[\'active\']: %s',
+                                          fetch_hidden_ehr, ehr_doc['active'])
+                        ehr_records.append(driver.decode_record(ehr_doc, fetch_ehr_records))
+                    else:
+                        self.logger.debug('Ignoring hidden EHR record %r', ehr_doc['_id'])
+                patient_record.ehr_records = ehr_records
+            return patient_records
+
     def _fetch_patient_data_full(self, patient_doc, fetch_ehr_records=True,
                                  fetch_hidden_ehr=False):
-        drf = self._get_drivers_factory(self.ehr_repository)
+        return self._fetch_patients_data_full([patient_doc], fetch_ehr_records,
+                                              fetch_hidden_ehr)[0]
+
+    def iter_patients(self, active_records_only=True, fetch_ehr_records=True,
+                      fetch_hidden_ehr=False, batch_size=500):
+        """
+        Iterate over the patients in the DB. Patients are read in pages of *batch_size*
+        records, the clinical records of each page are loaded with a single request and
+        patients are yielded one at a time, so only a page of patients is kept in memory.
+
+        :param active_records_only: if True fetch only active patient records, if False get all
+          patient records from the DB
+        :type active_records_only: boolean
+        :param fetch_ehr_records: if True fetch connected EHR records  as well, if False only EHR records'
+          IDs will be retrieved
+        :type fetch_ehr_records: boolean
+        :param fetch_hidden_ehr: if False only fetch active EHR records, if True fetch all EHR records
+          connected to the given patient record
+        :type fetch_hidden_ehr: boolean
+        :param batch_size: the number of patients loaded at once
+        :type batch_size: int
+        :return: an iterator over :class:`PatientRecord` objects
+        """
+        drf = self._get_drivers_factory(self.patients_repository)
         with drf.get_driver() as driver:
-            patient_record = driver.decode_record(patient_doc)
-            ehr_records = []
-            for ehr in patient_record.ehr_records:
-                ehr_doc = driver.get_record_by_id(ehr.record_id)
-                if fetch_hidden_ehr or (not fetch_hidden_ehr and ehr_doc['active']):
-                    self.logger.debug('fetch_hidden_ehr: %s --- ehr_doc[\'active\']: %s',
-                                      fetch_hidden_ehr, ehr_doc['active'])
-                    ehr_records.append(driver.decode_record(ehr_doc, fetch_ehr_records))
-                    self.logger.debug('ehr_records: %r', ehr_records)
-                else:
-                    self.logger.debug('Ignoring hidden EHR record %r', ehr_doc['_id'])
-            patient_record.ehr_records = ehr_records
-            return patient_record
+            if not active_records_only:
+                patient_docs = driver.get_all_records()
+            else:
+                patient_docs = self._get_active_records(driver)
+            patient_docs = iter(patient_docs or [])
+            while True:
+                page = list(islice(patient_docs, batch_size))
+                if len(page) == 0:
+                    break
+                for patient_record in self._fetch_patients_data_full(page, fetch_ehr_records,
+                                                                     fetch_hidden_ehr):
+                    yield patient_record
 
     def get_patients(self, active_records_only=True, fetch_ehr_records=True,
                      fetch_hidden_ehr=False):
@@ -422,14 +544,7 @@ class DBServices(object):
         :type fetch_hidden_ehr: boolean
         :return: a list of :class:`PatientRecord` objects
         """
-        drf = self._get_drivers_factory(self.patients_repository)
-        with drf.get_driver() as driver:
-            if not active_records_only:
-                patient_records = driver.get_all_records()
-            else:
-                patient_records = self._get_active_records(driver)
-        return [self._fetch_patient_data_full(r, fetch_ehr_records,
-                                              fetch_hidden_ehr) for r in patient_records]
+        return list(self.iter_patients(active_records_only, fetch_ehr_records, fetch_hidden_ehr))
 
     def get_patient(self, patient_id, fetch_ehr_records=True, fetch_hidden_ehr=False):
         """
@@ -484,8 +599,9 @@ class DBServices(object):
         """
         drf = self._get_drivers_factory(self.ehr_repository)
         with drf.get_driver() as driver:
-            ehr_records = [driver.get_record_by_id(ehr.record_id) for ehr in patient.ehr_records]
-            patient.ehr_records = [driver.decode_record(ehr) for ehr in ehr_records]
+            ehr_docs = self._get_ehr_documents(driver, [ehr.record_id for ehr in patient.ehr_records])
+            patient.ehr_records = [driver.decode_record(ehr_docs[ehr.record_id])
+                                   for ehr in patient.ehr_records if ehr.record_id in ehr_docs]
         return patient
 
     def hide_patient(self, patient):
@@ -568,9 +684,8 @@ class DBServices(object):
             driver.delete_records_by_id([ehr.record_id for ehr in ehr_records])
             struct_id_counter = Counter()
             for rec in ehr_records:
-                struct_id_counter[rec.structure_id] += 1
-            for str_id, str_count in struct_id_counter.iteritems():
-                self.index_service.decrease_structure_counter(str_id, str_count)
+                struct_id_counter[rec.structure_id] -= 1
+            self.index_service.update_structure_counters(struct_id_counter)
         if reset_history:
             for ehr in ehr_records:
                 self.version_manager.remove_revisions(ehr.record_id)
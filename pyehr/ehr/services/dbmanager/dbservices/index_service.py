@@ -1,43 +1,172 @@
 from lxml import etree
 from hashlib import md5
 from uuid import uuid4
-from copy import copy
+from copy import copy, deepcopy
+import time, os, re
 from pyehr.utils.services import get_logger
+from pyehr.utils.cache import LRUCache
+from pyehr.ehr.services.dbmanager.errors import UnknownIndexEngineError
 from pybasex import BaseXClient
 import pybasex.errors as pbx_errors
 
+# attribute values that can be serialized without the help of lxml
+SAFE_ATTRIBUTE_VALUE = re.compile(r'^[\x20-\x7e]*$')
 
-class IndexService(object):
 
-    def __init__(self, db, url, user, passwd, logger=None):
+class IndexService(object):
+    """
+    Service used to map the structure of clinical records to STRUCTURE_IDs and to
+    resolve AQL CONTAINS statements. Structures are stored in a BaseX database.
+
+    If *persistent_session* is True, the session with BaseX is opened once and reused
+    by all the following calls instead of being closed after each operation; if the
+    session is lost, it will be reopened and the failed operation will be retried once.
+
+    Structure IDs and results of :meth:`map_aql_contains` are cached and bound to the
+    index "generation", a counter stored in the database that is increased every time a
+    structure is created or deleted. The generation is checked at most once every
+    *generation_check_interval* seconds: cache hits within the interval don't access BaseX
+    at all, changes made by other processes are detected within that interval (0 means
+    at every call, at the cost of a query for each lookup) while changes made by this
+    instance are always detected.
+    """
+
+    GENERATION_DOCUMENT = 'index_generation'
+    # function used to return values from updating queries, 'db:output' for BaseX < 8.5
+    OUTPUT_FUNCTION = 'update:output'
+
+    def __init__(self, db, url, user, passwd, logger=None, cache_size=1000,
+                 persistent_session=False, contains_cache_size=500,
+                 generation_check_interval=5):
         self.url = url
         self.user = user
         self.passwd = passwd
         self.db = db
         self.basex_client = None
         self.logger = logger or get_logger('index_service')
+        # maps structures' hashes to structures' IDs
+        self.structures_cache = LRUCache(cache_size)
+        self.persistent_session = persistent_session
+        self._database_checked = False
+        # maps CONTAINS chains to the results of map_aql_contains
+        self.contains_cache = LRUCache(contains_cache_size)
+        self.generation_check_interval = generation_check_interval
+        self._index_generation = None
+        self._generation_checked_at = 0
+
+    @property
+    def cache_stats(self):
+        """
+        Return size, hits and misses of the structure IDs cache
+        """
+        return self.structures_cache.get_stats()
+
+    @property
+    def contains_cache_stats(self):
+        """
+        Return size, hits and misses of the CONTAINS statements cache
+        """
+        return self.contains_cache.get_stats()
 
     def connect(self):
         self.basex_client = BaseXClient(self.url, self.db, self.user, self.passwd, self.logger)
         self.basex_client.connect()
-        try:
-            self.basex_client.create_database()
-        except pbx_errors.OverwriteError:
-            # DB already exists, just ignore
-            pass
+        # with a persistent session the database is checked only once
+        if not (self.persistent_session and self._database_checked):
+            try:
+                self.basex_client.create_database()
+            except pbx_errors.OverwriteError:
+                # DB already exists, just ignore
+                pass
+            self._database_checked = True
 
     def disconnect(self):
-        self.basex_client.disconnect()
+        if self.basex_client:
+            self.basex_client.disconnect()
         self.basex_client = None
 
-    def _execute_query(self, xpath_query):
+    def delete_index(self):
+        """
+        Delete the database used by the index service, with all the structures it contains,
+        and clear the caches. The database will be created again at the next connection.
+        """
+        self._call_client('delete_database')
+        self.disconnect()
+        self._database_checked = False
+        self.structures_cache.clear()
+        self.contains_cache.clear()
+        self._index_generation = None
+
+    def _release_session(self):
+        # close the session after an operation unless persistent sessions are enabled
+        if not self.persistent_session:
+            self.disconnect()
+
+    def check_connection(self):
+        """
+        Check if the BaseX server can be reached using the current session, if not
+        open a new session.
+
+        :return: True if the server can be reached, False otherwise
+        """
+        try:
+            self._call_client('get_databases')
+            return True
+        except (pbx_errors.ConnectionError, pbx_errors.ConnectionClosedError):
+            self.logger.error('Unable to reach BaseX server at %s', self.url)
+            self.disconnect()
+            return False
+
+    def _call_client(self, method_name, *args, **kwargs):
         if not self.basex_client:
             self.connect()
-        res = self.basex_client.execute_query(xpath_query)
-        return res
+        try:
+            return getattr(self.basex_client, method_name)(*args, **kwargs)
+        except (pbx_errors.ConnectionError, pbx_errors.ConnectionClosedError):
+            if not self.persistent_session:
+                raise
+            # the session may have been closed by the server, open a new one and retry
+            self.logger.warning('BaseX session lost, reconnecting')
+            self.disconnect()
+            self.connect()
+            return getattr(self.basex_client, method_name)(*args, **kwargs)
+
+    def _execute_query(self, xpath_query):
+        return self._call_client('execute_query', xpath_query)
 
     @staticmethod
-    def get_structure(ehr_record, parent_key=None):
+    def _serialize_archetype_node(archetype_class, path_from_parent, children):
+        # produce exactly the same output of etree.tostring for an 'archetype' element
+        if isinstance(archetype_class, basestring) and SAFE_ATTRIBUTE_VALUE.match(archetype_class) \
+                and SAFE_ATTRIBUTE_VALUE.match(path_from_parent):
+            def escape(value):
+                return str(value).replace('&', '&amp;').replace('<', '&lt;')\
+                    .replace('>', '&gt;').replace('"', '&quot;')
+            open_tag = '<archetype class="%s" path_from_parent="%s"' % (escape(archetype_class),
+                                                                       escape(path_from_parent))
+        else:
+            # non ASCII or control characters, let lxml take care of them
+            open_tag = etree.tostring(etree.Element(
+                'archetype',
+                {'class': archetype_class, 'path_from_parent': path_from_parent}
+            ))[:-2]
+        if len(children) > 0:
+            return '%s>%s</archetype>' % (open_tag, ''.join(children))
+        else:
+            return '%s/>' % open_tag
+
+    @staticmethod
+    def serialize_structure(ehr_record, parent_key=None):
+        """
+        Return the canonical serialization of the structure of the given EHR. The
+        serialization is built directly from the dictionary, it is equal to the XML
+        document returned by :meth:`get_structure` serialized with lxml and it is
+        the value used to calculate the hash of the structure.
+
+        :param ehr_record: the EHR as a dictionary
+        :type ehr_record: dictionary
+        :return: the structure as an XML string
+        """
         def is_archetype(doc):
             return 'archetype_class' in doc
 
@@ -58,15 +187,11 @@ class IndexService(object):
                 pk = parent_key + [k]
                 if isinstance(v, dict):
                     if is_archetype(v):
-                        archetypes.append(IndexService.get_structure(v, pk))
+                        archetypes.append(IndexService.serialize_structure(v, pk))
                     else:
-                        a_from_dict = get_structure_from_dict(v, pk)
-                        if len(a_from_dict) > 0:
-                            archetypes.extend(a_from_dict)
+                        archetypes.extend(get_structure_from_dict(v, pk))
                 if isinstance(v, list):
-                    a_from_list = get_structure_from_list(v, pk)
-                    if len(a_from_list) > 0:
-                        archetypes.extend(a_from_list)
+                    archetypes.extend(get_structure_from_list(v, pk))
             return archetypes
 
         def get_structure_from_list(dlist, parent_key):
@@ -77,47 +202,52 @@ class IndexService(object):
                     return element
 
             archetypes = []
+            # serialized structures already in archetypes, used to skip duplicated ones
+            known_archetypes = set()
             for x in sorted(dlist, key=list_sort_key):
                 if isinstance(x, dict):
                     if is_archetype(x):
-                        structure = IndexService.get_structure(x, parent_key)
-                        if etree.tostring(structure) not in [etree.tostring(a) for a in archetypes]:
+                        structure = IndexService.serialize_structure(x, parent_key)
+                        if structure not in known_archetypes:
                             archetypes.append(structure)
+                            known_archetypes.add(structure)
                     else:
                         a_from_dict = get_structure_from_dict(x, parent_key)
-                        if len(a_from_dict) > 0:
-                            archetypes.extend(a_from_dict)
+                        archetypes.extend(a_from_dict)
+                        known_archetypes.update(a_from_dict)
                 if isinstance(x, list):
                     a_from_list = get_structure_from_list(x, parent_key)
-                    if len(a_from_list) > 0:
-                        archetypes.extend(a_from_list)
+                    archetypes.extend(a_from_list)
+                    known_archetypes.update(a_from_list)
             return archetypes
 
         if parent_key is None:
             parent_key = []
-        root = etree.Element(
-            'archetype',
-            {'class': ehr_record['archetype_class'], 'path_from_parent': build_path(parent_key)}
-        )
-
-        parent_key = []
+        children = []
         for k, x in sorted(ehr_record['archetype_details'].iteritems()):
-            pk = parent_key + [k]
+            pk = [k]
             if isinstance(x, dict):
                 if is_archetype(x):
-                    root.append(IndexService.get_structure(x, pk))
+                    children.append(IndexService.serialize_structure(x, pk))
                 else:
-                    for a in get_structure_from_dict(x, pk):
-                        root.append(a)
+                    children.extend(get_structure_from_dict(x, pk))
             if isinstance(x, list):
-                for a in get_structure_from_list(x, pk):
-                    root.append(a)
-        return root
+                children.extend(get_structure_from_list(x, pk))
+        return IndexService._serialize_archetype_node(ehr_record['archetype_class'],
+                                                      build_path(parent_key), children)
+
+    @staticmethod
+    def get_structure(ehr_record, parent_key=None):
+        return etree.fromstring(IndexService.serialize_structure(ehr_record, parent_key))
+
+    @staticmethod
+    def get_structure_hash(serialized_structure):
+        structure_hash = md5()
+        structure_hash.update(serialized_structure)
+        return structure_hash.hexdigest()
 
     def _get_record_hash(self, record):
-        record_hash = md5()
-        record_hash.update(etree.tostring(record))
-        return record_hash.hexdigest()
+        return IndexService.get_structure_hash(etree.tostring(record))
 
     def _build_new_record(self, record, record_id=None):
         record_root = etree.Element('archetype_structure')
@@ -134,22 +264,31 @@ class IndexService(object):
 
     def create_entry(self, record, record_id=None):
         record, structure_key = self._build_new_record(record, record_id)
-        if not self.basex_client:
-            self.connect()
-        self.basex_client.add_document(record, structure_key)
+        self._call_client('add_document', record, structure_key)
+        self._bump_index_generation()
         return structure_key
 
+    @staticmethod
+    def _to_string_literal(value):
+        return '"%s"' % value.replace('&', '&amp;').replace('"', '&quot;')
+
+    def _build_documents_insert(self, documents):
+        # documents are passed as strings and parsed by BaseX, their content can't be
+        # mistaken for XQuery expressions; the index generation is changed by the same
+        # updating query, so documents are never saved without changing it
+        updates = ['db:add("%s", parse-xml(%s), "%s")' %
+                   (self.db, self._to_string_literal(etree.tostring(doc)), doc_id)
+                   for doc_id, doc in documents.iteritems()]
+        updates.append(self._build_generation_update())
+        return '(%s)' % ',\n'.join(updates)
+
     def _get_structure_by_id(self, structure_id):
-        if not self.basex_client:
-            self.connect()
-        return self.basex_client.get_document(structure_id)
+        return self._call_client('get_document', structure_id)
 
     def _extract_structure_id_from_xml(self, xml_doc):
         return xml_doc.find('structure_id').get('uid')
 
     def _get_structure_id(self, xml_doc):
-        if not self.basex_client:
-            self.connect()
         record_hash = self._get_record_hash(xml_doc)
         res = self._execute_query('/archetype_structure/structure_id[@str_hash="%s"]' % record_hash)
         try:
@@ -157,6 +296,11 @@ class IndexService(object):
         except AttributeError:
             return None
 
+    def _get_structure_ids(self, records_hashes):
+        hashes_list = ', '.join('"%s"' % h for h in records_hashes)
+        res = self._execute_query('/archetype_structure/structure_id[@str_hash=(%s)]' % hashes_list)
+        return dict((s.get('str_hash'), s.get('uid')) for s in res.findall('structure_id'))
+
     def get_structure_id(self, ehr_record):
         """
         Return the STRUCTURE_ID related to the given EHR, if no ID is related to
@@ -166,21 +310,158 @@ class IndexService(object):
         :param ehr_record: the EHR as a dictionary
         :type ehr_record: dictionary
         """
-        if not self.basex_client:
-            self.connect()
-        xml_structure = IndexService.get_structure(ehr_record)
-        str_id = self._get_structure_id(xml_structure)
-        if not str_id:
-            str_id = self.create_entry(xml_structure)
-        self.disconnect()
-        return str_id
+        return self.get_structure_ids([ehr_record])[0]
 
-    def _get_document_reference_counter(self, doc):
-        return int(doc.find("references_counter").get("hits"))
-
-    def _update_document_references_counter(self, doc, update_value):
-        doc.find("references_counter").set("hits", str(update_value))
-        return doc
+    def get_structure_ids(self, ehr_records):
+        """
+        Return the STRUCTURE_IDs related to the given EHRs. Structures are calculated
+        locally and all the unknown ones are resolved using a single query, structures
+        that are not yet in the DB are created with a single updating query.
+
+        :param ehr_records: the EHRs as dictionaries
+        :type ehr_records: list
+        :return: a list with the STRUCTURE_IDs, the n-th element of the list is the
+          STRUCTURE_ID of the n-th EHR
+        """
+        if self.structures_cache.enabled:
+            # cached IDs of structures deleted by other processes must not be used
+            self._check_index_generation()
+        records_hashes = list()
+        structures_ids = dict()
+        unresolved = dict()
+        for ehr_record in ehr_records:
+            structure = IndexService.serialize_structure(ehr_record)
+            record_hash = IndexService.get_structure_hash(structure)
+            records_hashes.append(record_hash)
+            if record_hash in structures_ids or record_hash in unresolved:
+                continue
+            str_id = self.structures_cache.get(record_hash)
+            if str_id:
+                structures_ids[record_hash] = str_id
+            else:
+                unresolved[record_hash] = structure
+        if len(unresolved) > 0:
+            for record_hash, str_id in self._get_structure_ids(unresolved.keys()).iteritems():
+                structures_ids[record_hash] = str_id
+                self.structures_cache.put(record_hash, str_id)
+                del unresolved[record_hash]
+            if len(unresolved) > 0:
+                new_records = dict()
+                for record_hash, structure in unresolved.iteritems():
+                    # XML documents are built only for the structures that will be saved
+                    record, str_id = self._build_new_record(etree.fromstring(structure))
+                    new_records[str_id] = record
+                    structures_ids[record_hash] = str_id
+                self._execute_query(self._build_documents_insert(new_records))
+                self._index_generation_bumped()
+                self.logger.debug('Created %d new structures', len(new_records))
+                for record_hash in unresolved.keys():
+                    self.structures_cache.put(record_hash, structures_ids[record_hash])
+        self._release_session()
+        return [structures_ids[h] for h in records_hashes]
+
+    def _build_generation_update(self):
+        # the counter is increased in place, concurrent updates are serialized by BaseX
+        return '''for $g in db:open("%s", "%s")/index_generation/@value
+        return replace value of node $g with xs:integer($g) + 1''' % (self.db, self.GENERATION_DOCUMENT)
+
+    def _build_generation_query(self):
+        return 'db:open("%s", "%s")/index_generation/string-join((@epoch, @value), ":")' % \
+            (self.db, self.GENERATION_DOCUMENT)
+
+    def _index_generation_bumped(self):
+        # the generation has been increased by this instance: CONTAINS results are not valid
+        # anymore while cached structure IDs are, unless the generation was changed by
+        # another process too (in that case the next check won't match and will clear them)
+        self.contains_cache.clear()
+        if self._index_generation is not None:
+            epoch, counter = self._index_generation.rsplit(':', 1)
+            self._index_generation = '%s:%d' % (epoch, int(counter) + 1)
+
+    def _bump_index_generation(self):
+        # always done, other processes may rely on the generation even if this one doesn't
+        self._execute_query(self._build_generation_update())
+        self._index_generation_bumped()
+
+    def _read_index_generation(self):
+        res = self._execute_query(self._build_generation_query())
+        if res.text:
+            return res.text
+        # the epoch tells apart counters of databases deleted and created again
+        epoch = uuid4().hex
+        try:
+            self._call_client('add_document', etree.Element('index_generation', {'epoch': epoch, 'value': '0'}),
+                              self.GENERATION_DOCUMENT)
+        except pbx_errors.OverwriteError:
+            # created by another process in the meantime
+            return self._read_index_generation()
+        return '%s:0' % epoch
+
+    def _check_index_generation(self):
+        now = time.time()
+        if self._index_generation is None or \
+                (now - self._generation_checked_at) >= self.generation_check_interval:
+            generation = self._read_index_generation()
+            if generation != self._index_generation:
+                self.logger.debug('Index generation changed, clearing caches')
+                self.contains_cache.clear()
+                self.structures_cache.clear()
+                self._index_generation = generation
+            self._generation_checked_at = now
+
+    def _build_counter_update(self, structure_id, delta):
+        # a single updating expression: the counter is changed in place by BaseX
+        # and the structure is deleted if no record references it anymore
+        return '''for $s in db:open("%(db)s", "%(uid)s")/archetype_structure
+        let $hits := xs:integer($s/references_counter/@hits) + %(delta)d
+        return if ($hits <= 0)
+               then db:delete("%(db)s", "%(uid)s")
+               else replace value of node $s/references_counter/@hits with $hits''' % {
+            'db': self.db, 'uid': structure_id, 'delta': delta
+        }
+
+    def _build_missing_structures_output(self, structure_ids):
+        # evaluated against the database before any update is applied
+        return 'for $u in (%s) where not(db:exists("%s", $u)) return %s(<structure uid="{$u}"/>)' % \
+            (', '.join('"%s"' % str_id for str_id in structure_ids), self.db, self.OUTPUT_FUNCTION)
+
+    def update_structure_counters(self, counters):
+        """
+        Apply a batch of changes to the references counters of the structures using
+        a single, atomic, update query that also returns the IDs of the structures that
+        are not in the DB. *counters* maps structure IDs to the value that will be added
+        to their references counter, negative values decrease the counter while a value
+        equal to 0 only checks the counter. Structures with a references counter equal or
+        lower than 0 after the update will be deleted.
+
+        :param counters: a dictionary (or a Counter) mapping structure IDs to the deltas
+        :type counters: dict
+        :return: the IDs of the structures that are not in the DB
+        """
+        if len(counters) == 0:
+            return []
+        updates = [self._build_missing_structures_output(counters.keys())]
+        updates.extend(self._build_counter_update(str_id, delta) for str_id, delta in counters.iteritems())
+        deletable = [str_id for str_id, delta in counters.iteritems() if delta <= 0]
+        if len(deletable) > 0:
+            # structures may be deleted, change the index generation in the same query
+            updates.append(self._build_generation_update())
+        res = self._execute_query('(%s)' % ',\n'.join(updates))
+        missing = [s.get('uid') for s in res.findall('structure')]
+        for str_id in missing:
+            if counters[str_id] != 0:
+                self.logger.warn("There is no document with structure ID %s", str_id)
+            # the ID may come from a cache not yet invalidated, check the generation again
+            self.structures_cache.invalidate_value(str_id)
+            self._generation_checked_at = 0
+        if len(deletable) > 0:
+            # structures that could have been deleted must not be returned by the caches anymore
+            for str_id in deletable:
+                self.structures_cache.invalidate_value(str_id)
+            self._index_generation_bumped()
+        self._release_session()
+        self.logger.debug('Updated references counters for %d structures', len(counters))
+        return missing
 
     def check_structure_counter(self, structure_id):
         """
@@ -189,14 +470,7 @@ class IndexService(object):
 
         :param structure_id: the ID of the structure that will be checked
         """
-        doc = self._get_structure_by_id(structure_id)
-        if doc is not None:
-            doc_count = self._get_document_reference_counter(doc)
-            if doc_count == 0:
-                self.basex_client.delete_document(structure_id)
-            else:
-                self.logger.debug("References counter for structure %s id %d",
-                                  doc_count, structure_id)
+        self.update_structure_counters({structure_id: 0})
 
     def increase_structure_counter(self, structure_id, increase_value=1):
         """
@@ -208,16 +482,7 @@ class IndexService(object):
         """
         if increase_value < 1:
             raise ValueError("increase_value must be an integer greater than 0")
-        doc = self._get_structure_by_id(structure_id)
-        if doc is not None:
-            doc_count = self._get_document_reference_counter(doc)
-            self.logger.debug("Current counter for %s is %d", structure_id, doc_count)
-            doc = self._update_document_references_counter(doc, (doc_count + increase_value))
-            self.basex_client.delete_document(structure_id)
-            self.basex_client.add_document(doc, structure_id)
-            self.logger.debug("Documents %s updated", structure_id)
-        else:
-            self.logger.warn("There is no document with structure ID %s", structure_id)
+        self.update_structure_counters({structure_id: increase_value})
 
     def decrease_structure_counter(self, structure_id, decrease_value=1):
         """
@@ -231,18 +496,7 @@ class IndexService(object):
         """
         if decrease_value < 1:
             raise ValueError("decrease_value must be an integer greater than 0")
-        doc = self._get_structure_by_id(structure_id)
-        if doc is not None:
-            doc_count = self._get_document_reference_counter(doc)
-            if (doc_count - decrease_value) <= 0:
-                self.basex_client.delete_document(structure_id)
-            else:
-                doc = self._update_document_references_counter(doc, (doc_count - decrease_value))
-                self.basex_client.delete_document(structure_id)
-                self.basex_client.add_document(doc, structure_id)
-                self.logger.debug("Document %s updated", structure_id)
-        else:
-            self.logger.warn("There is no document with structure ID %s", structure_id)
+        self.update_structure_counters({structure_id: -decrease_value})
 
     def _container_to_xpath(self, aql_container):
         if aql_container.class_expression.predicate:
@@ -283,15 +537,35 @@ class IndexService(object):
                     v.insert(0, node.get('path_from_parent'))
         return node.find('structure_id').get('uid'), paths_map
 
+    def _get_containers_key(self, aql_containers):
+        return tuple(c.class_expression.predicate.archetype_id if c.class_expression.predicate else None
+                     for c in aql_containers)
+
     def map_aql_contains(self, aql_containers):
-        if not self.basex_client:
-            self.connect()
+        """
+        Return the structures matching the given chain of AQL CONTAINS statements, with
+        the paths of the matching archetypes, and the map of the variables of the chain.
+        Results are cached: a chain already resolved within the generation check interval
+        is returned without accessing BaseX.
+
+        :param aql_containers: the containers of the CONTAINS statements
+        :type aql_containers: list
+        :return: a tuple with the structures map and the variables map
+        """
+        variables_map = dict((c.class_expression.variable_name, c.class_expression.predicate.archetype_id)
+                             for c in aql_containers if c.class_expression.predicate)
+        if self.contains_cache.enabled:
+            self._check_index_generation()
+            cache_key = self._get_containers_key(aql_containers)
+            structures_map = self.contains_cache.get(cache_key)
+            if structures_map is not None:
+                self._release_session()
+                # callers are allowed to modify the returned map
+                return deepcopy(structures_map), variables_map
         query = self._build_xpath_query(aql_containers)
         res = self._execute_query(query)
-        self.disconnect()
+        self._release_session()
         structures_map = dict()
-        variables_map = dict((c.class_expression.variable_name, c.class_expression.predicate.archetype_id)
-                             for c in aql_containers if c.class_expression.predicate)
         container_classes = [c.class_expression.predicate.archetype_id
                              for c in aql_containers if c.class_expression.predicate]
         leaf_node = container_classes.pop(-1)
@@ -301,4 +575,28 @@ class IndexService(object):
         for node in res.xpath(ln_query):
             str_id, paths_map = self._resolve_node_paths(node, copy(container_classes), leaf_node)
             structures_map.setdefault(str_id, []).append(paths_map)
-        return structures_map, variables_map
\ No newline at end of file
+        if self.contains_cache.enabled:
+            self.contains_cache.put(cache_key, deepcopy(structures_map))
+        return structures_map, variables_map
+
+
+def get_index_service(engine, url, database, user=None, passwd=None, logger=None,
+                      persistent_session=False, cache_size=1000, contains_cache_size=500,
+                      generation_check_interval=5):
+    """
+    Build the index service for the given *engine*: 'basex' returns an :class:`IndexService`
+    that uses the BaseX server at *url*, 'local' returns a
+    :class:`pyehr.ehr.services.dbmanager.dbservices.local_index_service.LocalIndexService`
+    that stores the index *database* in the directory *url* (*user*, *passwd*,
+    *persistent_session* and the caches settings are ignored).
+    """
+    if engine == 'basex':
+        return IndexService(database, url, user, passwd, logger, cache_size=cache_size,
+                            persistent_session=persistent_session,
+                            contains_cache_size=contains_cache_size,
+                            generation_check_interval=generation_check_interval)
+    elif engine == 'local':
+        from local_index_service import LocalIndexService
+        return LocalIndexService(os.path.join(url, '%s.json' % database), logger)
+    else:
+        raise UnknownIndexEngineError('Unknown index engine: %s' % engine)
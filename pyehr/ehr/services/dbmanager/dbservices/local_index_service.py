@@ -0,0 +1,380 @@
+import os, time, atexit
+from uuid import uuid4
+from threading import RLock
+from lxml import etree
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyehr.utils import get_logger
+from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+
+
+class StructureNode(object):
+    """
+    A node of an archetype structure: the class of the archetype, the path that links
+    it to its parent and the references to parent and children nodes
+    """
+
+    __slots__ = ('archetype_class', 'path_from_parent', 'parent', 'children')
+
+    def __init__(self, archetype_class, path_from_parent, parent=None):
+        self.archetype_class = archetype_class
+        self.path_from_parent = path_from_parent
+        self.parent = parent
+        self.children = []
+
+    @staticmethod
+    def from_xml(xml_node, parent=None):
+        node = StructureNode(xml_node.get('class'), xml_node.get('path_from_parent'), parent)
+        node.children = [StructureNode.from_xml(ch, node) for ch in xml_node.iterchildren()]
+        return node
+
+    @staticmethod
+    def from_json(json_node, parent=None):
+        node = StructureNode(json_node[0], json_node[1], parent)
+        node.children = [StructureNode.from_json(ch, node) for ch in json_node[2]]
+        return node
+
+    def to_json(self):
+        return [self.archetype_class, self.path_from_parent, [ch.to_json() for ch in self.children]]
+
+    def iter_nodes(self):
+        # pre-order visit, the same order used by XPath to return nodes
+        yield self
+        for ch in self.children:
+            for n in ch.iter_nodes():
+                yield n
+
+
+class IndexedStructure(object):
+
+    __slots__ = ('structure_id', 'structure_hash', 'hits', 'root')
+
+    def __init__(self, structure_id, structure_hash, root, hits=0):
+        self.structure_id = structure_id
+        self.structure_hash = structure_hash
+        self.root = root
+        self.hits = hits
+
+    def to_json(self):
+        return {
+            'structure_id': self.structure_id,
+            'structure_hash': self.structure_hash,
+            'hits': self.hits,
+            'structure': self.root.to_json()
+        }
+
+
+class LocalIndexService(object):
+    """
+    An in-process alternative to the BaseX based :class:`IndexService`, it exposes the
+    same API but keeps archetype structures in memory, indexed by archetype class, and
+    persists them to a local JSON file. Structure hashes are calculated in the same way
+    used by the :class:`IndexService` so STRUCTURE_IDs can be migrated from one service
+    to the other.
+
+    The whole index is written at once, so writes are batched: pending changes are written
+    when :meth:`flush` or :meth:`disconnect` are called and when the interpreter exits.
+    The index file is reloaded if modified by another process while there are no pending
+    changes, anyway only one process should write on the same index file.
+
+    :ivar index_file: the file used to persist the index
+    :ivar autosave: if True, the index file is also written once *max_pending_changes*
+      operations changed the index or *flush_interval* seconds passed since the last write
+    :ivar max_pending_changes: the number of changes that triggers a write of the index file
+    :ivar flush_interval: the number of seconds after which pending changes trigger a write
+      of the index file
+    """
+
+    def __init__(self, index_file, logger=None, autosave=True, max_pending_changes=100,
+                 flush_interval=5):
+        self.index_file = index_file
+        self.autosave = autosave
+        self.max_pending_changes = max_pending_changes
+        self.flush_interval = flush_interval
+        self.logger = logger or get_logger('local_index_service')
+        self.structures = dict()
+        self.hashes = dict()
+        # maps archetype classes to the nodes of each structure with that class
+        self.postings = dict()
+        self._loaded_mtime = None
+        self._pending_changes = 0
+        self._flushed_at = time.time()
+        self._exit_flush_registered = False
+        self._lock = RLock()
+
+    def _index_structure(self, structure):
+        self.structures[structure.structure_id] = structure
+        self.hashes[structure.structure_hash] = structure.structure_id
+        for node in structure.root.iter_nodes():
+            self.postings.setdefault(node.archetype_class, dict())\
+                .setdefault(structure.structure_id, []).append(node)
+
+    def _remove_structure(self, structure_id):
+        structure = self.structures.pop(structure_id)
+        del self.hashes[structure.structure_hash]
+        for node in structure.root.iter_nodes():
+            class_postings = self.postings.get(node.archetype_class)
+            if class_postings is not None:
+                class_postings.pop(structure_id, None)
+                if len(class_postings) == 0:
+                    del self.postings[node.archetype_class]
+
+    def _get_file_mtime(self):
+        try:
+            return os.stat(self.index_file).st_mtime
+        except OSError:
+            return None
+
+    def _load(self):
+        self.structures = dict()
+        self.hashes = dict()
+        self.postings = dict()
+        mtime = self._get_file_mtime()
+        if mtime is not None:
+            with open(self.index_file) as f:
+                index = json.load(f)
+            for s in index['structures']:
+                self._index_structure(IndexedStructure(str(s['structure_id']), str(s['structure_hash']),
+                                                       StructureNode.from_json(s['structure']), s['hits']))
+            self.logger.debug('Loaded %d structures from %s', len(self.structures), self.index_file)
+        self._loaded_mtime = mtime
+
+    def _check_index_file(self):
+        # pending changes would be lost, they will overwrite the index file anyway
+        if self._pending_changes == 0 and self._get_file_mtime() != self._loaded_mtime:
+            self._load()
+
+    def flush(self):
+        """
+        Write the index to the index file
+        """
+        with self._lock:
+            tmp_file = '%s.%s.tmp' % (self.index_file, uuid4().hex)
+            with open(tmp_file, 'w') as f:
+                json.dump({'structures': [s.to_json() for s in self.structures.itervalues()]}, f)
+            os.rename(tmp_file, self.index_file)
+            self._loaded_mtime = self._get_file_mtime()
+            self._pending_changes = 0
+            self._flushed_at = time.time()
+
+    def _flush_pending_changes(self):
+        with self._lock:
+            if self._pending_changes > 0:
+                self.flush()
+
+    def _exit_flush(self):
+        try:
+            self._flush_pending_changes()
+        except (IOError, OSError), e:
+            self.logger.error('Unable to write pending changes to %s: %s', self.index_file, e)
+
+    def _save(self):
+        self._pending_changes += 1
+        if not self._exit_flush_registered:
+            atexit.register(self._exit_flush)
+            self._exit_flush_registered = True
+        if self.autosave and (self._pending_changes >= self.max_pending_changes or
+                              (time.time() - self._flushed_at) >= self.flush_interval):
+            self.flush()
+
+    def connect(self):
+        with self._lock:
+            self._check_index_file()
+
+    def disconnect(self):
+        self._flush_pending_changes()
+
+    def delete_index(self):
+        """
+        Delete the index file and all the structures it contains
+        """
+        with self._lock:
+            try:
+                os.remove(self.index_file)
+            except OSError:
+                # index never written
+                pass
+            self._pending_changes = 0
+            self._load()
+
+    def check_connection(self):
+        return True
+
+    @staticmethod
+    def get_structure(ehr_record, parent_key=None):
+        return IndexService.get_structure(ehr_record, parent_key)
+
+    def _get_record_hash(self, record):
+        return IndexService.get_structure_hash(etree.tostring(record))
+
+    def _add_structure(self, xml_structure, record_hash, structure_id=None):
+        structure = IndexedStructure(structure_id or uuid4().hex, record_hash,
+                                     StructureNode.from_xml(xml_structure))
+        self._index_structure(structure)
+        return structure.structure_id
+
+    def create_entry(self, record, record_id=None):
+        with self._lock:
+            self._check_index_file()
+            structure_id = self._add_structure(record, self._get_record_hash(record), record_id)
+            self._save()
+            return structure_id
+
+    def get_structure_id(self, ehr_record):
+        """
+        Return the STRUCTURE_ID related to the given EHR, if no ID is related to
+        record's structure create a new entry in the index and return the newly created
+        value
+
+        :param ehr_record: the EHR as a dictionary
+        :type ehr_record: dictionary
+        """
+        return self.get_structure_ids([ehr_record])[0]
+
+    def get_structure_ids(self, ehr_records):
+        """
+        Return the STRUCTURE_IDs related to the given EHRs, structures that are not yet
+        in the index are created.
+
+        :param ehr_records: the EHRs as dictionaries
+        :type ehr_records: list
+        :return: a list with the STRUCTURE_IDs, the n-th element of the list is the
+          STRUCTURE_ID of the n-th EHR
+        """
+        with self._lock:
+            self._check_index_file()
+            structure_ids = list()
+            created = False
+            for ehr_record in ehr_records:
+                structure = IndexService.serialize_structure(ehr_record)
+                record_hash = IndexService.get_structure_hash(structure)
+                str_id = self.hashes.get(record_hash)
+                if not str_id:
+                    str_id = self._add_structure(etree.fromstring(structure), record_hash)
+                    created = True
+                structure_ids.append(str_id)
+            if created:
+                self._save()
+            return structure_ids
+
+    def update_structure_counters(self, counters):
+        """
+        Apply a batch of changes to the references counters of the structures. *counters*
+        maps structure IDs to the value that will be added to their references counter,
+        negative values decrease the counter while a value equal to 0 only checks the counter.
+        Structures with a references counter equal or lower than 0 after the update will be
+        deleted.
+
+        :param counters: a dictionary (or a Counter) mapping structure IDs to the deltas
+        :type counters: dict
+        :return: the IDs of the structures that are not in the index
+        """
+        if len(counters) == 0:
+            return []
+        missing = list()
+        with self._lock:
+            self._check_index_file()
+            changed = False
+            for str_id, delta in counters.iteritems():
+                structure = self.structures.get(str_id)
+                if structure is None:
+                    if delta != 0:
+                        self.logger.warn('There is no structure with ID %s', str_id)
+                    missing.append(str_id)
+                    continue
+                if delta != 0:
+                    structure.hits += delta
+                    changed = True
+                if structure.hits <= 0:
+                    self._remove_structure(str_id)
+                    changed = True
+            # checks of referenced structures and missing IDs leave the index unchanged
+            if changed:
+                self._save()
+        return missing
+
+    def check_structure_counter(self, structure_id):
+        """
+        Check if a structure with ID *structure_id* has a references counter equal to 0.
+        If so, delete the structure because it is not referenced by a clinical record.
+
+        :param structure_id: the ID of the structure that will be checked
+        """
+        self.update_structure_counters({structure_id: 0})
+
+    def increase_structure_counter(self, structure_id, increase_value=1):
+        """
+        Increase the value of the references counter of the structure with the
+        given *structure_id* by the amount specified by *increase_value*.
+
+        :param structure_id: the ID of the structure
+        :param increase_value: the value that will be added to structure's references counter
+        """
+        if increase_value < 1:
+            raise ValueError("increase_value must be an integer greater than 0")
+        self.update_structure_counters({structure_id: increase_value})
+
+    def decrease_structure_counter(self, structure_id, decrease_value=1):
+        """
+        Decrease the value of the references counter of the structure with the
+        given *structure_id* by the amount specified by *decrease_value*.
+        If references counter reaches a value equal or lower than 0, the
+        structure will be delete.
+
+        :param structure_id: the ID of the structure
+        :param decrease_value: the value that will be subtracted from structure's references counter
+        """
+        if decrease_value < 1:
+            raise ValueError("decrease_value must be an integer greater than 0")
+        self.update_structure_counters({structure_id: -decrease_value})
+
+    def _match_containers(self, node, archetype_classes):
+        # node matches the last container, look for the nearest ancestors matching
+        # the other ones; a None class matches any archetype
+        for archetype_class in reversed(archetype_classes[:-1]):
+            node = node.parent
+            while node is not None and archetype_class is not None and \
+                    node.archetype_class != archetype_class:
+                node = node.parent
+            if node is None:
+                return False
+        return True
+
+    def _resolve_node_paths(self, node, container_classes, leaf_class):
+        paths_map = dict()
+        paths_map.setdefault(leaf_class, []).insert(0, node.path_from_parent)
+        while len(container_classes):
+            current_class = container_classes.pop(-1)
+            while node.parent is not None and node.archetype_class != current_class:
+                node = node.parent
+                for v in paths_map.values():
+                    v.insert(0, node.path_from_parent)
+            paths_map.setdefault(current_class, []).append(node.path_from_parent)
+        # container_classes mapped, go back and complete all paths, if necessary
+        while node.parent is not None:
+            node = node.parent
+            for v in paths_map.values():
+                v.insert(0, node.path_from_parent)
+        return paths_map
+
+    def map_aql_contains(self, aql_containers):
+        archetype_classes = [c.class_expression.predicate.archetype_id if c.class_expression.predicate else None
+                             for c in aql_containers]
+        variables_map = dict((c.class_expression.variable_name, c.class_expression.predicate.archetype_id)
+                             for c in aql_containers if c.class_expression.predicate)
+        container_classes = [c.class_expression.predicate.archetype_id
+                             for c in aql_containers if c.class_expression.predicate]
+        leaf_class = container_classes.pop(-1)
+        structures_map = dict()
+        with self._lock:
+            self._check_index_file()
+            for str_id, nodes in self.postings.get(leaf_class, {}).iteritems():
+                for node in nodes:
+                    if self._match_containers(node, archetype_classes):
+                        paths_map = self._resolve_node_paths(node, list(container_classes), leaf_class)
+                        structures_map.setdefault(str_id, []).append(paths_map)
+        return structures_map, variables_map
@@ -1,13 +1,14 @@
 from pyehr.aql.parser import *
-from pyehr.ehr.services.dbmanager.drivers.interface import DriverInterface
+from pyehr.ehr.services.dbmanager.drivers.interface import DriverInterface, get_worker_driver
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import *
 from pyehr.ehr.services.dbmanager.errors import *
 from pyehr.utils import *
-from itertools import izip
+from itertools import izip, islice
+from multiprocessing.pool import ThreadPool
 from hashlib import md5
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
-    ResultColumnDef, ResultRow
-from multiprocessing import Pool
+    ResultColumnDef, ResultRow, StreamingResultSet
+from functools import partial
 
 try:
     import simplejson as json
@@ -30,16 +31,18 @@ class MultiprocessQueryRunner(object):
         self.user = user
         self.passwd = passwd
 
+    def _get_driver(self):
+        return get_worker_driver(ElasticSearchDriver, self.host, self.database, self.collection_name,
+                                 self.port, self.user, self.passwd)
+
     def __call__(self, query_description):
-        driver_instance = ElasticSearchDriver(
-            self.host, self.database, self.collection_name,
-            self.port, self.user, self.passwd
-        )
+        driver_instance = self._get_driver()
         results = driver_instance._run_aql_query(
             query_description['condition'], query_description['selection'],
             query_description['aliases'], self.collection_name
         )
-        return results
+        # a compact batch is cheaper to send back to the parent process than a ResultSet
+        return results.to_batch()
 
 class ElasticSearchDriver(DriverInterface):
     """
@@ -61,10 +64,18 @@ class ElasticSearchDriver(DriverInterface):
     # This map is used to encode\decode data when writing\reading to\from ElasticSearch
     #ENCODINGS_MAP = {'.': '-'}   I NEED TO SEE THE QUERIES
     ENCODINGS_MAP = {}
+    CLINICAL_RECORD_SUMMARY_FIELDS = DriverInterface.CLINICAL_RECORD_SUMMARY_FIELDS + ['version']
+    INSERT_BATCH_SIZE = 1000
+    # limits of the chunks sent with a single bulk request
+    BULK_CHUNK_SIZE = 500
+    BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+    # no refresh is issued after each write operation during a bulk ingest
+    BULK_INGEST_OPTIONS = {'refresh': 'false', 'drefresh': 'false'}
 
     def __init__(self, host, database,collection,
                  port=None, user=None, passwd=None,
-                 index_service=None, logger=None):
+                 index_service=None, logger=None, queries_pool=None, clients_pool=None,
+                 refresh='true', drefresh='true', bulk_threads=1):
         self.client = None
         self.host = host
         self.database = database
@@ -76,6 +87,10 @@ class ElasticSearchDriver(DriverInterface):
         self.transportclass=elasticsearch.Urllib3HttpConnection
         self.index_service = index_service
         self.logger = logger or get_logger('elasticsearch-db-driver')
+        #pool of processes used for multiprocessor queries, if None a new pool is created for each query
+        self.queries_pool = queries_pool
+        #pool of clients shared by drivers, if None the driver opens its own client
+        self.clients_pool = clients_pool
         self.regtrue = re.compile("([ :])True([ \]},])")
         self.regfalse = re.compile("([ :])False([ \]},])")
         self.database_ids_suffix="lookup"
@@ -93,14 +108,16 @@ class ElasticSearchDriver(DriverInterface):
         self.dere="lookuptable"
         #method in delete_later_versions:"search" or "lookuptable"
         self.dlv="lookuptable"
-        #refresh for insertion. put to false for long bulk insertion
-        self.refresh='true'
+        #refresh for insertion. put to false for long bulk insertion (see bulk_ingest)
+        self.refresh=refresh
         #timeout for insertion
         self.insert_timeout = 600
         #timeout for all action on es
         self.global_timeout=60
-        #refresh for deletion. put to false for long bulk deletion
-        self.drefresh='true'
+        #refresh for deletion. put to false for long bulk deletion (see bulk_ingest)
+        self.drefresh=drefresh
+        #number of threads sending the chunks of a bulk insertion
+        self.bulk_threads = bulk_threads
     def __enter__(self):
         self.connect()
         return self
@@ -109,19 +126,31 @@ class ElasticSearchDriver(DriverInterface):
         self.disconnect()
         return None
 
+    def _get_client_key(self):
+        # indices (databases) are selected for each request, clients are shared by
+        # all the drivers connecting to the same hosts
+        return self.__class__, str(self.host), self.user, self.passwd, self.global_timeout
+
+    def _new_client(self):
+        try:
+            client = elasticsearch.Elasticsearch(hosts=self.host,connection_class=self.transportclass,
+                                                 maxsize=100,timeout=self.global_timeout)
+            client.info()
+        except elasticsearch.TransportError:
+            raise DBManagerNotConnectedError('Unable to connect to ElasticSearch at %s:%s' %
+                                            (self.host[0]['host'], self.host[0]['port']))
+        return client
+
     def connect(self):
         """
         Open a connection to a ES server.
         """
         if not self.client:
             self.logger.debug('connecting to host %s', self.host)
-            try:
-                self.client = elasticsearch.Elasticsearch(hosts=self.host,connection_class=self.transportclass,
-                                                          maxsize=100,timeout=self.global_timeout)
-                self.client.info()
-            except elasticsearch.TransportError:
-                raise DBManagerNotConnectedError('Unable to connect to ElasticSearch at %s:%s' %
-                                                (self.host[0]['host'], self.host[0]['port']))
+            if self.clients_pool is not None:
+                self.client = self.clients_pool.get_client(self._get_client_key(), self._new_client)
+            else:
+                self.client = self._new_client()
             self.logger.debug('binding to database %s', self.database)
             #there is no authentication/authorization layer in elasticsearch
             self.logger.debug('using collection %s', self.collection)
@@ -144,6 +173,60 @@ class ElasticSearchDriver(DriverInterface):
         """
         pass
 
+    def _get_ingest_settings(self, disable_refresh_interval, replicas):
+        settings = dict()
+        if disable_refresh_interval:
+            settings['refresh_interval'] = '-1'
+        if replicas is not None:
+            settings['number_of_replicas'] = replicas
+        return settings
+
+    def start_bulk_ingest(self, disable_refresh_interval=True, replicas=None):
+        """
+        Prepare the index of the current database and its lookup table for a bulk load:
+        periodic refresh is disabled and the number of replicas is changed, indices that
+        don't exist yet are created with these settings.
+
+        :param disable_refresh_interval: if True, set refresh_interval to -1
+        :type disable_refresh_interval: bool
+        :param replicas: if not None, the number_of_replicas used during the load
+        :type replicas: int
+        :return: a dictionary with the original settings of each index
+        :rtype: dict
+        """
+        self.__check_connection()
+        ingest_settings = self._get_ingest_settings(disable_refresh_interval, replicas)
+        original_settings = dict()
+        for index in (self.database, self.database_ids):
+            if self.client.indices.exists(index=index):
+                current = self.client.indices.get_settings(index=index, flat_settings=True)
+                current = current.values()[0]['settings']
+                # settings that are not explicitly set are restored to their default value
+                original_settings[index] = dict((k, current.get('index.%s' % k)) for k in ingest_settings)
+                if ingest_settings:
+                    self.client.indices.put_settings(index=index, body={'index': ingest_settings})
+            else:
+                self.client.indices.create(index=index, body={'settings': {'index': ingest_settings}})
+                original_settings[index] = dict((k, None) for k in ingest_settings)
+            self.logger.debug('index %s ready for bulk ingest (settings %r)', index, ingest_settings)
+        return original_settings
+
+    def stop_bulk_ingest(self, ingest_state):
+        """
+        Restore the settings of the indices changed by :meth:`start_bulk_ingest` and
+        refresh them, making all loaded records available for search
+
+        :param ingest_state: the original settings returned by :meth:`start_bulk_ingest`
+        :type ingest_state: dict
+        """
+        self.__check_connection()
+        if not ingest_state:
+            return
+        for index, settings in ingest_state.iteritems():
+            if settings:
+                self.client.indices.put_settings(index=index, body={'index': settings})
+        self.client.indices.refresh(index=','.join(ingest_state))
+
     @property
     def is_connected(self):
         """
@@ -539,6 +622,50 @@ class ElasticSearchDriver(DriverInterface):
                                         body=existing_record,op_type='create',refresh=self.refresh,
                               timeout=self.insert_timeout)
 
+    def _store_ids_batch(self,records,rectype_clinical):
+        """
+        store a batch of records in the lookup table: ids are grouped by baseid, existing
+        entries are fetched with a single multi get and the updated entries are written
+        with a single bulk request, the lookup index is refreshed once
+
+        :param records: records to store in the lookup table
+        :type  records: list of dict
+        :param rectype_clinical: whether the records are clinical records
+        :type rectype_clinical: bool
+        """
+        if not records:
+            return
+        new_ids=dict()
+        records_by_baseid={}
+        for r in records:
+            if rectype_clinical:
+                self._select_doc_type(r['ehr_structure_id'])
+                baseid=r['_id'].rsplit('_', 1)[0]
+            else:
+                baseid=r['_id']
+            new_ids.setdefault(baseid,[]).append([r['_id'],self.database,self.collection_name])
+            records_by_baseid.setdefault(baseid,[]).append(r)
+        res=self.client.mget(index=self.database_ids,doc_type=self.doc_ids,body={'ids':new_ids.keys()})
+        existing_ids=dict((doc['_id'],doc['_source']['ids']) for doc in res['docs'] if doc.get('found'))
+        bulklist=[]
+        for baseid,ids in new_ids.iteritems():
+            if baseid in existing_ids:
+                bulklist.append({'index':{'_index':self.database_ids,'_type':self.doc_ids,'_id':baseid}})
+                bulklist.append({'ids':existing_ids[baseid]+ids})
+            else:
+                bulklist.append({'create':{'_index':self.database_ids,'_type':self.doc_ids,'_id':baseid}})
+                bulklist.append({'ids':ids})
+        bulkanswer=self.client.bulk(body=bulklist,refresh=self.refresh,timeout=self.insert_timeout)
+        if bulkanswer['errors']:
+            # entries created by someone else in the meantime, store their ids one by one
+            for b in bulkanswer['items']:
+                action=b.values()[0]
+                if action.has_key('error'):
+                    for r in records_by_baseid[action['_id']]:
+                        if rectype_clinical:
+                            self._select_doc_type(r['ehr_structure_id'])
+                        self._store_ids(r)
+
 
     def _erase_ids(self,id2e):
         """
@@ -554,7 +681,7 @@ class ElasticSearchDriver(DriverInterface):
             if new_value:
                 existing_record['ids']=new_value
                 self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=id2e,
-                                        body=existing_record,refresh='true',timeout=self.insert_timeout)
+                                        body=existing_record,refresh=self.drefresh,timeout=self.insert_timeout)
             else:
                 self.client.delete(index=self.database_ids,doc_type=self.doc_ids,id=id2e,refresh=self.drefresh)
         else:
@@ -566,40 +693,120 @@ class ElasticSearchDriver(DriverInterface):
                 if new_value:
                     existing_record['ids']=new_value
                     self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=baseid,
-                                        body=existing_record,refresh='true',timeout=self.insert_timeout)
+                                        body=existing_record,refresh=self.drefresh,timeout=self.insert_timeout)
                 else:
                     self.client.delete(index=self.database_ids,doc_type=self.doc_ids,id=baseid,refresh=self.drefresh)
             else:
                 raise MissingRevisionError("A record with ID %s does not exist in archive" % id)
 
-    def pack_records(self,records,rectype_clinical):
+    def _check_records_type(self,records,rectype_clinical):
         """
-        pack records for the bulk insertion
-        the records must be of the same type
+        check that the records are all clinical records or all patient records
 
-        :param records: records to be packed
+        :param records: records to be checked
         :type records : list of dict
-        :param rectype_clinical: whether the first record a clinical record
+        :param rectype_clinical: whether the records must be clinical records
         :type rectype_clinical: bool
-        :return:
         """
-        first="{\"create\":{\"_index\":\""+self.database
-        puzzle=""
         for dox in records:
             if(rectype_clinical and self._is_patient_record(dox)):
                 raise InvalidRecordTypeError("Patient Record among Clinical Records")
             if((not rectype_clinical) and (not self._is_patient_record(dox))):
                 raise InvalidRecordTypeError("Clinical Record among Patient Records")
+
+    def _iter_bulk_lines(self,records,rectype_clinical):
+        """
+        yield the action and source lines of the bulk insertion for each record,
+        the doc_type of clinical records is calculated without changing the selected one
+        """
+        for dox in records:
             if rectype_clinical:
-                self._select_doc_type(dox['ehr_structure_id'])
-            puzzle=puzzle+first+"\",\"_type\":\""+self.collection_name+"\""
-            if(dox.has_key('_id')):
-                puzzle = puzzle+",\"_id\":\""+dox['_id']+"\"}}\n"
+                doc_type=self.collection+"_"+dox['ehr_structure_id']
             else:
-                puzzle=puzzle+"}}\n"
-            puzzle=puzzle+self._to_json(dox)
-            puzzle=puzzle+"\n"
-        return puzzle
+                doc_type=self.collection_name
+            action={'_index':self.database,'_type':doc_type}
+            if(dox.has_key('_id')):
+                action['_id']=dox['_id']
+            yield self._to_json({'create':action})+"\n", self._to_json(dox)+"\n"
+
+    def pack_records(self,records,rectype_clinical):
+        """
+        pack records for the bulk insertion
+        the records must be of the same type
+
+        :param records: records to be packed
+        :type records : list of dict
+        :param rectype_clinical: whether the first record a clinical record
+        :type rectype_clinical: bool
+        :return: the body of the bulk request
+        :rtype: str
+        """
+        self._check_records_type(records,rectype_clinical)
+        return "".join(line for lines in self._iter_bulk_lines(records,rectype_clinical) for line in lines)
+
+    def _iter_bulk_chunks(self,records,rectype_clinical):
+        """
+        pack records for the bulk insertion in chunks with at most BULK_CHUNK_SIZE records
+        and BULK_MAX_CHUNK_BYTES bytes (a single record bigger than the limit makes a chunk
+        on its own), chunks are built only when requested
+
+        :param records: records to be packed
+        :type records : list of dict
+        :param rectype_clinical: whether the records are clinical records
+        :type rectype_clinical: bool
+        :return: a generator of request bodies
+        """
+        chunk=[]
+        chunk_records=0
+        chunk_bytes=0
+        for action,source in self._iter_bulk_lines(records,rectype_clinical):
+            lines_bytes=len(action)+len(source)
+            if chunk and (chunk_records==self.BULK_CHUNK_SIZE or
+                          chunk_bytes+lines_bytes>self.BULK_MAX_CHUNK_BYTES):
+                yield "".join(chunk)
+                chunk=[]
+                chunk_records=0
+                chunk_bytes=0
+            chunk.append(action)
+            chunk.append(source)
+            chunk_records+=1
+            chunk_bytes+=lines_bytes
+        if chunk:
+            yield "".join(chunk)
+
+    def _send_bulk_chunk(self,body):
+        return self.client.bulk(body=body,index=self.database,refresh=self.refresh,
+                                timeout=self.insert_timeout)['items']
+
+    def _send_bulk(self,records,rectype_clinical):
+        """
+        save records with bulk requests, up to bulk_threads chunks are built and sent in parallel
+
+        :param records: records to be saved
+        :type records : list of dict
+        :param rectype_clinical: whether the records are clinical records
+        :type rectype_clinical: bool
+        :return: the IDs of the saved records and a bool which says if one or more records
+                 were not saved
+        :rtype: list, bool
+        """
+        chunks=self._iter_bulk_chunks(records,rectype_clinical)
+        items=[]
+        if self.bulk_threads>1:
+            pool=ThreadPool(self.bulk_threads)
+            try:
+                # take only as many chunks as the threads, memory is bounded by bulk_threads chunks
+                for group in iter(lambda: list(islice(chunks,self.bulk_threads)),[]):
+                    for chunk_items in pool.map(self._send_bulk_chunk,group):
+                        items.extend(chunk_items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for body in chunks:
+                items.extend(self._send_bulk_chunk(body))
+        saved=[b['create']['_id'] for b in items if not b['create'].has_key('error')]
+        return saved,len(saved)<len(items)
 
 
     def _is_id_taken(self,indextc,idtc,collection_nametc=None):
@@ -620,70 +827,78 @@ class ElasticSearchDriver(DriverInterface):
             return self.client.exists(index=indextc,id=idtc)
 
 
-    def add_records(self,records,skip_existing_duplicated=False):
+    def _get_taken_ids(self,records_ids):
+        """
+        given a list of ids returns the ones already used by a record of the current database
+
+        :param records_ids: ids
+        :type records_ids: list
+        :return: set
+        """
+        res = self.client.mget(index=self.database,body={'ids':records_ids},_source=False)
+        return set(doc['_id'] for doc in res['docs'] if doc.get('found'))
+
+    def add_records(self,records,skip_existing_duplicated=False,batch_size=None):
         """
         Save a list of records in ES and return records' IDs
+        IDs already in use are checked for each batch of *batch_size* records, the records of a
+        batch are saved with bulk requests bounded by BULK_CHUNK_SIZE and BULK_MAX_CHUNK_BYTES
+        that are sent in parallel when bulk_threads is greater than 1
 
         :param records: the list of records that is going to be saved
         :type record: list
-        :return: a list of records' IDs
+        :param skip_existing_duplicated: ignore duplicated key errors and save records with a unique ID
+        :type skip_existing_duplicated: bool
+        :param batch_size: the number of records checked and saved with a single request, if None
+                           INSERT_BATCH_SIZE will be used
+        :type batch_size: int
+        :return: a list of records' IDs and a list of records that caused a duplicated key error
         :rtype: list
         """
         if len(records) == 0:
             return [],[]
         self.__check_connection()
+        batch_size = batch_size or self.INSERT_BATCH_SIZE
         if self._is_patient_record(records[0]):
             rectype_clinical= False
         else:
              rectype_clinical= True
+        self._check_records_type(records,rectype_clinical)
         duplicatedlist=[]
         notduplicatedlist=[]
-        duplicatedlistid=[]
+        uniquelist=[]
         records_map={}
         for r in records:
             myid=r['_id']
             if myid in records_map:
                 duplicatedlist.append(r)
-                duplicatedlistid.append(myid)
             else:
                 records_map[myid]=r
-                if(not self._is_patient_record(r)):
-                    self._select_doc_type(r['ehr_structure_id'])
-                if(self._is_id_taken(self.database,myid)):
-                    duplicatedlist.append(r)
-                    duplicatedlistid.append(myid)
-                else:
-                    notduplicatedlist.append(r)
+                uniquelist.append(r)
+        taken_ids=set()
+        for i in xrange(0,len(uniquelist),batch_size):
+            taken_ids.update(self._get_taken_ids([r['_id'] for r in uniquelist[i:i+batch_size]]))
+        for r in uniquelist:
+            if r['_id'] in taken_ids:
+                duplicatedlist.append(r)
+            else:
+                notduplicatedlist.append(r)
         if duplicatedlist and not skip_existing_duplicated:
-            raise DuplicatedKeyError('The following IDs are already in use: %s' % duplicatedlistid)
-        bulklist = self.pack_records(notduplicatedlist,rectype_clinical)
-        bulkanswer = self.client.bulk(body=bulklist,index=self.database,refresh=self.refresh,
-                                      timeout=self.insert_timeout)
-        failuresid=[]
-        errtype=[]
-        nerrors=0
+            raise DuplicatedKeyError('The following IDs are already in use: %s' %
+                                     [r['_id'] for r in duplicatedlist])
         successfulid=[]
-        if(bulkanswer['errors']): # there are errors
-            for b in bulkanswer['items']:
-                if(b['create'].has_key('error')):
-                    failuresid.append(str(b['create']['_id']))
-                    errtype.append(str(b['create']['error']))
-                    nerrors += 1
-                else:
-                    successfulid.append(b['create']['_id'])
-            for s in successfulid:
-                r=records_map[s]
-                if rectype_clinical:
-                    self._select_doc_type(r['ehr_structure_id'])
-                self._store_ids(r)
-                self.delete_record(s)
-            return [],duplicatedlist
-        else:
-            for r in notduplicatedlist:
-                if rectype_clinical:
-                    self._select_doc_type(r['ehr_structure_id'])
-                self._store_ids(r)
-            return [b['create']['_id'] for b in bulkanswer['items']],duplicatedlist
+        for i in xrange(0,len(notduplicatedlist),batch_size):
+            batch=notduplicatedlist[i:i+batch_size]
+            saved,errors=self._send_bulk(batch,rectype_clinical)
+            self._store_ids_batch([records_map[sid] for sid in saved],rectype_clinical)
+            successfulid.extend(saved)
+            if errors: # there are errors, delete all the records saved so far
+                for s in successfulid:
+                    if rectype_clinical:
+                        self._select_doc_type(records_map[s]['ehr_structure_id'])
+                    self.delete_record(s)
+                return [],duplicatedlist
+        return successfulid,duplicatedlist
 
     def get_record_by_id(self, record_id):
         """
@@ -727,6 +942,35 @@ class ElasticSearchDriver(DriverInterface):
 
 
 
+    def get_records_by_ids(self, records_ids, fields=None, batch_size=1000):
+        """
+        Retrieve the records with the given IDs, when using the "current" method records are
+        fetched with a multi get request for each batch of *batch_size* IDs, the "lookuptable"
+        method needs a request for each record
+
+        :param records_ids: the IDs of the records
+        :type records_ids: list
+        :param fields: a list of field names that should be returned, if None the whole
+                       records are returned
+        :type fields: list
+        :param batch_size: the maximum number of IDs used for a single request
+        :type batch_size: int
+        :return: the records matching the given IDs, IDs without a record are ignored
+        :rtype: list
+        """
+        self.__check_connection()
+        if self.grbi == "lookuptable":
+            records = [self.get_record_by_id(rid) for rid in records_ids]
+            return [r for r in records if r is not None]
+        params = dict()
+        if fields:
+            params['_source_include'] = ','.join(fields)
+        records = list()
+        for i in xrange(0, len(records_ids), batch_size):
+            res = self.client.mget(index=self.database, body={'ids': records_ids[i:i+batch_size]}, **params)
+            records.extend(decode_dict(doc['_source']) for doc in res['docs'] if doc.get('found'))
+        return records
+
     def get_record_by_id_lookup(self, record_id):
         """
         Retrieve a record using its ID
@@ -1035,7 +1279,7 @@ class ElasticSearchDriver(DriverInterface):
             if new_er:
                 existing_record['ids']=new_er
                 self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=baseid,
-                                        body=existing_record,refresh='true',timeout=self.insert_timeout)
+                                        body=existing_record,refresh=self.drefresh,timeout=self.insert_timeout)
             self.client.indices.refresh(index=self.database_ids)
             return counter
         else:
@@ -1248,13 +1492,41 @@ class ElasticSearchDriver(DriverInterface):
         self.logger.debug('updated %s document', res[u'_id'])
         return last_update
 
+    def _merge_bool_queries(self, bool_query, other_bool_query):
+        """
+        add the clauses of a bool query to another one, clauses with the same occurrence
+        type (must, must_not, should, filter) are joined in a single list
+        :param bool_query: the bool query that will be updated
+        :param other_bool_query: the bool query whose clauses will be added
+        :return: the updated bool query
+        """
+        for occur, clauses in other_bool_query.iteritems():
+            if isinstance(clauses, list):
+                bool_query.setdefault(occur, []).extend(clauses)
+            else:
+                bool_query[occur] = clauses
+        return bool_query
+
+    def _merge_location_expression(self, condition_query, location_query):
+        return self._merge_bool_queries(condition_query, location_query)
+
+    def _to_bool_clause(self, bool_query):
+        """
+        convert a bool query to a clause that can be nested in another bool query
+        :param bool_query:
+        :return: the single clause of a bool query with a single must clause or the bool query
+        """
+        if bool_query.keys() == ['must'] and len(bool_query['must']) == 1:
+            return bool_query['must'][0]
+        return {'bool': bool_query}
+
     def _map_operand(self, left, right, operand):
         """
         map operand from AQL to ES
         :param left: left part of the expression
         :param right: right part of the expression
         :param operand: operand
-        :return: mapped expression in ES syntax
+        :return: a bool query with the mapped expression in ES syntax
         """
         def cast_right_operand(rigth_operand):
             if rigth_operand.isdigit():
@@ -1278,11 +1550,11 @@ class ElasticSearchDriver(DriverInterface):
         right = cast_right_operand(right.strip())
         left = left.strip()
         if operand == '=':
-            return {"{\"match\" : "+str({left : right})+"}" : "$%nothing%$"}
+            return {'must': [{'match': {left: right}}]}
         elif operand == "!=":
-            return   { "  \"must_not\" : { \"match\" : "+str({left : right})+"}" : "$%nothing%$" }
+            return {'must_not': [{'match': {left: right}}]}
         elif operand in operands_map:
-            return { "{ \"range\" :  "+str({left: {operands_map[operand]: right}})+"}" : "$%nothing%$" }
+            return {'must': [{'range': {left: {operands_map[operand]: right}}}]}
         else:
             raise ValueError('The operand %s is not supported' % operand)
 
@@ -1356,7 +1628,7 @@ class ElasticSearchDriver(DriverInterface):
         :param condition:
         :param variables_map:
         :param containment_mapping:
-        :return: dict with condition translated in ES syntax
+        :return: the bool query with the condition translated in ES syntax
         """
         query = dict()
         paths = self._build_paths(containment_mapping)
@@ -1378,29 +1650,16 @@ class ElasticSearchDriver(DriverInterface):
                     else:
                         and_indices.append(i+1)
         if len(or_indices) > 0:
-            for j in or_indices:
-                if(str(expressions[j]).find("must_not") != -1):
-                    exprstr=self._clean_piece(expressions[j])
-                    exprstr2="{ \"bool\":"+exprstr+"}"
-                    exprstr3=exprstr2.replace("\\'","'").replace("\"bool\":{'","\"bool\":{ {'").replace("}':","}}':")
-                    expressions[j]= { exprstr3 : "$%nothing%$"}
-            or_statement= " \"should\" : "+str([ expressions[i] for i in or_indices])+",\"minimum_should_match\" : 1"
-            expressions[max(expressions.keys()) + 1] = or_statement
+            or_indices = sorted(set(or_indices))
+            should = [self._to_bool_clause(expressions[j]) for j in or_indices]
+            expressions[max(expressions.keys()) + 1] = {'should': should, 'minimum_should_match': 1}
             and_indices.append(max(expressions.keys()))
         if len(and_indices) > 0:
-            for ai in and_indices:
-                if(isinstance(expressions[ai],str)):
-                    query.update({str(expressions[ai]) : "$%nothing%$" })
-                elif (str(expressions[ai]).find("must_not") == -1 ):
-                    query.update({ " \"must\" : "+str(expressions[ai]) : "$%nothing%$" })
-                else:
-                    query.update(expressions[ai])
+            for ai in sorted(set(and_indices)):
+                self._merge_bool_queries(query, expressions[ai])
         else:
             for e in expressions.values():
-                if (str(e).find("must_not") == -1 ):
-                    query.update({" \"must\" : "+ str(e) : "$%nothing%$" })
-                else:
-                    query.update(e)
+                self._merge_bool_queries(query, e)
         return query
 
     def _compute_predicate(self, predicate):
@@ -1408,7 +1667,7 @@ class ElasticSearchDriver(DriverInterface):
         Compute a predicate (archetype or expression)
 
         :param predicate:
-        :return: dict with predicate translated in ES syntax
+        :return: the bool query with the predicate translated in ES syntax
         """
         query = dict()
         if type(predicate) == Predicate:
@@ -1422,13 +1681,12 @@ class ElasticSearchDriver(DriverInterface):
                 if op and ro:
                     self.logger.debug("lo: %s - op: %s - ro: %s", lo, op, ro)
                     if op == "=":
-                        query.update({"{ \"match\" : {"+ str({lo : ro})+"}}" : "$%nothing%$" })
-#                        query[lo] = ro
+                        self._merge_bool_queries(query, {'must': [{'match': {lo: ro}}]})
             else:
                 raise PredicateException("No predicate expression found")
         elif type(predicate) == ArchetypePredicate:
             predicate_string = predicate.archetype_id
-            query.update({"{ \"filter\" : {\"exists\" : { \"field\" : "+ str(predicate_string)+"}}}" : "$%nothing%$"} )
+            self._merge_bool_queries(query, {'filter': [{'exists': {'field': predicate_string}}]})
         else:
             raise PredicateException("No predicate expression found")
         return query
@@ -1457,14 +1715,14 @@ class ElasticSearchDriver(DriverInterface):
                 else:
                     right_operand = pr.right_operand
                 if pr.left_operand == 'uid':
-                    query.update({ " \"must\" : { \"term\" : {\"patient_id\": \"" + str(right_operand).lower() +"\"}}" : "$%nothing%$"})
+                    self._merge_bool_queries(query, {'must': [{'term': {'patient_id': str(right_operand).lower()}}]})
                 elif pr.left_operand == 'id':
                     # use given EHR ID
-                    query.update(self._map_operand(pr.left_operand,
-                                                   right_operand,
-                                                   pr.operand))
+                    self._merge_bool_queries(query, self._map_operand(pr.left_operand,
+                                                                      right_operand,
+                                                                      pr.operand))
                 else:
-                    query.update(self._compute_predicate(pr))
+                    self._merge_bool_queries(query, self._compute_predicate(pr))
             else:
                 raise PredicateException('No left operand in predicate')
         return query
@@ -1486,14 +1744,14 @@ class ElasticSearchDriver(DriverInterface):
         if location.class_expression:
             ce = location.class_expression
             if ce.class_name.upper() == 'EHR':
-                query.update(self._calculate_ehr_expression(ce, query_params,
-                                                            patients_collection,
-                                                            ehr_collection))
+                self._merge_bool_queries(query, self._calculate_ehr_expression(ce, query_params,
+                                                                               patients_collection,
+                                                                               ehr_collection))
                 if 'EHR' not in aliases_mapping:
                     aliases_mapping['EHR'] = ce.variable_name
             else:
                 if ce.predicate:
-                    query.update(self._compute_predicate(ce.predicate))
+                    self._merge_bool_queries(query, self._compute_predicate(ce.predicate))
         else:
             raise MissingLocationExpressionError("Query must have a location expression")
         return query
@@ -1537,6 +1795,12 @@ class ElasticSearchDriver(DriverInterface):
                                                                    var.variable.path.value)
         return query, results_aliases
 
+    def _get_path_value(self, document, path_keys, index=0):
+        return super(ElasticSearchDriver, self)._get_path_value(document, path_keys, index)
+
+    def _get_result_values(self, query_result, paths_keys):
+        return super(ElasticSearchDriver, self)._get_result_values(query_result, paths_keys)
+
     def _split_results(self, query_result):
         for key, value in query_result.iteritems():
             if isinstance(value, dict):
@@ -1629,6 +1893,39 @@ class ElasticSearchDriver(DriverInterface):
             return ( decode_dict(res[i]) for i in range(0,len(res)) )
         return None
 
+    def iter_records_by_query(self, query, fields=None):
+        """
+        Lazily retrieve all records matching the given query, records are fetched
+        from the server using scroll in pages of *threshold* elements while
+        they are consumed. The scroll context is released when the generator
+        is exhausted or closed.
+
+        :param query: the value that must be matched for the given field
+        :type query: string
+        :param fields: the fields to be retrieved
+        :type  fields: string
+        :return: a generator of records
+        """
+        if fields:
+            resu = self.client.search(index=self.database,_source_include=fields,size=self.threshold,
+                                      body=query,scroll=self.scrolltime)
+        else:
+            resu = self.client.search(index=self.database,size=self.threshold,body=query,scroll=self.scrolltime)
+        try:
+            while resu['hits']['hits']:
+                for hit in resu['hits']['hits']:
+                    yield decode_dict(hit['_source'])
+                if len(resu['hits']['hits']) < self.threshold:
+                    break
+                resu = self.client.scroll(scroll_id=resu['_scroll_id'], scroll=self.scrolltime)
+        finally:
+            if resu.get('_scroll_id'):
+                try:
+                    self.client.clear_scroll(scroll_id=resu['_scroll_id'])
+                except elasticsearch.NotFoundError:
+                    # scroll context already expired
+                    pass
+
     def get_records_by_query_from(self, query,fields=None,limit=0):
         """
         Retrieve all records matching the given query
@@ -1691,6 +1988,22 @@ class ElasticSearchDriver(DriverInterface):
         """
         return self.client.search(index=self.database,body=query,search_type='count')['hits']['total']
 
+    def count_records_by_field(self, query, field):
+        """
+        Retrieve the count of all records matching the given query grouped by the values
+        of *field*, counters are calculated with a single terms aggregation
+        :param query: the value that must be matched for the given field
+        :type query: string
+        :param field: the field used to group the records
+        :type field: string
+        :return: a dictionary that maps the values of *field* to the count of matching records
+        :rtype: dict
+        """
+        body = json.loads(query)
+        body['aggs'] = {'count_by': {'terms': {'field': field, 'size': 0}}}
+        res = self.client.search(index=self.database,body=body,search_type='count')
+        return dict((b['key'], b['doc_count']) for b in res['aggregations']['count_by']['buckets'])
+
 #    @profile
     def _run_aql_query(self, query, fields, aliases, collection):
         """
@@ -1722,20 +2035,36 @@ class ElasticSearchDriver(DriverInterface):
         else:
             self.select_collection(original_collection)
         if query_results:
-            for q in query_results:
-                record = dict()
-                for x in self._split_results(q):
-                    record[x[0]] = x[1]
-                rr = ResultRow(record)
-                rs.add_row(rr)
+            paths = tuple(c.path for c in rs.columns)
+            paths_keys = [p.split('.') for p in paths]
+            rs.add_rows(paths, (self._get_result_values(q, paths_keys) for q in query_results))
         return rs
 
-    def _run_aql_count(self, query, collection):
+    def _get_query_driver(self, database, collection):
+        # disconnect() resets database and collection, results that are lazily
+        # fetched need a driver of their own
+        return ElasticSearchDriver(self.host, database, collection, self.port,
+                                   self.user, self.passwd, logger=self.logger,
+                                   clients_pool=self.clients_pool)
+
+    def _iter_aql_query_rows(self, database, query, fields, aliases, collection):
+        driver = self._get_query_driver(database, collection)
+        paths = tuple(ResultColumnDef(alias, path).path for path, alias in aliases.iteritems())
+        paths_keys = [p.split('.') for p in paths]
+        driver.connect()
+        try:
+            for q in driver.iter_records_by_query(query, self._collate_selected_fields(fields)):
+                yield ResultRow.from_values(paths, self._get_result_values(q, paths_keys))
+        finally:
+            driver.disconnect()
+
+    def _run_aql_count(self, query, collection, count_by_field=None):
         """
         Run the AQL count query
 
         :param query:
         :param collection:
+        :param count_by_field: if not None, group counted records by this field
         :return: count of records matching the query given
         """
         self.logger.debug("Running count query\n%s\nwith filters\n%s", query)
@@ -1746,7 +2075,10 @@ class ElasticSearchDriver(DriverInterface):
             close_conn_after_done = True
         self.connect()
         self.select_collection(collection)
-        qcount = self.count_records_by_query(query)
+        if count_by_field:
+            qcount = self.count_records_by_field(query, count_by_field)
+        else:
+            qcount = self.count_records_by_query(query)
         if close_conn_after_done:
             self.disconnect()
         else:
@@ -1784,12 +2116,12 @@ class ElasticSearchDriver(DriverInterface):
         Return the structure selector in ES syntax
 
         :param structure_ids:
-        :return:dict with structures selector
+        :return: the bool query with the structures selector
         """
         if len(structure_ids) == 1:
-            return {"\"must\" : {\"term\" : {\"ehr_structure_id\" : \""+str(structure_ids[0])+"\"} }": "$%nothing%$"}
+            return {'must': [{'term': {'ehr_structure_id': structure_ids[0]}}]}
         else:
-            return {"\"must\" : {\"terms\" : {\"ehr_structure_id\" : "+str([structure_ids])+",\"execution\" : \"or\" } }" : "$%nothing%$"}
+            return {'must': [{'terms': {'ehr_structure_id': list(structure_ids), 'execution': 'or'}}]}
 
     def _aggregate_queries(self, queries):
         """
@@ -1802,21 +2134,21 @@ class ElasticSearchDriver(DriverInterface):
         queries_hash_map = self._get_queries_hash_map(queries)
         structures_hash_map = self._get_structures_hash_map(queries)
         for qhash, structures in structures_hash_map.iteritems():
-            ql=[]
             query = queries_hash_map[qhash]
-            q1=self._clean_piece(query['condition'])
-            ql.append(" \"query\" : { \"bool\" : "+str(q1)+"}")
-            q2=self._clean_piece(self._get_structures_selector(structures))
-            ql.append(" \"filter\" : { \"bool\" : "+str(q2)+"}")
-            qs=",".join(ql)
-            qtot=" \"query\" : { \"filtered\" : {"+qs + "}}"
-            qtot={ qtot : "$%nothing%$"}
-            query['condition']=qtot
+            query['condition'] = {
+                'query': {
+                    'filtered': {
+                        'query': {'bool': query['condition']},
+                        'filter': {'bool': self._get_structures_selector(structures)}
+                    }
+                }
+            }
             aggregated_queries.append(query)
         return aggregated_queries
 
     def execute_query(self, query_model, patients_repository, ehr_repository,
-                      query_params=None, count_only=False, query_processes=1):
+                      query_params=None, count_only=False, query_processes=1, stream=False,
+                      count_by=None, query_threads=1):
         """
         Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and expressed
         as a :class:`pyehr.aql.model.QueryModel`. If the query is a parametric one, query parameters
@@ -1827,245 +2159,117 @@ class ElasticSearchDriver(DriverInterface):
         :type: :class:`pyehr.aql.parser.QueryModel`
         :param query_params: a dictionary containing query's parameters and their values
         :type: dictionary
+        :param stream: if True, return a :class:`StreamingResultSet` whose rows are fetched from
+                       the database while they are consumed, *query_processes* is ignored
+        :type stream: bool
+        :param count_by: used with *count_only*, group counted results by 'structure' or 'patient'
+                         and return a dictionary with the counters
+        :type count_by: str
+        :param query_threads: if greater than 1, queries are executed by a pool of threads sharing
+                              the connection of the driver, *query_processes* is ignored
+        :type query_threads: int
         :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
                  containing results for the given query
         """
-        queries = self.build_queries(query_model, patients_repository, ehr_repository,
-                                     query_params)
-        aggregated_queries = self._aggregate_queries(queries)
-        total_queries=[]
-        for query in aggregated_queries:
-            single_query={}
-            query_string=self._clean_piece(query['condition'])
-            query_string=self._final_check(query_string)
-            single_query.update({'condition':query_string})
-            single_query.update({'selection':query['selection']})
-            single_query.update({'aliases':query['aliases']})
-            total_queries.append(single_query)
+        total_queries = self._build_total_queries(query_model, patients_repository, ehr_repository,
+                                                  query_params)
         if count_only:
-            return self._count_only_queries(total_queries,ehr_repository)
+            return self._count_only_queries(total_queries,ehr_repository,count_by)
+        elif stream:
+            return self._stream_queries(total_queries,ehr_repository)
         else:
-            return self._regular_queries(total_queries,ehr_repository,query_processes)
+            return self._regular_queries(total_queries,ehr_repository,query_processes,query_threads)
+
+    def _build_total_queries(self, query_model, patients_repository, ehr_repository, query_params=None):
+        """
+        Build the aggregated queries for the given query model, the condition of each query
+        is the JSON body of the ES request
+
+        :param query_model:
+        :param patients_repository:
+        :param ehr_repository:
+        :param query_params:
+        :return: a list of dictionaries with condition, selection and aliases of each query
+        """
+        queries = self.build_queries(query_model, patients_repository, ehr_repository,
+                                     query_params)
+        return [{'condition': self._to_json(query['condition']),
+                 'selection': query['selection'],
+                 'aliases': query['aliases']}
+                for query in self._aggregate_queries(queries)]
+
+    def _stream_queries(self,total_queries,ehr_repository):
+        """
+        Build a streaming result set, queries will be executed when results are consumed
+
+        :param total_queries:
+        :param ehr_repository:
+        :return:
+        """
+        database = self.database
+        total_results = StreamingResultSet(lambda: self._get_query_driver(database, ehr_repository)
+                                           ._count_only_queries(total_queries, ehr_repository))
+        for query in total_queries:
+            for path, alias in query['aliases'].iteritems():
+                total_results.add_column_definition(ResultColumnDef(alias, path))
+            total_results.add_rows_source(partial(self._iter_aql_query_rows, database, query['condition'],
+                                                  query['selection'], query['aliases'], ehr_repository))
+        return total_results
 
-    def _regular_queries(self,total_queries,ehr_repository,query_processes):
+    def _regular_queries(self,total_queries,ehr_repository,query_processes,query_threads=1):
         """
-        Call the routines to perform a single processor or multiprocessor query
+        Call the routines to perform a single processor, multithread or multiprocessor query
 
         :param total_queries:
         :param ehr_repository:
         :param query_processes:
+        :param query_threads:
         :return:
         """
         total_results = ResultSet()
-        if query_processes == 1 or len(total_queries) == 1:
+        if query_threads > 1 and len(total_queries) > 1:
+            for r in self._map_queries_in_threads(total_queries, ehr_repository, query_threads):
+                total_results.extend(r)
+        elif query_processes == 1 or len(total_queries) == 1:
             for i in range(0,len(total_queries)):
                 results = self._run_aql_query(total_queries[i]['condition'], fields=total_queries[i]['selection'],
                                           aliases=total_queries[i]['aliases'], collection=ehr_repository)
                 total_results.extend(results)
         else:
-            queries_pool = Pool(query_processes)
-            results = queries_pool.imap_unordered( MultiprocessQueryRunner(self.host, self.database,
-                                                    ehr_repository, self.port, self.user,self.passwd),total_queries)
+            results = self._map_queries(MultiprocessQueryRunner(self.host, self.database,
+                                        ehr_repository, self.port, self.user,self.passwd),total_queries,
+                                        query_processes)
             for r in results:
-                total_results.extend(r)
+                total_results.extend_batch(r)
         return total_results
 
-    def _count_only_queries(self,total_queries,ehr_repository):
+    def _get_union_query(self,total_queries):
         """
-        Call the routine to perform a count query
+        Join queries in a single bool query matching records that match at least one of them
 
         :param total_queries:
-        :param ehr_repository:
-        :return:
-        """
-        count=0
-        for i in range(0,len(total_queries)):
-            cresult = self._run_aql_count(total_queries[i]['condition'], collection=ehr_repository)
-            count=count+cresult
-        return count
-#    @profile
-    def _final_check(self,qtot):
+        :return: the query string
         """
-        Final check on parentheses
+        if len(total_queries) == 1:
+            return total_queries[0]['condition']
+        should = [json.loads(q['condition'])['query'] for q in total_queries]
+        return json.dumps({'query': {'bool': {'should': should, 'minimum_should_match': 1}}})
 
-        :param qtot:
-        :return:
+    def _count_only_queries(self,total_queries,ehr_repository,count_by=None):
         """
-        ql=list(qtot)
-        ob=0
-        oq=0
-        for i in ql:
-            if i=="{":
-                ob=ob+1
-            elif i=="}":
-                ob=ob-1
-            elif i=="[":
-                oq=oq+1
-            elif i=="]":
-                oq=oq-1
-        if ob != 0:
-            if ob>0:
-                for i in range(ob):
-                    ql.append("}")
-            else:
-                for i in range(ob):
-                    ql.pop(len(ql) - 1 - ql[::-1].index("}"))
-        if oq !=0:
-            if oq>0:
-                for i in range(oq):
-                    ql.append("]")
-            else:
-                for i in range(oq):
-                    ql.pop(len(ql) - 1 - ql[::-1].index("]"))
-        qtot="".join(ql)
-        return qtot
+        Call the routine to perform a count query, all the queries are counted
+        with a single request so records matching more than one query are counted once
 
-    def _clean_piece(self,piece):
-        """
-        clean a piece of expression from artifacts used to build it
-
-        :param piece:
+        :param total_queries:
+        :param ehr_repository:
+        :param count_by: group counted records by 'structure' or 'patient'
         :return:
         """
-        def cleanp(p):
-            newp = str(p)
-            newpr=newp[::-1]
-            #clean p from nothing
-            posnothing=[]
-            poscolon=[]
-            posparleft=[]
-            posparright=[]
-            starts=0
-            ends = len(newp)
-            while starts < ends:
-                #find position of string nothing
-                positionn = newp.find("$%nothing%$",starts,ends)
-                if (positionn == -1):
-                    starts=ends
-                else:
-                    starts=positionn+1
-                    posnothing.append(positionn)
-                    #find position of left colon
-                    positionc=newpr.find(":",len(newpr)-positionn,len(newpr))
-                    if( positionc == -1):
-                        print "not found colon for a given nothing :D"
-                        print "bad piece to cleanup: %s" % newp
-                        raise QueryCreationException()
-                    else:
-                        positionc=len(newpr)-positionc-1
-                        poscolon.append(positionc)
-                    #find position of first right parenthesis
-                    position=newp.find("}",positionn+10,len(newp))
-                    position2=newp.find("]",positionn+10,len(newp))
-                    isbrace=True
-                    if( position==-1 and position2==-1):
-                        print "not found parenthesis for a given nothing :D"
-                        print "bad piece to cleanup: %s" % newp
-                        raise QueryCreationException()
-                    else:
-                        if(position2 != -1):
-                            if(position == -1):
-                                posparright.append(position2)
-                                isbrace=False
-                            if(position < position2):
-                                posparright.append(position)
-                            else:
-                                posparright.append(position2)
-                                isbrace=False
-                        else:
-                            posparright.append(position)
-                    #find position of corresponding left parenthesis
-                    br=0
-                    sq=0
-                    for g,h in enumerate(newpr[(len(newpr)-positionc):len(newpr)]):
-                        if h == "{":
-                            if isbrace and br==0:
-                                posparleft.append(positionc-g-1)
-                                break
-                            else:
-                                br=br-1
-                        elif h == "[":
-                            if not isbrace and sq==0:
-                                posparleft.append(positionc-g-1)
-                                break
-                            else:
-                                sq=sq-1
-                        elif h== "}":
-                            br=br+1
-                        elif h=="]":
-                            sq=sq+1
-            newpl = list(newp)
-            for i in posparleft:
-                newpl[i]=""
-                newpl[i+1]=""
-            for i in range(len(poscolon)):
-                for j in range(poscolon[i]-1,posparright[i]+1):
-                    newpl[j]=""
-            #clean p from extra braces
-            #clean p from extra squares
-            br=0
-            sq=0
-            istart=[]
-            iend=[]
-            cursor=-1
-            for i in range(len(newpl)-1):
-                if newpl[i]==newpl[i+1]:
-                    if(newpl[i]=="{"):
-                        br=2
-                        istart.append(i)
-                        cursor=len(istart)-1
-                    elif(newpl[i]=="}"):
-                        if(br==2):
-                            iend.append(i)
-                            cursor=-1
-                        else:
-                            br=0
-                            if(cursor>-1):
-                                istart.pop()
-                    elif(newpl[i]=="["):
-                        sq=1
-                        istart.append(i)
-                        cursor=len(istart)-1
-                    elif(newpl[i]=="]"):
-                        if(sq==1):
-                            iend.append(i)
-                            cursor=-1
-                        else:
-                            sq=0
-                            if(cursor>-1):
-                                istart.pop()
-                elif newpl[i]=="{":
-                    if (i-1) in istart:
-                        pass
-                    else:
-                        br=0
-                elif newpl[i]== "[":
-                    if (i-1) in istart:
-                        pass
-                    else:
-                        sq=0
-            for i in range(len(istart)):
-                newpl[istart[i]]=""
-                newpl[iend[i]]=""
-            #change all single quotation marks to double
-            for i in range(len(newpl)-1):
-                if newpl[i]=="\\" and newpl[i+1]=="'":
-                    newpl[i]=""
-                    newpl[i+1]='"'
-                elif newpl[i]=="\\" and newpl[i+1]=="\"":
-                    newpl[i]=""
-                elif newpl[i] == "'":
-                    newpl[i]='"'
-                elif newpl[i+1]=="'":
-                    newpl[i+1]='"'
-            newpn = "".join(newpl)
-            return newpn
-        newpiece="{"
-        for p in piece:
-            newpiece=newpiece+cleanp(p)+","
-        newpiece=newpiece.strip(",")+"}"
-        return newpiece
-
+        count_by_field = self._get_count_by_field(count_by) if count_by else None
+        if len(total_queries) == 0:
+            return dict() if count_by else 0
+        return self._run_aql_count(self._get_union_query(total_queries), collection=ehr_repository,
+                                   count_by_field=count_by_field)
     def get_selection_hash(self,selection):
         """
         get hash for selection
@@ -1,12 +1,70 @@
+import os
+from threading import RLock
+
 from pyehr.utils import get_logger
 from pyehr.ehr.services.dbmanager.errors import UnknownDriverError
 
 
+class ClientsPool(object):
+    """
+    Keeps the clients opened by the drivers so that they can be shared by all the drivers
+    created by the same process. Each driver defines the key of its clients, usually made by
+    driver, host, port, database and credentials. Clients can't be shared between processes,
+    the pool is emptied when it is used by a process different from the one that filled it
+    (i.e. after a fork).
+    """
+
+    def __init__(self):
+        self._clients = dict()
+        self._pid = os.getpid()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def get_client(self, key, client_factory):
+        """
+        Return the client mapped to *key*, if there is no such client a new one is created
+        calling *client_factory* and added to the pool
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = dict()
+                self._pid = os.getpid()
+            try:
+                return self._clients[key]
+            except KeyError:
+                client = client_factory()
+                self._clients[key] = client
+                return client
+
+    def discard_client(self, key):
+        """
+        Remove the client mapped to *key* from the pool, return True if the client was found
+        """
+        with self._lock:
+            return self._clients.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._clients = dict()
+
+
+# clients shared by the drivers created by a DriversFactory
+_CLIENTS_POOL = ClientsPool()
+
+
 class DriversFactory(object):
+    """
+    Create the drivers used to access the database. If *shared_clients* is True,
+    drivers borrow their clients from a pool shared by the whole process instead of
+    opening a new connection each time they are connected, disconnecting a driver
+    simply releases the client.
+    """
 
     def __init__(self, driver, host, database, repository=None,
                  port=None, user=None, passwd=None, index_service=None,
-                 logger=None):
+                 logger=None, driver_options=None, shared_clients=True):
         self.driver = driver
         self.host = host
         self.database = database
@@ -16,6 +74,9 @@ class DriversFactory(object):
         self.passwd = passwd
         self.index_service = index_service
         self.logger = logger or get_logger('drivers-factory')
+        # driver specific arguments, passed to the constructor of the driver
+        self.driver_options = driver_options or dict()
+        self.clients_pool = _CLIENTS_POOL if shared_clients else None
 
     def get_driver(self):
         if self.driver == 'mongodb':
@@ -24,17 +85,20 @@ class DriversFactory(object):
                 from mongo_pm2 import MongoDriverPM2
                 return MongoDriverPM2(self.host, self.database, self.repository,
                                self.port, self.user, self.passwd,
-                               self.index_service, self.logger)
+                               self.index_service, self.logger, clients_pool=self.clients_pool,
+                               **self.driver_options)
             else:
                 from mongo_pm3 import MongoDriverPM3
                 return MongoDriverPM3(self.host, self.database, self.repository,
                                self.port, self.user, self.passwd,
-                               self.index_service, self.logger)
+                               self.index_service, self.logger, clients_pool=self.clients_pool,
+                               **self.driver_options)
         elif self.driver == 'elasticsearch':
             from elastic_search import ElasticSearchDriver
             return ElasticSearchDriver([{"host":self.host,"port":self.port}],
                                        self.database, self.repository,
                                        user=self.user, passwd=self.passwd,
-                                       index_service=self.index_service, logger=self.logger)
+                                       index_service=self.index_service, logger=self.logger,
+                                       clients_pool=self.clients_pool, **self.driver_options)
         else:
             raise UnknownDriverError('Unknown driver: %s' % self.driver)
\ No newline at end of file
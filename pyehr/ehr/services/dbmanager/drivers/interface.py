@@ -1,9 +1,64 @@
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from copy import copy
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
 from pyehr.ehr.services.dbmanager.errors import *
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import MissingValue
 import re, json
 from hashlib import md5
 
 
+# drivers used by the worker processes of a pool, a driver is created and connected
+# when a worker receives its first query and then it is reused by the following ones
+_WORKER_DRIVERS = dict()
+
+
+def _close_worker_drivers():
+    while _WORKER_DRIVERS:
+        _, driver_instance = _WORKER_DRIVERS.popitem()
+        driver_instance.disconnect()
+
+
+def get_worker_driver(driver_class, host, database, collection, port, user, passwd, **kwargs):
+    """
+    Return a connected instance of *driver_class* cached by the current process, drivers
+    are built by the worker processes of a pool when they receive their first query and
+    they are disconnected when the worker exits
+    """
+    driver_key = (driver_class, str(host), database, collection, port, user, passwd,
+                  tuple(sorted(kwargs.iteritems())))
+    driver_instance = _WORKER_DRIVERS.get(driver_key)
+    if driver_instance is None:
+        if len(_WORKER_DRIVERS) == 0:
+            # processes of a pool run multiprocessing finalizers instead of atexit handlers
+            Finalize(None, _close_worker_drivers, exitpriority=10)
+        driver_instance = driver_class(host, database, collection, port, user, passwd, **kwargs)
+        driver_instance.connect()
+        _WORKER_DRIVERS[driver_key] = driver_instance
+    return driver_instance
+
+
+class ThreadQueryRunner(object):
+    """
+    Run AQL queries in a thread using a shallow copy of *driver*: all threads share the
+    client (and its connections pool) of the driver while each one of them can select
+    the collection it needs
+    """
+
+    def __init__(self, driver, collection):
+        self.driver = driver
+        self.collection = collection
+
+    def __call__(self, query_description):
+        driver_instance = copy(self.driver)
+        return driver_instance._run_aql_query(
+            query_description['condition'], query_description['selection'],
+            query_description['aliases'], self.collection
+        )
+
+
 class DriverInterface(object):
     """
     This abstract class acts as an interface for all the driver classes
@@ -11,6 +66,20 @@ class DriverInterface(object):
     """
     __metaclass__ = ABCMeta
 
+    # fields needed to decode a clinical record when its EHR data are not loaded
+    CLINICAL_RECORD_SUMMARY_FIELDS = ['_id', 'creation_time', 'last_update', 'active',
+                                      'ehr_structure_id', 'patient_id', 'ehr_data.archetype_class']
+
+    # driver attributes replaced while a bulk ingest is running, drivers created by a
+    # DriversFactory during a bulk ingest receive them as constructor arguments
+    BULK_INGEST_OPTIONS = dict()
+
+    # fields used to group the results of count queries
+    COUNT_BY_FIELDS = {
+        'structure': 'ehr_structure_id',
+        'patient': 'patient_id'
+    }
+
     def __enter__(self):
         self.connect()
         return self
@@ -64,7 +133,7 @@ class DriverInterface(object):
         pass
 
     @abstractmethod
-    def add_records(self, records, skip_existing_duplicated=False):
+    def add_records(self, records, skip_existing_duplicated=False, batch_size=None):
         """
         Add a list of records in the backed server
         """
@@ -92,6 +161,95 @@ class DriverInterface(object):
             raise DuplicatedKeyError('The following IDs have one or more duplicated in this batch: %s' %
                                      [k for k, v in duplicated_counter.iteritems() if v > 1])
 
+    def start_bulk_ingest(self, disable_refresh_interval=True, replicas=None):
+        """
+        Prepare the database for a bulk load of records. Drivers that don't need to
+        change the configuration of the database simply ignore this call.
+
+        :param disable_refresh_interval: if True, disable the periodic refresh of the
+          database until :meth:`stop_bulk_ingest` is called
+        :type disable_refresh_interval: bool
+        :param replicas: if not None, the number of replicas used during the load
+        :type replicas: int
+        :return: the state that must be passed to :meth:`stop_bulk_ingest` in order to
+          restore the original configuration
+        """
+        return None
+
+    def stop_bulk_ingest(self, ingest_state):
+        """
+        Restore the configuration changed by :meth:`start_bulk_ingest` and make all
+        loaded records available
+
+        :param ingest_state: the value returned by :meth:`start_bulk_ingest`
+        """
+        pass
+
+    @contextmanager
+    def bulk_ingest(self, disable_refresh_interval=True, replicas=None):
+        """
+        Context manager that runs a bulk load of records with the current driver, the
+        configuration of the database and of the driver is restored at exit
+
+        :param disable_refresh_interval: if True, disable the periodic refresh of the
+          database during the load
+        :type disable_refresh_interval: bool
+        :param replicas: if not None, the number of replicas used during the load
+        :type replicas: int
+        """
+        ingest_state = self.start_bulk_ingest(disable_refresh_interval, replicas)
+        saved_options = dict((k, getattr(self, k)) for k in self.BULK_INGEST_OPTIONS)
+        for k, v in self.BULK_INGEST_OPTIONS.iteritems():
+            setattr(self, k, v)
+        try:
+            yield self
+        finally:
+            for k, v in saved_options.iteritems():
+                setattr(self, k, v)
+            self.stop_bulk_ingest(ingest_state)
+
+    def _map_queries(self, queries_runner, queries, query_processes):
+        """
+        Run *queries* in parallel using *queries_runner* and yield the results, the pool
+        of processes assigned to the driver is used, if there is no such pool a new one
+        with *query_processes* workers is created and closed when all queries are done
+        """
+        if self.queries_pool is not None:
+            for r in self.queries_pool.imap_unordered(queries_runner, queries):
+                yield r
+        else:
+            queries_pool = Pool(query_processes)
+            try:
+                for r in queries_pool.imap_unordered(queries_runner, queries):
+                    yield r
+            finally:
+                queries_pool.close()
+                queries_pool.join()
+
+    def _map_queries_in_threads(self, queries, collection, query_threads):
+        """
+        Run *queries* using a pool of *query_threads* threads and yield the results,
+        threads share the connection of the current driver that is opened if needed
+        """
+        close_conn_after_done = not self.is_connected
+        self.connect()
+        queries_pool = ThreadPool(query_threads)
+        try:
+            for r in queries_pool.imap_unordered(ThreadQueryRunner(self, collection), queries):
+                yield r
+        finally:
+            queries_pool.close()
+            queries_pool.join()
+            if close_conn_after_done:
+                self.disconnect()
+
+    def _get_count_by_field(self, count_by):
+        try:
+            return self.COUNT_BY_FIELDS[count_by]
+        except KeyError:
+            raise ValueError('Unable to count results by %s, allowed values are %s' %
+                             (count_by, self.COUNT_BY_FIELDS.keys()))
+
     @abstractmethod
     def get_record_by_id(self, record_id):
         """
@@ -99,6 +257,14 @@ class DriverInterface(object):
         """
         pass
 
+    @abstractmethod
+    def get_records_by_ids(self, records_ids, fields=None):
+        """
+        Retrieve the records with the given IDs using as few requests as possible,
+        IDs that don't match a record are ignored
+        """
+        pass
+
     @abstractmethod
     def get_record_by_version(self, record_id, version):
         """
@@ -141,6 +307,13 @@ class DriverInterface(object):
         """
         pass
 
+    @abstractmethod
+    def count_records_by_field(self, selector, field):
+        """
+        Retrieve the number of records matching the given query grouped by the values of *field*
+        """
+        pass
+
     @abstractmethod
     def count_records_by_query(self, selector):
         """
@@ -311,6 +484,27 @@ class DriverInterface(object):
     def _split_results(self, query_results):
         pass
 
+    @abstractmethod
+    def _get_path_value(self, document, path_keys, index=0):
+        # same values produced by _split_results for the given path: only leaf values
+        # are returned and, if lists are traversed, the last value found wins
+        if isinstance(document, list):
+            value = MissingValue
+            for element in document:
+                element_value = self._get_path_value(element, path_keys, index)
+                if element_value is not MissingValue:
+                    value = element_value
+            return value
+        if not isinstance(document, dict):
+            return document if index == len(path_keys) else MissingValue
+        if index == len(path_keys) or path_keys[index] not in document:
+            return MissingValue
+        return self._get_path_value(document[path_keys[index]], path_keys, index + 1)
+
+    @abstractmethod
+    def _get_result_values(self, query_result, paths_keys):
+        return tuple(self._get_path_value(query_result, pk) for pk in paths_keys)
+
     @abstractmethod
     def _run_aql_query(self, query, fields, aliases, collection):
         pass
@@ -344,10 +538,18 @@ class DriverInterface(object):
                     # set and empty dictionary as 'condition', it will be filled later with rules to match
                     # ClinicalRecord structure ID
                     apat_query['condition'] = dict()
-                apat_query['condition'].update(location_query)
+                apat_query['condition'] = self._merge_location_expression(apat_query['condition'],
+                                                                          location_query)
                 queries.setdefault(structure_id, list()).append(apat_query)
         return queries
 
+    def _merge_location_expression(self, condition_query, location_query):
+        """
+        Add the expression calculated for the location of a query to its condition
+        """
+        condition_query.update(location_query)
+        return condition_query
+
     @abstractmethod
     def _get_query_hash(self, query):
         query_hash = md5()
@@ -379,7 +581,7 @@ class DriverInterface(object):
 
     @abstractmethod
     def execute_query(self, query_model, patients_repository, ehr_repository, query_params,
-                      count_only, query_processes):
+                      count_only, query_processes, stream, count_by, query_threads):
         """
         Execute a query expressed as a :class:pyehr.aql.model.QueryModel` object
         """
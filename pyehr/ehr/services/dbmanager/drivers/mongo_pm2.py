@@ -1,14 +1,14 @@
 from pyehr.aql.parser import *
-from pyehr.ehr.services.dbmanager.drivers.interface import DriverInterface
+from pyehr.ehr.services.dbmanager.drivers.interface import DriverInterface, get_worker_driver
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
-    ResultColumnDef, ResultRow
+    ResultColumnDef, ResultRow, StreamingResultSet, MissingValue
 from pyehr.ehr.services.dbmanager.errors import *
 from pyehr.utils import *
 import pymongo
 import pymongo.errors
 import time
 from hashlib import md5
-from multiprocessing import Pool
+from functools import partial
 
 try:
     import simplejson as json
@@ -19,24 +19,27 @@ except ImportError:
 class MultiprocessQueryRunnerPM2(object):
 
     def __init__(self, host, database, collection,
-                 port, user, passwd):
+                 port, user, passwd, query_mode='find'):
         self.host = host
         self.database = database
         self.collection_name = collection
         self.port = port
         self.user = user
         self.passwd = passwd
+        self.query_mode = query_mode
+
+    def _get_driver(self):
+        return get_worker_driver(MongoDriverPM2, self.host, self.database, self.collection_name,
+                                 self.port, self.user, self.passwd, query_mode=self.query_mode)
 
     def __call__(self, query_description):
-        driver_instance = MongoDriverPM2(
-            self.host, self.database, self.collection_name,
-            self.port, self.user, self.passwd
-        )
+        driver_instance = self._get_driver()
         results = driver_instance._run_aql_query(
             query_description['condition'], query_description['selection'],
             query_description['aliases'], self.collection_name
         )
-        return results
+        # a compact batch is cheaper to send back to the parent process than a ResultSet
+        return results.to_batch()
 
 
 class MongoDriverPM2(DriverInterface):
@@ -45,14 +48,28 @@ class MongoDriverPM2(DriverInterface):
     and *password* the driver will contact MongoDB when a connection is needed and will interrogate a specific
     *collection* stored in one *database* within the server. If no *logger* object is passed to constructor, a
     new one is created.
+
+    AQL queries can be executed in two modes, selected using *query_mode*: 'find' (the
+    default) fetches matching documents and extracts selected fields, 'aggregate' uses an
+    aggregation pipeline and lets the server project selected fields.
+    If a *queries_pool* is given, it will be used to run multi-process queries instead of
+    creating a new pool of processes for each query.
+    If a *clients_pool* is given, the driver borrows its client from the pool and
+    :meth:`disconnect` releases the client without closing it.
     """
 
     # This map is used to encode\decode data when writing\reading to\from MongoDB
     ENCODINGS_MAP = {'.': '-'}
+    CLINICAL_RECORD_SUMMARY_FIELDS = DriverInterface.CLINICAL_RECORD_SUMMARY_FIELDS + ['_version']
+    # error codes used by MongoDB for duplicated keys
+    DUPLICATED_KEY_ERROR_CODES = (11000, 11001, 12582)
+    INSERT_BATCH_SIZE = 1000
+    QUERY_MODES = ('find', 'aggregate')
 
     def __init__(self, host, database, collection,
                  port=None, user=None, passwd=None,
-                 index_service=None, logger=None):
+                 index_service=None, logger=None, query_mode='find', queries_pool=None,
+                 clients_pool=None):
         self.client = None
         self.database = None
         self.collection = None
@@ -64,6 +81,30 @@ class MongoDriverPM2(DriverInterface):
         self.passwd = passwd
         self.index_service = index_service
         self.logger = logger or get_logger('mongo-db-driver')
+        if query_mode not in self.QUERY_MODES:
+            raise ValueError('Unknown query mode %s' % query_mode)
+        self.query_mode = query_mode
+        self.queries_pool = queries_pool
+        self.clients_pool = clients_pool
+
+    def _get_client_key(self):
+        # credentials are bound to a database, clients can be shared only by drivers
+        # using the same database
+        return self.__class__, self.host, self.port, self.database_name, self.user, self.passwd
+
+    def _new_client(self):
+        try:
+            client = pymongo.MongoClient(self.host, self.port)
+        except pymongo.errors.ConnectionFailure:
+            raise DBManagerNotConnectedError('Unable to connect to MongoDB at %s:%s' %
+                                             (self.host, self.port))
+        if self.user:
+            self.logger.debug('authenticating with username %s', self.user)
+            client[self.database_name].authenticate(self.user, self.passwd)
+        return client
+
+    def _close_client(self):
+        self.client.disconnect()
 
     def connect(self):
         """
@@ -71,16 +112,12 @@ class MongoDriverPM2(DriverInterface):
         """
         if not self.client:
             self.logger.debug('connecting to host %s', self.host)
-            try:
-                self.client = pymongo.MongoClient(self.host, self.port)
-            except pymongo.errors.ConnectionFailure:
-                raise DBManagerNotConnectedError('Unable to connect to MongoDB at %s:%s' %
-                                                 (self.host, self.port))
+            if self.clients_pool is not None:
+                self.client = self.clients_pool.get_client(self._get_client_key(), self._new_client)
+            else:
+                self.client = self._new_client()
             self.logger.debug('binding to database %s', self.database_name)
             self.database = self.client[self.database_name]
-            if self.user:
-                self.logger.debug('authenticating with username %s', self.user)
-                self.database.authenticate(self.user, self.passwd)
             self.logger.debug('using collection %s', self.collection_name)
             self.collection = self.database[self.collection_name]
         else:
@@ -89,10 +126,14 @@ class MongoDriverPM2(DriverInterface):
 
     def disconnect(self):
         """
-        Close a connection to a MongoDB server.
+        Close a connection to a MongoDB server, if the client was borrowed from a
+        pool it is released and the connection stays open.
         """
-        self.logger.debug('disconnecting from host %s', self.client.host)
-        self.client.disconnect()
+        if self.clients_pool is None:
+            self.logger.debug('disconnecting from host %s', self.client.host)
+            self._close_client()
+        else:
+            self.logger.debug('releasing client for host %s', self.host)
         self.database = None
         self.collection = None
         self.client = None
@@ -325,32 +366,65 @@ class MongoDriverPM2(DriverInterface):
         except pymongo.errors.DuplicateKeyError:
             raise DuplicatedKeyError('A record with ID %s already exists' % record['_id'])
 
-    def add_records(self, records, skip_existing_duplicated=False):
+    def _insert_records_batch(self, records_batch):
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for r in records_batch:
+            bulk.insert(r)
+        bulk.execute()
+
+    def _rollback_insert(self, records_ids):
+        if len(records_ids) > 0:
+            self.logger.debug('Deleting %d records saved before the error', len(records_ids))
+            self.delete_records_by_query({'_id': {'$in': records_ids}})
+
+    def add_records(self, records, skip_existing_duplicated=False, batch_size=None):
         """
         Save a list of records within MongoDB and return records' IDs. If skip_existing_duplicated is
         True, ignore duplicated key errors and continue with the save process, if it is False a
         DuplicatedKeyError will be raised and no record will be saved.
+        Records are saved using unordered bulk inserts of *batch_size* records, no query is made
+        to look for IDs already in use: duplicated keys are detected using the errors reported
+        by the server. If records must not be skipped, the records saved before the error was
+        detected are deleted before raising the DuplicatedKeyError, so other clients may see
+        them for a short time.
 
         :param records: the list of records that is going to be saved
         :type records: list
         :param skip_existing_duplicated: ignore duplicated key errors and save records with a unique ID
         :type skip_existing_duplicated: bool
+        :param batch_size: the number of records saved with a single bulk insert, if None
+                           INSERT_BATCH_SIZE will be used
+        :type batch_size: int
         :return: a list of records' IDs and a list of records that caused a duplicated key error
         """
+        if not len(records):
+            return [], []
         # check for duplicated ID in records' batch
         self._check_batch(records, '_id')
         self._check_connection()
-        records_map = {r['_id']: r for r in records}
-        duplicated_ids = [x['_id'] for x in self.get_records_by_query({'_id': {'$in': records_map.keys()}},
-                                                                      {'_id': True})]
-        if len(duplicated_ids) > 0 and not skip_existing_duplicated:
-            raise DuplicatedKeyError('The following IDs are already in use: %s' % duplicated_ids)
-        try:
-            return self.collection.insert([x for k, x in records_map.iteritems() if k not in duplicated_ids]),\
-                [records_map[x] for x in duplicated_ids]
-        except pymongo.errors.InvalidOperation:
-            # empty bulk insert
-            return [], [records_map[x] for x in duplicated_ids]
+        batch_size = batch_size or self.INSERT_BATCH_SIZE
+        saved_ids = list()
+        duplicated = list()
+        for i in xrange(0, len(records), batch_size):
+            records_batch = records[i:i+batch_size]
+            try:
+                self._insert_records_batch(records_batch)
+                write_errors = []
+            except pymongo.errors.BulkWriteError, bwe:
+                write_errors = bwe.details['writeErrors']
+                failed_indexes = set(e['index'] for e in write_errors)
+                saved_ids.extend(r['_id'] for j, r in enumerate(records_batch) if j not in failed_indexes)
+                if any(e['code'] not in self.DUPLICATED_KEY_ERROR_CODES for e in write_errors):
+                    self._rollback_insert(saved_ids)
+                    raise bwe
+                duplicated.extend(records_batch[e['index']] for e in write_errors)
+                if not skip_existing_duplicated:
+                    self._rollback_insert(saved_ids)
+                    raise DuplicatedKeyError('The following IDs are already in use: %s' %
+                                             [r['_id'] for r in duplicated])
+            if len(write_errors) == 0:
+                saved_ids.extend(r['_id'] for r in records_batch)
+        return saved_ids, duplicated
 
     def get_record_by_id(self, record_id):
         """
@@ -367,6 +441,28 @@ class MongoDriverPM2(DriverInterface):
         else:
             return res
 
+    def get_records_by_ids(self, records_ids, fields=None, batch_size=1000):
+        """
+        Retrieve the records with the given IDs, records are fetched using one query
+        for each batch of *batch_size* IDs
+
+        :param records_ids: the IDs of the records
+        :type records_ids: list
+        :param fields: a list of field names that should be returned or a dict specifying the
+                       fields to include or exclude, if None the whole records are returned
+        :type fields: list or dictionary
+        :param batch_size: the maximum number of IDs used for a single query
+        :type batch_size: int
+        :return: the records matching the given IDs, IDs without a record are ignored
+        :rtype: list
+        """
+        self._check_connection()
+        records = list()
+        for i in xrange(0, len(records_ids), batch_size):
+            records.extend(self.get_records_by_query({'_id': {'$in': records_ids[i:i+batch_size]}},
+                                                     fields))
+        return records
+
     def get_record_by_version(self, record_id, version):
         """
         Retrieve a record using its ID and version number
@@ -429,6 +525,18 @@ class MongoDriverPM2(DriverInterface):
         self._check_connection()
         return (decode_dict(rec) for rec in self.collection.find(selector, fields, limit=limit))
 
+    def aggregate_records(self, pipeline):
+        """
+        Run an aggregation pipeline on the current collection
+
+        :param pipeline: the stages of the pipeline (in MongoDB syntax)
+        :type pipeline: list
+        :return: the documents produced by the pipeline
+        :rtype: list
+        """
+        self._check_connection()
+        return (decode_dict(rec) for rec in self.collection.aggregate(pipeline, cursor={}))
+
     def get_values_by_record_id(self, record_id, values_list):
         """
         Retrieve values in *values_list* from record with ID *record_id*
@@ -458,6 +566,23 @@ class MongoDriverPM2(DriverInterface):
         res = self.collection.find(selector)
         return res.count()
 
+    def count_records_by_field(self, selector, field):
+        """
+        Retrieve the number of records matching the given query grouped by the values of
+        *field*, counters are calculated by the server using a single aggregation
+
+        :param selector: the selector (in MongoDB syntax) used to select data
+        :param field: the field used to group the records
+        :type field: str
+        :return: a dictionary that maps the values of *field* to the number of matching records
+        :rtype: dict
+        """
+        pipeline = [
+            {'$match': selector},
+            {'$group': {'_id': '$%s' % field, 'count': {'$sum': 1}}}
+        ]
+        return dict((r['_id'], r['count']) for r in self.aggregate_records(pipeline))
+
     def delete_record(self, record_id):
         """
         Delete an existing record
@@ -861,6 +986,12 @@ class MongoDriverPM2(DriverInterface):
                                                                    var.variable.path.value)
         return query, results_aliases
 
+    def _get_path_value(self, document, path_keys, index=0):
+        return super(MongoDriverPM2, self)._get_path_value(document, path_keys, index)
+
+    def _get_result_values(self, query_result, paths_keys):
+        return super(MongoDriverPM2, self)._get_result_values(query_result, paths_keys)
+
     def _split_results(self, query_result):
         for key, value in query_result.iteritems():
             if isinstance(value, dict):
@@ -873,6 +1004,37 @@ class MongoDriverPM2(DriverInterface):
             else:
                 yield key, value
 
+    def _get_aggregation_pipeline(self, query, paths):
+        # selected fields are projected using the position of the column as key
+        projection = {'_id': False}
+        for i, path in enumerate(paths):
+            projection['c%d' % i] = '$%s' % path
+        return [{'$match': query}, {'$project': projection}]
+
+    def _get_projected_value(self, value):
+        # fields that cross an array are projected as (nested) arrays, keep the same
+        # value returned by _get_path_value
+        if isinstance(value, list):
+            for element in reversed(value):
+                element_value = self._get_projected_value(element)
+                if element_value is not MissingValue:
+                    return element_value
+            return MissingValue
+        if isinstance(value, dict):
+            return MissingValue
+        return value
+
+    def _get_results_values(self, query, fields, paths):
+        if self.query_mode == 'aggregate':
+            query_results = self.aggregate_records(self._get_aggregation_pipeline(query, paths))
+            columns = ['c%d' % i for i in xrange(len(paths))]
+            return (tuple(self._get_projected_value(q.get(c, MissingValue)) for c in columns)
+                    for q in query_results)
+        else:
+            query_results = self.get_records_by_query(query, fields)
+            paths_keys = [p.split('.') for p in paths]
+            return (self._get_result_values(q, paths_keys) for q in query_results)
+
     def _run_aql_query(self, query, fields, aliases, collection):
         self.logger.debug("Running query\n%s\nwith filters\n%s", query, fields)
         rs = ResultSet()
@@ -886,20 +1048,30 @@ class MongoDriverPM2(DriverInterface):
             close_conn_after_done = True
         self.connect()
         self.select_collection(collection)
-        query_results = self.get_records_by_query(query, fields)
+        paths = tuple(c.path for c in rs.columns)
+        results_values = self._get_results_values(query, fields, paths)
 
+        rs.add_rows(paths, results_values)
         if close_conn_after_done:
             self.disconnect()
         else:
             self.select_collection(original_collection)
-        for q in query_results:
-            record = dict()
-            for x in self._split_results(q):
-                record[x[0]] = x[1]
-            rr = ResultRow(record)
-            rs.add_row(rr)
         return rs
 
+    def _iter_aql_query_rows(self, query, fields, aliases, collection):
+        # use a dedicated driver, the cursor must stay open while rows are consumed
+        # and this may happen after the current driver has been disconnected
+        driver = self.__class__(self.host, self.database_name, collection,
+                                self.port, self.user, self.passwd, logger=self.logger,
+                                query_mode=self.query_mode, clients_pool=self.clients_pool)
+        paths = tuple(ResultColumnDef(alias, path).path for path, alias in aliases.iteritems())
+        driver.connect()
+        try:
+            for values in driver._get_results_values(query, fields, paths):
+                yield ResultRow.from_values(paths, values)
+        finally:
+            driver.disconnect()
+
     def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None):
         return super(MongoDriverPM2, self).build_queries(query_model, patients_repository, ehr_repository,
                                                       query_params)
@@ -956,27 +1128,44 @@ class MongoDriverPM2(DriverInterface):
             })
         return aggregated_queries
 
-    def _find_by_aql_queries(self, queries, ehr_repository, query_processes):
+    def _find_by_aql_queries(self, queries, ehr_repository, query_processes, query_threads=1):
         if len(queries) > 1:
             queries = self._aggregate_queries_by_selection(queries)
         total_results = ResultSet()
-        if query_processes == 1 or len(queries) == 1:
+        if query_threads > 1 and len(queries) > 1:
+            for r in self._map_queries_in_threads(queries, ehr_repository, query_threads):
+                total_results.extend(r)
+        elif query_processes == 1 or len(queries) == 1:
             for query in queries:
                 results = self._run_aql_query(query=query['condition'], fields=query['selection'],
                                               aliases=query['aliases'], collection=ehr_repository)
                 total_results.extend(results)
         else:
-            queries_pool = Pool(query_processes)
-            results = queries_pool.imap_unordered(
+            results = self._map_queries(
                 MultiprocessQueryRunnerPM2(self.host, self.database_name,
-                                        ehr_repository, self.port, self.user, self.passwd),
-                queries
+                                        ehr_repository, self.port, self.user, self.passwd,
+                                        self.query_mode),
+                queries, query_processes
             )
             for r in results:
-                total_results.extend(r)
+                total_results.extend_batch(r)
         return total_results
 
-    def _count_by_aql_queries(self, queries, ehr_repository):
+    def _stream_by_aql_queries(self, queries, ehr_repository):
+        if len(queries) > 1:
+            queries = self._aggregate_queries_by_selection(queries)
+        conditions = [q['condition'] for q in queries]
+        total_results = StreamingResultSet(partial(self._count_by_aql_queries, conditions, ehr_repository))
+        for query in queries:
+            for path, alias in query['aliases'].iteritems():
+                total_results.add_column_definition(ResultColumnDef(alias, path))
+            total_results.add_rows_source(partial(self._iter_aql_query_rows, query['condition'],
+                                                  query['selection'], query['aliases'], ehr_repository))
+        return total_results
+
+    def _count_by_aql_queries(self, queries, ehr_repository, count_by=None):
+        if len(queries) == 0:
+            return dict() if count_by else 0
         if self.is_connected:
             original_collection = self.collection_name
             close_conn_after_done = False
@@ -985,9 +1174,13 @@ class MongoDriverPM2(DriverInterface):
         self.connect()
         self.select_collection(ehr_repository)
         if len(queries) == 1:
-            results_counter = self.count_records_by_query(queries[0])
+            selector = queries[0]
+        else:
+            selector = {'$or': queries}
+        if count_by:
+            results_counter = self.count_records_by_field(selector, self._get_count_by_field(count_by))
         else:
-            results_counter = self.count_records_by_query({'$or': queries})
+            results_counter = self.count_records_by_query(selector)
         if close_conn_after_done:
             self.disconnect()
         else:
@@ -995,7 +1188,8 @@ class MongoDriverPM2(DriverInterface):
         return results_counter
 
     def execute_query(self, query_model, patients_repository, ehr_repository,
-                      query_params=None, count_only=False, query_processes=1):
+                      query_params=None, count_only=False, query_processes=1, stream=False,
+                      count_by=None, query_threads=1):
         """
         Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and expressed
         as a :class:`pyehr.aql.model.QueryModel`. If the query is a parametric one, query parameters
@@ -1006,6 +1200,15 @@ class MongoDriverPM2(DriverInterface):
         :type: :class:`pyehr.aql.parser.QueryModel`
         :param query_params: a dictionary containing query's parameters and their values
         :type: dictionary
+        :param stream: if True, return a :class:`StreamingResultSet` whose rows are fetched from
+                       the database while they are consumed, *query_processes* is ignored
+        :type stream: bool
+        :param count_by: used with *count_only*, group counted results by 'structure' or 'patient'
+                         and return a dictionary with the counters
+        :type count_by: str
+        :param query_threads: if greater than 1, queries are executed by a pool of threads sharing
+                              the connection of the driver, *query_processes* is ignored
+        :type query_threads: int
         :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
                  containing results for the given query
         """
@@ -1013,7 +1216,10 @@ class MongoDriverPM2(DriverInterface):
                                      query_params)
         aggregated_queries = self._aggregate_queries(queries)
         if not count_only:
-            return self._find_by_aql_queries(aggregated_queries, ehr_repository, query_processes)
+            if stream:
+                return self._stream_by_aql_queries(aggregated_queries, ehr_repository)
+            return self._find_by_aql_queries(aggregated_queries, ehr_repository, query_processes,
+                                             query_threads)
         else:
             return self._count_by_aql_queries([aq['condition'] for aq in aggregated_queries],
-                                              ehr_repository)
+                                              ehr_repository, count_by)
@@ -1,12 +1,13 @@
 from mongo_pm2 import MongoDriverPM2
+from pyehr.ehr.services.dbmanager.drivers.interface import get_worker_driver
 import pymongo
 import pymongo.errors
 import time
-from multiprocessing import Pool
 
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
     ResultColumnDef, ResultRow
 from pyehr.ehr.services.dbmanager.errors import *
+from pyehr.utils import decode_dict
 
 try:
     import simplejson as json
@@ -17,24 +18,27 @@ except ImportError:
 class MultiprocessQueryRunnerPM3(object):
 
     def __init__(self, host, database, collection,
-                 port, user, passwd):
+                 port, user, passwd, query_mode='find'):
         self.host = host
         self.database = database
         self.collection_name = collection
         self.port = port
         self.user = user
         self.passwd = passwd
+        self.query_mode = query_mode
+
+    def _get_driver(self):
+        return get_worker_driver(MongoDriverPM3, self.host, self.database, self.collection_name,
+                                 self.port, self.user, self.passwd, query_mode=self.query_mode)
 
     def __call__(self, query_description):
-        driver_instance = MongoDriverPM3(
-            self.host, self.database, self.collection_name,
-            self.port, self.user, self.passwd
-        )
+        driver_instance = self._get_driver()
         results = driver_instance._run_aql_query(
             query_description['condition'], query_description['selection'],
             query_description['aliases'], self.collection_name
         )
-        return results
+        # a compact batch is cheaper to send back to the parent process than a ResultSet
+        return results.to_batch()
 
 class MongoDriverPM3(MongoDriverPM2):
     """
@@ -43,33 +47,15 @@ class MongoDriverPM3(MongoDriverPM2):
     *collection* stored in one *database* within the server. If no *logger* object is passed to constructor, a
     new one is created.
     """
-    def connect(self):
-        """
-        Open a connection to a MongoDB server.
-        """
-        if not self.client:
-            self.logger.debug('connecting to host %s', self.host)
-            self.client = pymongo.MongoClient(self.host, self.port)
-            self.logger.debug('binding to database %s', self.database_name)
-            self.database = self.client[self.database_name]
-            if self.user:
-                self.logger.debug('authenticating with username %s', self.user)
-                self.database.authenticate(self.user, self.passwd)
-            self.logger.debug('using collection %s', self.collection_name)
-            self.collection = self.database[self.collection_name]
-        else:
-            self.logger.debug('Already connected to database %s, using collection %s',
-                              self.database_name, self.collection_name)
-
-    def disconnect(self):
-        """
-        Close a connection to a MongoDB server.
-        """
-        self.logger.debug('disconnecting from host %s', self.client.host)
+    def _new_client(self):
+        client = pymongo.MongoClient(self.host, self.port)
+        if self.user:
+            self.logger.debug('authenticating with username %s', self.user)
+            client[self.database_name].authenticate(self.user, self.passwd)
+        return client
+
+    def _close_client(self):
         self.client.close()
-        self.database = None
-        self.collection = None
-        self.client = None
 
     def add_record(self, record):
         """
@@ -85,36 +71,8 @@ class MongoDriverPM3(MongoDriverPM2):
         except pymongo.errors.DuplicateKeyError:
             raise DuplicatedKeyError('A record with ID %s already exists' % record['_id'])
 
-    def add_records(self, records, skip_existing_duplicated=False):
-        """
-        Save a list of records within MongoDB and return records' IDs. If skip_existing_duplicated is
-        True, ignore duplicated key errors and continue with the save process, if it is False a
-        DuplicatedKeyError will be raised and no record will be saved.
-
-        :param records: the list of records that is going to be saved
-        :type records: list
-        :param skip_existing_duplicated: ignore duplicated key errors and save records with a unique ID
-        :type skip_existing_duplicated: bool
-        :return: a list of records' IDs and a list of records that caused a duplicated key error
-        """
-        # check for duplicated ID in records' batch
-        if not len(records):
-            return [],[]
-        self._check_batch(records, '_id')
-        self._check_connection()
-        records_map = {r['_id']: r for r in records}
-        duplicated_ids = [x['_id'] for x in self.get_records_by_query({'_id': {'$in': records_map.keys()}},
-                                                                      {'_id': True})]
-        if len(duplicated_ids) > 0 and not skip_existing_duplicated:
-            raise DuplicatedKeyError('The following IDs are already in use: %s' % duplicated_ids)
-        try:
-            return self.collection.insert_many([x for k, x in records_map.iteritems()
-                                                if k not in duplicated_ids]).inserted_ids,\
-                [records_map[x] for x in duplicated_ids]
-        except pymongo.errors.InvalidOperation:
-            # empty bulk insert
-            return [], [records_map[x] for x in duplicated_ids]
-
+    def _insert_records_batch(self, records_batch):
+        self.collection.insert_many(records_batch, ordered=False)
 
     def _update_record(self, record_id, update_condition):
         """
@@ -180,24 +138,27 @@ class MongoDriverPM3(MongoDriverPM2):
         self.collection.replace_one({"_id" : record_id}, new_record)
         return last_update
 
-    def _find_by_aql_queries(self, queries, ehr_repository, query_processes):
+    def _find_by_aql_queries(self, queries, ehr_repository, query_processes, query_threads=1):
         if len(queries) > 1:
             queries = self._aggregate_queries_by_selection(queries)
         total_results = ResultSet()
-        if query_processes == 1 or len(queries) == 1:
+        if query_threads > 1 and len(queries) > 1:
+            for r in self._map_queries_in_threads(queries, ehr_repository, query_threads):
+                total_results.extend(r)
+        elif query_processes == 1 or len(queries) == 1:
             for query in queries:
                 results = self._run_aql_query(query=query['condition'], fields=query['selection'],
                                               aliases=query['aliases'], collection=ehr_repository)
                 total_results.extend(results)
         else:
-            queries_pool = Pool(query_processes)
-            results = queries_pool.imap_unordered(
+            results = self._map_queries(
                 MultiprocessQueryRunnerPM3(self.host, self.database_name,
-                                        ehr_repository, self.port, self.user, self.passwd),
-                queries
+                                        ehr_repository, self.port, self.user, self.passwd,
+                                        self.query_mode),
+                queries, query_processes
             )
             for r in results:
-                total_results.extend(r)
+                total_results.extend_batch(r)
         return total_results
 
     def count_records_by_query(self, selector):
@@ -209,4 +170,16 @@ class MongoDriverPM3(MongoDriverPM2):
         :rtype: int
         """
         self._check_connection()
-        return self.collection.count(selector)
\ No newline at end of file
+        return self.collection.count(selector)
+
+    def aggregate_records(self, pipeline):
+        """
+        Run an aggregation pipeline on the current collection
+
+        :param pipeline: the stages of the pipeline (in MongoDB syntax)
+        :type pipeline: list
+        :return: the documents produced by the pipeline
+        :rtype: list
+        """
+        self._check_connection()
+        return (decode_dict(rec) for rec in self.collection.aggregate(pipeline))
@@ -26,6 +26,10 @@ class IndexServiceConnectionError(Exception):
     pass
 
 
+class UnknownIndexEngineError(Exception):
+    pass
+
+
 class ConfigurationError(Exception):
     pass
 
@@ -1,18 +1,34 @@
+import atexit
+from threading import Lock
+from multiprocessing import Pool
+
 from pyehr.ehr.services.dbmanager.drivers.factory import DriversFactory
 from pyehr.utils import get_logger
-from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+from pyehr.utils.cache import LRUCache
+from pyehr.ehr.services.dbmanager.dbservices.index_service import get_index_service
 from pyehr.aql.parser import Parser
 
 
 class QueryManager(object):
     """
     TODO: add documentation here
+
+    *driver_options* is a dictionary with driver specific arguments that will be passed
+    to the drivers used to run the queries, as an example {'query_mode': 'aggregate'}
+    enables aggregation pipelines for MongoDB queries.
+
+    If *persistent_pool* is True, multi-process queries are executed using pools of
+    processes owned by the :class:`QueryManager`, one for each number of processes
+    requested; a pool is created by the first query that needs it and reused by the
+    following ones, workers keep their database connections open between queries.
+    Call :meth:`shutdown` to terminate the workers.
     """
 
     def __init__(self, driver, host, database, versioning_database=None,
                  patients_repository=None, ehr_repository=None,
                  ehr_versioning_repository=None, port=None, user=None,
-                 passwd=None, logger=None):
+                 passwd=None, logger=None, query_cache_size=200, driver_options=None,
+                 persistent_pool=True):
         self.driver = driver
         self.host = host
         self.database = database
@@ -25,8 +41,23 @@ class QueryManager(object):
         self.passwd = passwd
         self.index_service = None
         self.logger = logger or get_logger('query_manager')
+        # maps AQL queries to the QueryModel objects produced by the Parser
+        self.query_cache = LRUCache(query_cache_size)
+        self.driver_options = driver_options
+        self.persistent_pool = persistent_pool
+        # maps the number of processes to the pool, pools are shared by concurrent queries
+        self._queries_pools = dict()
+        self._queries_pools_lock = Lock()
+        self._shutdown_registered = False
+
+    @property
+    def query_cache_stats(self):
+        """
+        Return size, hits and misses of the parsed queries cache
+        """
+        return self.query_cache.get_stats()
 
-    def _get_drivers_factory(self, repository):
+    def _get_drivers_factory(self, repository, driver_options=None):
         return DriversFactory(
             driver=self.driver,
             host=self.host,
@@ -36,10 +67,38 @@ class QueryManager(object):
             user=self.user,
             passwd=self.passwd,
             index_service=self.index_service,
-            logger=self.logger
+            logger=self.logger,
+            driver_options=driver_options or self.driver_options
         )
 
-    def set_index_service(self, url, database, user, passwd):
+    def _get_queries_pool(self, query_processes):
+        # pools are never replaced, a pool may be in use by a query running in another thread
+        with self._queries_pools_lock:
+            queries_pool = self._queries_pools.get(query_processes)
+            if queries_pool is None:
+                self.logger.debug('Starting a pool of %d processes', query_processes)
+                queries_pool = Pool(query_processes)
+                self._queries_pools[query_processes] = queries_pool
+                if not self._shutdown_registered:
+                    atexit.register(self.shutdown)
+                    self._shutdown_registered = True
+            return queries_pool
+
+    def shutdown(self):
+        """
+        Terminate the pools of processes used to run multi-process queries, if any. Workers
+        complete the queries already submitted and disconnect the drivers they cached before
+        exiting. New pools will be created if a multi-process query is executed after the shutdown.
+        """
+        with self._queries_pools_lock:
+            queries_pools, self._queries_pools = self._queries_pools, dict()
+        for queries_pool in queries_pools.itervalues():
+            queries_pool.close()
+            queries_pool.join()
+
+    def set_index_service(self, url, database, user, passwd, persistent_session=False,
+                          engine='basex', cache_size=1000, contains_cache_size=500,
+                          generation_check_interval=5):
         """
         Add a :class:`IndexService` to the current :class:`QueryManager` that will be used
         to index clinical records
@@ -51,10 +110,39 @@ class QueryManager(object):
         :type user: str
         :param passwd: the password to access the :class:`IndexService`
         :type passwd: str
+        :param persistent_session: if True, the :class:`IndexService` will keep its session
+          open and reuse it for all the requests
+        :type persistent_session: bool
+        :param engine: the index engine, 'basex' (default) or 'local'; when using the 'local'
+          engine *url* is the directory where the index file will be stored
+        :type engine: str
+        :param cache_size: the number of structure IDs cached by the :class:`IndexService`,
+          0 disables the cache
+        :type cache_size: int
+        :param contains_cache_size: the number of CONTAINS statements whose results are cached
+          by the :class:`IndexService`, 0 disables the cache
+        :type contains_cache_size: int
+        :param generation_check_interval: the number of seconds after which the caches of the
+          :class:`IndexService` are checked against changes made by other processes
+        :type generation_check_interval: int
         """
-        self.index_service = IndexService(database, url, user, passwd, self.logger)
+        self.index_service = get_index_service(engine, url, database, user, passwd, self.logger,
+                                               persistent_session, cache_size, contains_cache_size,
+                                               generation_check_interval)
+
+    def _get_query_model(self, query):
+        # query parameters are bound by the driver when queries are built, so the same
+        # QueryModel can be shared by all the executions of a parametric query.
+        # Cached QueryModel objects must be considered as read-only.
+        query_model = self.query_cache.get(query)
+        if query_model is None:
+            parser = Parser()
+            query_model = parser.parse(query)
+            self.query_cache.put(query, query_model)
+        return query_model
 
-    def execute_aql_query(self, query, query_params=None, count_only=False, query_processes=1):
+    def execute_aql_query(self, query, query_params=None, count_only=False, query_processes=1,
+                          stream=False, count_by=None, query_threads=1):
         """
         Execute an AQL query and return a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet`
         object that maps the obtained results.
@@ -64,6 +152,16 @@ class QueryManager(object):
         :type query: str
         :param query_params: a dictionary containing query parameters as keys and their values
         :type query_params: dict
+        :param stream: if True, results are not loaded in memory but fetched from the database
+          while they are consumed, the returned object will be a
+          :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.StreamingResultSet`
+        :type stream: bool
+        :param count_by: used with count_only, group the counted results by 'structure' or 'patient';
+          counters are calculated with a single query and returned as a dictionary
+        :type count_by: str
+        :param query_threads: if greater than 1, sub-queries are executed concurrently by a pool of
+          threads sharing a single database connection; it can't be used with query_processes
+        :type query_threads: int
         :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet` object
         """
         if query_params:
@@ -72,11 +170,17 @@ class QueryManager(object):
             # add the $ character to the keys in query_params that don't begin with it
             query_params = dict(('$%s' % k if not k.startswith('$') else k, v)
                                 for k, v in query_params.iteritems())
-        parser = Parser()
-        query_model = parser.parse(query)
-        drf = self._get_drivers_factory(self.ehr_repository)
+        if query_processes > 1 and query_threads > 1:
+            raise ValueError('query_processes and query_threads can not be used together')
+        query_model = self._get_query_model(query)
+        driver_options = None
+        if self.persistent_pool and query_processes > 1 and not (count_only or stream):
+            driver_options = dict(self.driver_options or {})
+            driver_options['queries_pool'] = self._get_queries_pool(query_processes)
+        drf = self._get_drivers_factory(self.ehr_repository, driver_options)
         with drf.get_driver() as driver:
             # the count_only field will be retrieved parsing AQL query
             results_set = driver.execute_query(query_model, self.patients_repository, self.ehr_repository,
-                                               query_params, count_only, query_processes)
+                                               query_params, count_only, query_processes, stream,
+                                               count_by, query_threads)
         return results_set
\ No newline at end of file
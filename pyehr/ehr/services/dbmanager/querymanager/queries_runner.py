@@ -88,13 +88,13 @@ class QueriesRunner(object):
         return self.queries_results.get(query_label)
 
     def get_intersection(self, field, *query_labels):
-        res = set([r[field] for r in self.queries_results[query_labels[0]].results])
+        res = set(self.queries_results[query_labels[0]].get_column(field))
         for label in query_labels[1:]:
-            res.intersection_update(set([r[field] for r in self.queries_results[label].results]))
+            res.intersection_update(self.queries_results[label].get_column(field))
         return res
 
     def get_union(self, field, *query_labels):
-        res = set([r[field] for r in self.queries_results[query_labels[0]].results])
+        res = set(self.queries_results[query_labels[0]].get_column(field))
         for label in query_labels[1:]:
-            res.update(set([r[field] for r in self.queries_results[label].results]))
+            res.update(self.queries_results[label].get_column(field))
         return res
\ No newline at end of file
@@ -1,3 +1,5 @@
+from itertools import izip, islice
+
 from pyehr.ehr.services.dbmanager.errors import InvalidFieldError
 
 
@@ -17,10 +19,43 @@ class ResultColumnDef(object):
         return {'alias': self.alias, 'path': self.path}
 
 
+class MissingValue(object):
+    """
+    Placeholder used in the columns of a :class:`ResultSet` for rows that have no value
+    for a column, the class itself is used as a value so it can be safely pickled
+    """
+    pass
+
+
 class ResultRow(object):
+    """
+    A row of a query result: *values* is a tuple aligned with *paths*, the paths of the
+    selected columns. The *paths* tuple is usually shared by all the rows produced by the
+    same query, :class:`MissingValue` is used for columns without a value.
+    """
+
+    __slots__ = ('paths', 'values')
 
     def __init__(self, record):
-        self.record = record
+        self.paths = tuple(record.iterkeys())
+        self.values = tuple(record.itervalues())
+
+    @classmethod
+    def from_values(cls, paths, values):
+        row = cls.__new__(cls)
+        row.paths = paths
+        row.values = values
+        return row
+
+    @property
+    def record(self):
+        return dict((p, v) for p, v in izip(self.paths, self.values) if v is not MissingValue)
+
+    def __getstate__(self):
+        return self.paths, self.values
+
+    def __setstate__(self, state):
+        self.paths, self.values = state
 
     def __eq__(self, other):
         if isinstance(other, ResultRow):
@@ -30,12 +65,22 @@ class ResultRow(object):
 
 
 class ResultSet(object):
+    """
+    The results of a query. Rows are stored by column, each column is a list of values
+    (one for each row) mapped to the path of the column; :class:`MissingValue` is used
+    for rows without a value for a column.
+    """
 
     def __init__(self):
         self.name = None
         self.total_results = 0
         self.columns = []
-        self.rows = []
+        self._columns_keys = set()
+        # maps columns paths to their aliases and vice versa
+        self._aliases = dict()
+        self._aliases_paths = dict()
+        self._columns_data = dict()
+        self._rows_count = 0
 
     def to_json(self, add_columns_json=False):
         json_res = {
@@ -47,37 +92,250 @@ class ResultSet(object):
         return json_res
 
     def _get_alias(self, key):
-        for col in self.columns:
-            if col.path == key:
-                return col.alias
-        raise KeyError('Can\'t map key %s' % key)
+        try:
+            return self._aliases[key]
+        except KeyError:
+            raise KeyError('Can\'t map key %s' % key)
 
     def __str__(self):
         return str(self.to_json())
 
     def extend(self, result_set):
-        self.total_results += result_set.total_results
-        self.rows += result_set.rows
         for c in result_set.columns:
-            if c not in self.columns:
-                self.columns.append(c)
+            self.add_column_definition(c)
+        if isinstance(result_set, StreamingResultSet):
+            for r in result_set.rows:
+                self.add_row(r)
+        else:
+            self._extend_columns_data(result_set.total_results, result_set._rows_count,
+                                      result_set._columns_data.iteritems())
+
+    def _extend_columns_data(self, total_results, rows_count, columns_data):
+        self.total_results += total_results
+        rows_count += self._rows_count
+        for path, values in columns_data:
+            self._get_column_data(path).extend(values)
+        self._fill_columns(rows_count)
+
+    def to_batch(self):
+        """
+        Return a compact representation of the result set, made only by tuples, lists and
+        plain values, that is cheaper to pickle than the result set itself and can be merged
+        into another result set using :meth:`extend_batch`. Used to send the results produced
+        by a worker process back to the parent one.
+        """
+        return (tuple((c.alias, c.path) for c in self.columns), self.total_results,
+                self._rows_count, tuple(self._columns_data.iteritems()))
+
+    def extend_batch(self, batch):
+        """
+        Add the columns and the rows of a batch produced by :meth:`to_batch` to the result set
+        """
+        columns, total_results, rows_count, columns_data = batch
+        for alias, path in columns:
+            self.add_column_definition(ResultColumnDef(alias, path))
+        self._extend_columns_data(total_results, rows_count, columns_data)
 
     def add_column_definition(self, colum_def):
-        if colum_def not in self.columns:
+        column_key = (colum_def.alias, colum_def.path)
+        if column_key not in self._columns_keys:
+            self._columns_keys.add(column_key)
             self.columns.append(colum_def)
+            if colum_def.path not in self._aliases:
+                self._aliases[colum_def.path] = colum_def.alias
+                self._aliases_paths.setdefault(colum_def.alias, []).append(colum_def.path)
+
+    def _get_column_data(self, path):
+        try:
+            return self._columns_data[path]
+        except KeyError:
+            return self._columns_data.setdefault(path, [MissingValue] * self._rows_count)
+
+    def _fill_columns(self, rows_count):
+        for values in self._columns_data.itervalues():
+            if len(values) < rows_count:
+                values.extend([MissingValue] * (rows_count - len(values)))
+        self._rows_count = rows_count
 
     def add_row(self, row):
-        self.rows.append(row)
+        for path, value in izip(row.paths, row.values):
+            if value is not MissingValue:
+                self._get_column_data(path).append(value)
+        self._fill_columns(self._rows_count + 1)
         self.total_results += 1
 
+    def add_rows(self, paths, rows_values, chunk_size=1000):
+        """
+        Add the rows produced by *rows_values*, an iterable of tuples of values aligned
+        with *paths*, as done by :meth:`add_row` with :meth:`ResultRow.from_values`.
+        Rows are transposed and appended to the columns in chunks of *chunk_size* rows,
+        no :class:`ResultRow` object is created.
+        """
+        columns = [self._get_column_data(p) for p in paths]
+        rows_values = iter(rows_values)
+        rows_count = 0
+        while True:
+            chunk = list(islice(rows_values, chunk_size))
+            if len(chunk) == 0:
+                break
+            for column, values in izip(columns, izip(*chunk)):
+                column.extend(values)
+            rows_count += len(chunk)
+        self._fill_columns(self._rows_count + rows_count)
+        self.total_results += rows_count
+
+    @property
+    def rows(self):
+        paths = tuple(self._columns_data.iterkeys())
+        columns = self._columns_data.values()
+        for i in xrange(self._rows_count):
+            yield ResultRow.from_values(paths, tuple(values[i] for values in columns))
+
+    def _row_to_result(self, row):
+        return dict((self._get_alias(p), v) for p, v in izip(row.paths, row.values)
+                    if v is not MissingValue)
+
     @property
     def results(self):
-        for r in self.rows:
-            yield {self._get_alias(k): v for k, v in r.record.iteritems()}
+        columns = [(self._get_alias(path), values) for path, values in self._columns_data.iteritems()]
+        for i in xrange(self._rows_count):
+            yield dict((alias, values[i]) for alias, values in columns if values[i] is not MissingValue)
+
+    def get_column(self, field):
+        """
+        Return a list with the values of the column with alias *field*, the n-th element
+        of the list is the value of the n-th row of the result set. A KeyError is raised
+        if one or more rows don't have a value for the given field.
+
+        :param field: the alias of the column
+        :type field: str
+        :rtype: list
+        """
+        if self._rows_count == 0:
+            return []
+        columns = [self._columns_data[p] for p in self._aliases_paths.get(field, [])
+                   if p in self._columns_data]
+        if len(columns) == 0:
+            raise KeyError(field)
+        elif len(columns) == 1:
+            values = list(columns[0])
+        else:
+            # the same alias can be used for different paths, take the value from
+            # the column that has one for each row
+            values = [MissingValue] * self._rows_count
+            for c in columns:
+                for i, v in enumerate(c):
+                    if v is not MissingValue:
+                        values[i] = v
+        if MissingValue in values:
+            raise KeyError(field)
+        return values
 
     def get_distinct_results(self, field):
         try:
-            for x in set([r[field] for r in self.results]):
-                yield x
+            values = self.get_column(field)
         except KeyError:
-            raise InvalidFieldError('There is no field "%s" in this results set' % field)
\ No newline at end of file
+            raise InvalidFieldError('There is no field "%s" in this results set' % field)
+        for x in set(values):
+            yield x
+
+
+class StreamingResultSet(ResultSet):
+    """
+    A :class:`ResultSet` whose rows are not stored in memory but lazily fetched from
+    the database while they are consumed. Rows are produced by one or more sources,
+    callables returning an iterable of :class:`ResultRow` objects, that are called every
+    time the rows of the result set are iterated.
+
+    *total_results* is calculated when requested for the first time using the
+    *count_function*, that must return the number of rows produced by all the sources
+    added with :meth:`add_rows_source`, and then cached. If no *count_function* was given
+    results are counted iterating over the rows, this means running again all the queries
+    of the sources unless the rows have already been consumed entirely, so drivers always
+    provide a *count_function*.
+    """
+
+    def __init__(self, count_function=None):
+        super(StreamingResultSet, self).__init__()
+        self._rows_sources = []
+        self._count_function = count_function
+        self._total_results = None
+
+    @property
+    def total_results(self):
+        if self._total_results is None:
+            if self._count_function:
+                self._total_results = self._count_function()
+            else:
+                self._total_results = sum(1 for _ in self.rows)
+        return self._total_results
+
+    @total_results.setter
+    def total_results(self, value):
+        self._total_results = value
+
+    @property
+    def rows(self):
+        count = 0
+        for source in self._rows_sources:
+            for row in source():
+                count += 1
+                yield row
+        # all the rows have been consumed, there is no need to run the sources again to count them
+        if self._total_results is None and self._count_function is None:
+            self._total_results = count
+
+    @property
+    def results(self):
+        for r in self.rows:
+            yield self._row_to_result(r)
+
+    def get_column(self, field):
+        return [r[field] for r in self.results]
+
+    def add_rows_source(self, rows_source):
+        """
+        Add a callable that returns an iterable of :class:`ResultRow` objects to the sources
+        of the result set
+        """
+        self._rows_sources.append(rows_source)
+        self._total_results = None
+
+    def extend(self, result_set):
+        if isinstance(result_set, StreamingResultSet):
+            self._count_function = self._merge_count_functions(self._get_count_function(),
+                                                               result_set._get_count_function())
+            self._rows_sources.extend(result_set._rows_sources)
+        else:
+            self._count_function = self._merge_count_functions(self._get_count_function(),
+                                                               lambda: result_set.total_results)
+            self._rows_sources.append(lambda: result_set.rows)
+        self._total_results = None
+        for c in result_set.columns:
+            self.add_column_definition(c)
+
+    def _get_count_function(self):
+        if self._count_function is None and len(self._rows_sources) == 0:
+            return lambda: 0
+        return self._count_function
+
+    @staticmethod
+    def _merge_count_functions(first, second):
+        if first and second:
+            return lambda: first() + second()
+        return None
+
+    def extend_batch(self, batch):
+        result_set = ResultSet()
+        result_set.extend_batch(batch)
+        self.extend(result_set)
+
+    def add_row(self, row):
+        self._count_function = self._merge_count_functions(self._get_count_function(), lambda: 1)
+        self.add_rows_source(lambda: [row])
+
+    def add_rows(self, paths, rows_values, chunk_size=1000):
+        rows = [ResultRow.from_values(paths, values) for values in rows_values]
+        self._count_function = self._merge_count_functions(self._get_count_function(),
+                                                           lambda: len(rows))
+        self.add_rows_source(lambda: rows)
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from threading import RLock
+
+
+class LRUCache(object):
+    """
+    A bounded, thread safe, in-memory cache with a Least Recently Used eviction
+    policy. When the cache reaches *max_size* elements, the least recently used
+    one is discarded. A *max_size* equal to 0 disables the cache.
+
+    :ivar max_size: the maximum number of elements stored in the cache
+    :ivar hits: the number of lookups that found a value in the cache
+    :ivar misses: the number of lookups that didn't find a value in the cache
+    """
+
+    def __init__(self, max_size=1000):
+        if max_size < 0:
+            raise ValueError('max_size must be an integer greater or equal to 0')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key, default=None):
+        """
+        Return the value mapped to *key* or *default* if *key* is not in the cache
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # re-insert the value in order to mark it as the most recently used one
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Map *value* to *key*, if the cache is full the least recently used element
+        will be discarded
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove *key* from the cache, return True if the key was found
+        """
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def invalidate_value(self, value):
+        """
+        Remove all the keys mapped to *value* and return the number of removed elements
+        """
+        with self._lock:
+            keys = [k for k, v in self._data.iteritems() if v == value]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def clear(self):
+        """
+        Remove all the elements from the cache, hits and misses counters are preserved
+        """
+        with self._lock:
+            self._data.clear()
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        """
+        Return a dictionary with cache's size and its hits and misses counters
+        """
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
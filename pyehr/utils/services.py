@@ -11,7 +11,9 @@ class ServiceConfig(object):
                  db_ehr_repository, db_ehr_versioning_repository,
                  index_url, index_database, index_user, index_passwd,
                  db_service_host, db_service_port, db_service_server_engine,
-                 query_service_host, query_service_port, query_service_server_engine):
+                 query_service_host, query_service_port, query_service_server_engine,
+                 index_engine='basex', index_cache_size=1000, index_contains_cache_size=500,
+                 index_generation_check_interval=5):
         self.db_driver = db_driver
         self.db_host = db_host
         self.db_database = db_database
@@ -26,6 +28,10 @@ class ServiceConfig(object):
         self.index_database = index_database
         self.index_user = index_user
         self.index_passwd = index_passwd
+        self.index_engine = index_engine
+        self.index_cache_size = int(index_cache_size)
+        self.index_contains_cache_size = int(index_contains_cache_size)
+        self.index_generation_check_interval = float(index_generation_check_interval)
         self.db_service_host = db_service_host
         self.db_service_port = db_service_port
         self.db_service_server_engine = db_service_server_engine
@@ -52,7 +58,11 @@ class ServiceConfig(object):
             'url': self.index_url,
             'database': self.index_database,
             'user': self.index_user,
-            'passwd': self.index_passwd
+            'passwd': self.index_passwd,
+            'engine': self.index_engine,
+            'cache_size': self.index_cache_size,
+            'contains_cache_size': self.index_contains_cache_size,
+            'generation_check_interval': self.index_generation_check_interval
         }
 
     def get_db_service_configuration(self):
@@ -75,6 +85,10 @@ def get_service_configuration(configuration_file, logger=None):
         logger = get_logger('service_configuration')
     parser = SafeConfigParser(allow_no_value=True)
     parser.read(configuration_file)
+
+    def get_optional(section, option, default):
+        return parser.get(section, option) if parser.has_option(section, option) else default
+
     try:
         conf = ServiceConfig(
             parser.get('db', 'driver'),
@@ -96,7 +110,12 @@ def get_service_configuration(configuration_file, logger=None):
             parser.get('db_service', 'server_engine'),
             parser.get('query_service', 'host'),
             parser.get('query_service', 'port'),
-            parser.get('query_service', 'server_engine')
+            parser.get('query_service', 'server_engine'),
+            # optional, BaseX is the default index engine
+            get_optional('index', 'engine', 'basex'),
+            get_optional('index', 'cache_size', 1000),
+            get_optional('index', 'contains_cache_size', 500),
+            get_optional('index', 'generation_check_interval', 5)
         )
         return conf
     except NoOptionError, nopt:
@@ -52,8 +52,13 @@ class DBService(object):
         post('/check/status/dbservice')(self.test_server)
         get('/check/status/dbservice')(self.test_server)
 
-    def add_index_service(self, url, database, user, passwd):
-        self.dbs.set_index_service(url, database, user, passwd)
+    def add_index_service(self, url, database, user, passwd, engine='basex', cache_size=1000,
+                          contains_cache_size=500, generation_check_interval=5):
+        # daemons are long running processes, keep the session with the index open
+        self.dbs.set_index_service(url, database, user, passwd, persistent_session=True,
+                                   engine=engine, cache_size=cache_size,
+                                   contains_cache_size=contains_cache_size,
+                                   generation_check_interval=generation_check_interval)
 
     def exceptions_handler(f):
         @wraps(f)
@@ -36,12 +36,18 @@ class QueryService():
         ###############################################
         post('/query/execute')(self.execute_query)
         post('/query/execute_count')(self.execute_count_query)
+        get('/query/cache/stats')(self.get_query_cache_stats)
         # utilities
         post('/check/status/querymanager')(self.test_server)
         get('/check/status/querymanager')(self.test_server)
 
-    def add_index_service(self, url, database, user, passwd):
-        self.qmanager.set_index_service(url, database, user, passwd)
+    def add_index_service(self, url, database, user, passwd, engine='basex', cache_size=1000,
+                          contains_cache_size=500, generation_check_interval=5):
+        # daemons are long running processes, keep the session with the index open
+        self.qmanager.set_index_service(url, database, user, passwd, persistent_session=True,
+                                        engine=engine, cache_size=cache_size,
+                                        contains_cache_size=contains_cache_size,
+                                        generation_check_interval=generation_check_interval)
 
     def exception_handler(f):
         @wraps(f)
@@ -77,14 +83,18 @@ class QueryService():
         response.status = return_code
         return body
 
-    def _execute_query(self, params, count_only):
+    def _execute_query(self, params, count_only, count_by=None):
         aql_query = params.get('query')
         if not aql_query:
             self._missing_mandatory_field('query')
         query_params = params.get('query_params')
         if query_params:
             query_params = json.loads(query_params)
-        results = self.qmanager.execute_aql_query(aql_query, query_params, count_only)
+        query_processes = int(params.get('query_processes') or 1)
+        query_threads = int(params.get('query_threads') or 1)
+        results = self.qmanager.execute_aql_query(aql_query, query_params, count_only,
+                                                  query_processes, count_by=count_by,
+                                                  query_threads=query_threads)
         return results
 
     @exception_handler
@@ -100,19 +110,29 @@ class QueryService():
     @exception_handler
     def execute_count_query(self):
         params = request.forms
-        results = self._execute_query(params, count_only=True)
+        results = self._execute_query(params, count_only=True, count_by=params.get('count_by'))
         response_body = {
             'SUCCESS': True,
             'RESULTS_COUNTER': results
         }
         return self._success(response_body)
 
+    @exception_handler
+    def get_query_cache_stats(self):
+        response_body = {
+            'SUCCESS': True,
+            'QUERY_CACHE': self.qmanager.query_cache_stats
+        }
+        return self._success(response_body)
+
     def start_service(self, host, port, engine, debug=False):
         self.logger.info('Starting QueryService daemon with DEBUG set to %s', debug)
         try:
             run(host=host, port=port, server=engine, debug=debug)
         except Exception, e:
             self.logger.critical('An error has occurred: %s', e)
+        finally:
+            self.qmanager.shutdown()
 
     def test_server(self):
         return 'QueryManager daemon running'
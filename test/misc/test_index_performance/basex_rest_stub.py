@@ -0,0 +1,220 @@
+"""
+A minimal, in-memory stand-in for the BaseX REST API. It implements only the subset
+of the API used by the IndexService (databases, resources, documents, XPath queries
+and the updating queries built by the service) and can add a fixed latency to each
+HTTP request in order to simulate a remote server. Unsupported queries are rejected
+with a 400 response, the client will raise a QueryError.
+Not meant to be used outside benchmarks.
+"""
+
+import re, time, threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from lxml import etree
+
+BASEX_NSPACE = 'http://basex.org/rest'
+# BaseX supports general comparisons with sequences, lxml (XPath 1.0) does not
+SEQUENCE_COMPARISON = re.compile(r'@([\w-]+)=\(([^)]*)\)')
+
+
+# the updating expressions built by the IndexService
+DB_ADD = re.compile(r'db:add\("[^"]*", parse-xml\("([^"]*)"\), "([^"]*)"\)')
+GENERATION_UPDATE = re.compile(r'for \$g in db:open\("[^"]*", "([^"]*)"\)/index_generation/@value\s+'
+                               r'return replace value of node \$g with xs:integer\(\$g\) \+ 1')
+MISSING_OUTPUT = re.compile(r'for \$u in \(([^)]*)\) where not\(db:exists\("[^"]*", \$u\)\) '
+                            r'return (?:update|db):output\(<structure uid="\{\$u\}"/>\)')
+COUNTER_UPDATE = re.compile(r'for \$s in db:open\("[^"]*", "([^"]*)"\)/archetype_structure\s+'
+                            r'let \$hits := xs:integer\(\$s/references_counter/@hits\) \+ (-?\d+)\s+'
+                            r'return if \(\$hits <= 0\)\s+'
+                            r'then db:delete\("[^"]*", "[^"]*"\)\s+'
+                            r'else replace value of node \$s/references_counter/@hits with \$hits')
+UPDATING_EXPRESSIONS = (DB_ADD, GENERATION_UPDATE, MISSING_OUTPUT, COUNTER_UPDATE)
+GENERATION_QUERY = re.compile(r'db:open\("[^"]*", "([^"]*)"\)/index_generation/'
+                              r'string-join\(\(@epoch, @value\), ":"\)$')
+STRING_ENTITIES = re.compile(r'&(quot|amp);')
+SEPARATOR = re.compile(r'\s*,\s*')
+
+
+class UnsupportedQueryError(Exception):
+    pass
+
+
+def _unescape_string_literal(value):
+    return STRING_ENTITIES.sub(lambda m: '"' if m.group(1) == 'quot' else '&', value)
+
+
+def _parse_updating_query(query):
+    # a single updating expression or a comma separated list of them
+    if query.startswith('(') and query.endswith(')'):
+        query = query[1:-1]
+    expressions = list()
+    position = 0
+    while position < len(query):
+        for expression in UPDATING_EXPRESSIONS:
+            match = expression.match(query, position)
+            if match:
+                break
+        else:
+            raise UnsupportedQueryError('Unsupported query: %s' % query[position:])
+        expressions.append(match)
+        position = match.end()
+        separator = SEPARATOR.match(query, position)
+        if separator:
+            position = separator.end()
+        elif position < len(query):
+            raise UnsupportedQueryError('Unsupported query: %s' % query[position:])
+    return expressions
+
+
+def _expand_sequence(match):
+    conditions = ['@%s=%s' % (match.group(1), v.strip()) for v in match.group(2).split(',')]
+    return '(%s)' % ' or '.join(conditions)
+
+
+class BaseXRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def databases(self):
+        return self.server.databases
+
+    def _send_response(self, status_code, body=''):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _get_path(self):
+        return [p for p in self.path.split('/') if p]
+
+    def do_GET(self):
+        path = self._get_path()
+        if len(path) == 0:
+            dbs = ''.join('<rest:database>%s</rest:database>' % db for db in self.databases)
+            return self._send_response(200, '<rest:databases xmlns:rest="%s">%s</rest:databases>' %
+                                       (BASEX_NSPACE, dbs))
+        if path[0] not in self.databases:
+            return self._send_response(404)
+        documents = self.databases[path[0]]
+        if len(path) == 1:
+            resources = ''.join('<rest:resource>%s</rest:resource>' % r for r in documents)
+            return self._send_response(200, '<rest:database xmlns:rest="%s" name="%s">%s</rest:database>' %
+                                       (BASEX_NSPACE, path[0], resources))
+        if path[1] in documents:
+            return self._send_response(200, documents[path[1]])
+        return self._send_response(200, '<rest:database xmlns:rest="%s" resources="0"/>' % BASEX_NSPACE)
+
+    def do_PUT(self):
+        path = self._get_path()
+        body = self._read_body()
+        if len(path) == 1:
+            self.databases[path[0]] = dict()
+        else:
+            self.databases[path[0]][path[1]] = body
+        self._send_response(201)
+
+    def do_DELETE(self):
+        path = self._get_path()
+        self._read_body()
+        if len(path) == 1:
+            self.databases.pop(path[0], None)
+        else:
+            self.databases[path[0]].pop(path[1], None)
+        self._send_response(200)
+
+    def _execute_updates(self, documents, expressions):
+        # like BaseX, outputs are evaluated against the database before the updates
+        # are applied and all the updates are applied at the end of the query
+        results = list()
+        updates = list()
+        for match in expressions:
+            if match.re is DB_ADD:
+                updates.append((match.group(2), _unescape_string_literal(match.group(1))))
+            elif match.re is GENERATION_UPDATE:
+                if match.group(1) in documents:
+                    generation = etree.fromstring(documents[match.group(1)])
+                    generation.set('value', str(int(generation.get('value')) + 1))
+                    updates.append((match.group(1), etree.tostring(generation)))
+            elif match.re is MISSING_OUTPUT:
+                for str_id in re.findall(r'"([^"]*)"', match.group(1)):
+                    if str_id not in documents:
+                        results.append('<structure uid="%s"/>' % str_id)
+            else:
+                if match.group(1) in documents:
+                    structure = etree.fromstring(documents[match.group(1)])
+                    hits = int(structure.find('references_counter').get('hits')) + int(match.group(2))
+                    if hits <= 0:
+                        updates.append((match.group(1), None))
+                    else:
+                        structure.find('references_counter').set('hits', str(hits))
+                        updates.append((match.group(1), etree.tostring(structure)))
+        for doc_id, document in updates:
+            if document is None:
+                documents.pop(doc_id, None)
+            else:
+                documents[doc_id] = document
+        return results
+
+    def _execute_query(self, documents, query):
+        generation_query = GENERATION_QUERY.match(query)
+        if generation_query:
+            if generation_query.group(1) not in documents:
+                return []
+            generation = etree.fromstring(documents[generation_query.group(1)])
+            return ['%s:%s' % (generation.get('epoch'), generation.get('value'))]
+        if query.startswith('/'):
+            query = SEQUENCE_COMPARISON.sub(_expand_sequence, query)
+            results = list()
+            for doc in documents.values():
+                try:
+                    matches = etree.fromstring(doc).getroottree().xpath(query)
+                except etree.XPathError, xpe:
+                    raise UnsupportedQueryError('Unsupported query %s: %s' % (query, xpe))
+                results.extend(etree.tostring(r) for r in matches)
+            return results
+        return self._execute_updates(documents, _parse_updating_query(query))
+
+    def do_POST(self):
+        path = self._get_path()
+        query = etree.fromstring(self._read_body()).findtext('{%s}text' % BASEX_NSPACE)
+        if path[0] not in self.databases:
+            return self._send_response(404, 'Database \'%s\' was not found.' % path[0])
+        # queries are serialized, as BaseX does with updating queries
+        try:
+            with self.server.lock:
+                results = self._execute_query(self.databases[path[0]], query.strip())
+        except UnsupportedQueryError, uqe:
+            return self._send_response(400, str(uqe))
+        self._send_response(200, ''.join(results))
+
+
+class BaseXRESTStub(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        HTTPServer.__init__(self, (host, port), BaseXRequestHandler)
+        self.databases = dict()
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        server_thread = threading.Thread(target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
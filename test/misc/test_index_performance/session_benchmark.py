@@ -0,0 +1,104 @@
+import sys, argparse, time
+
+from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+from pyehr.aql.parser import Parser
+from pyehr.utils import get_logger
+from basex_rest_stub import BaseXRESTStub
+
+QUERY = """
+SELECT o/data[at0002]/events[at0003]/data[at0001]/items[at0004]/value/magnitude AS systolic
+FROM Ehr e
+CONTAINS Composition c[openEHR-EHR-COMPOSITION.encounter.v1]
+CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+"""
+
+
+def get_parser():
+    parser = argparse.ArgumentParser('Measure per-call latency of the IndexService with and without persistent sessions')
+    parser.add_argument('--basex_url', type=str,
+                        help='URL of a BaseX REST server, if missing a local stand-in server will be used')
+    parser.add_argument('--basex_user', type=str, help='BaseX user')
+    parser.add_argument('--basex_passwd', type=str, help='BaseX password')
+    parser.add_argument('--database', type=str, default='pyehr_session_benchmark',
+                        help='The BaseX database used for the benchmark (default pyehr_session_benchmark)')
+    parser.add_argument('--calls', type=int, default=200,
+                        help='Number of calls for each measured operation (default 200)')
+    parser.add_argument('--latency_ms', type=float, default=1.0,
+                        help='Latency in milliseconds added to each request by the local stand-in server (default 1)')
+    parser.add_argument('--log_file', type=str, help='LOG file (default=stderr)')
+    parser.add_argument('--log_level', type=str, default='INFO',
+                        help='LOG level (default=INFO)')
+    return parser
+
+
+def build_records():
+    blood_pressure = {
+        'archetype_class': 'openEHR-EHR-OBSERVATION.blood_pressure.v1',
+        'archetype_details': {}
+    }
+    return [
+        {'archetype_class': 'openEHR-EHR-COMPOSITION.encounter.v1',
+         'archetype_details': {'content': [blood_pressure]}},
+        {'archetype_class': 'openEHR-EHR-COMPOSITION.encounter.v1',
+         'archetype_details': {'context': {'at0001': blood_pressure}}}
+    ]
+
+
+def measure(label, function, calls, logger):
+    start_time = time.time()
+    for i in xrange(calls):
+        function(i)
+    execution_time = time.time() - start_time
+    logger.info('%s: %d calls in %f seconds, %f ms per call', label, calls,
+                execution_time, (execution_time * 1000) / calls)
+    return execution_time
+
+
+def run_benchmark(url, database, user, passwd, calls, logger):
+    records = build_records()
+    containers = Parser().parse(QUERY).location.containers
+    results = dict()
+    for persistent_session in (False, True):
+        # caches are disabled, every call must reach the server
+        index_service = IndexService(database, url, user, passwd, logger,
+                                     cache_size=0, contains_cache_size=0,
+                                     persistent_session=persistent_session)
+        label = 'persistent' if persistent_session else 'per-call'
+        results[label] = {
+            'get_structure_id': measure('%s session, get_structure_id' % label,
+                                        lambda i: index_service.get_structure_id(records[i % len(records)]),
+                                        calls, logger),
+            'map_aql_contains': measure('%s session, map_aql_contains' % label,
+                                        lambda i: index_service.map_aql_contains(containers),
+                                        calls, logger)
+        }
+        index_service.disconnect()
+    for operation in ('get_structure_id', 'map_aql_contains'):
+        logger.info('%s speedup: %.2fx', operation,
+                    results['per-call'][operation] / results['persistent'][operation])
+    return results
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    logger = get_logger('session_benchmark', log_level=args.log_level, log_file=args.log_file)
+    basex_stub = None
+    url = args.basex_url
+    if not url:
+        basex_stub = BaseXRESTStub(latency=args.latency_ms / 1000.)
+        basex_stub.start()
+        url = basex_stub.url
+        logger.info('Started BaseX stand-in server at %s', url)
+    try:
+        run_benchmark(url, args.database, args.basex_user, args.basex_passwd, args.calls, logger)
+    finally:
+        if basex_stub:
+            basex_stub.stop()
+        else:
+            index_service = IndexService(args.database, url, args.basex_user, args.basex_passwd, logger)
+            index_service.delete_index()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
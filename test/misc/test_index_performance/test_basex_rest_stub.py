@@ -0,0 +1,86 @@
+import unittest
+from pybasex import errors as pbx_errors
+from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+from pyehr.aql.parser import Parser
+from basex_rest_stub import BaseXRESTStub
+
+
+class TestBaseXRESTStub(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestBaseXRESTStub, self).__init__(label)
+
+    def setUp(self):
+        self.basex_stub = BaseXRESTStub()
+        self.basex_stub.start()
+        # caches are disabled, every call reaches the stand-in server
+        self.index_service = IndexService('test_basex_stub', self.basex_stub.url, None, None,
+                                          cache_size=0, contains_cache_size=0)
+
+    def tearDown(self):
+        self.index_service.disconnect()
+        self.basex_stub.stop()
+
+    def _get_record(self, leaf_class='openEHR-EHR-OBSERVATION.blood_pressure.v1'):
+        return {
+            'archetype_class': 'openEHR-EHR-COMPOSITION.encounter.v1',
+            'archetype_details': {
+                'content': [
+                    {
+                        'archetype_class': leaf_class,
+                        'archetype_details': {}
+                    }
+                ]
+            }
+        }
+
+    def _get_containers(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Composition c[openEHR-EHR-COMPOSITION.encounter.v1]
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        return Parser().parse(query).location.containers
+
+    def test_get_structure_id(self):
+        str_id = self.index_service.get_structure_id(self._get_record())
+        self.assertEqual(self.index_service.get_structure_id(self._get_record()), str_id)
+        self.assertNotEqual(self.index_service.get_structure_id(self._get_record('openEHR-EHR-OBSERVATION.heart_rate.v1')),
+                            str_id)
+        self.assertEqual(self.index_service.get_structure_id(self._get_record()), str_id)
+        self.assertEqual(self.index_service.map_aql_contains(self._get_containers())[0].keys(), [str_id])
+
+    def test_index_generation(self):
+        generation = self.index_service._read_index_generation()
+        self.index_service.get_structure_id(self._get_record())
+        epoch, counter = generation.split(':')
+        self.assertEqual(self.index_service._read_index_generation(), '%s:%d' % (epoch, int(counter) + 1))
+
+    def test_structure_counters(self):
+        str_id = self.index_service.get_structure_id(self._get_record())
+        missing_id = 'a' * 32
+        self.assertEqual(self.index_service.update_structure_counters({str_id: 2, missing_id: 1}),
+                         [missing_id])
+        self.assertEqual(self.index_service.update_structure_counters({str_id: -1}), [])
+        self.assertEqual(self.index_service.update_structure_counters({str_id: -1}), [])
+        # the structure was deleted, a new one is created
+        self.assertEqual(self.index_service.update_structure_counters({str_id: 0}), [str_id])
+        self.assertNotEqual(self.index_service.get_structure_id(self._get_record()), str_id)
+
+    def test_unsupported_query(self):
+        with self.assertRaises(pbx_errors.QueryError):
+            self.index_service._execute_query('db:drop("test_basex_stub")')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestBaseXRESTStub('test_get_structure_id'))
+    suite.addTest(TestBaseXRESTStub('test_index_generation'))
+    suite.addTest(TestBaseXRESTStub('test_structure_counters'))
+    suite.addTest(TestBaseXRESTStub('test_unsupported_query'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
@@ -110,7 +110,7 @@ class TestIndexPerformance(object):
 
     def cleanup(self, index_cleanup=True):
         self.logger.info('*** Deleting pyEHR data ***')
-        for p in self.dbs.get_patients(fetch_ehr_records=False):
+        for p in self.dbs.iter_patients(fetch_ehr_records=False):
             self.logger.debug('-- Deleting patient %s and EHRs', p.record_id)
             self.dbs.delete_patient(p, cascade_delete=True)
         if index_cleanup:
@@ -16,6 +16,11 @@ class DataLoaderThread(multiprocessing.Process):
         self.logger = logger
 
     def run(self):
+        # the database has been prepared for the bulk ingest by the parent process
+        with self.db_service.bulk_ingest(prepare_database=False):
+            self._dump_row()
+
+    def _dump_row(self):
         for patient, dataset in get_patient_records_from_file_row(self.dataset_row):
             self.logger.info('Saving data for patient %s' % patient.record_id)
             p = self.db_service.get_patient(patient.record_id, fetch_ehr_records=False)
@@ -46,6 +51,8 @@ def get_parser():
                         help='clean pyEHR databases before dumping new records')
     parser.add_argument('--parallel_processes', type=int, default=1,
                         help='The number of parallel processes used to load data (tool is single process by default)')
+    parser.add_argument('--ingest_replicas', type=int, default=None,
+                        help='The number of replicas used while loading data (by default replicas are not changed)')
     parser.add_argument('--log_file', type=str, help='LOG file (default=stderr)')
     parser.add_argument('--log_level', type=str, default='INFO',
                         help='LOG level (default=INFO)')
@@ -63,14 +70,13 @@ def get_db_service(conf_file):
 
 def clean_database(db_service, logger):
     logger.info('Starting cleanup')
-    patients = db_service.get_patients(fetch_ehr_records=False)
+    # patients are loaded lazily, a page at a time
+    patients = db_service.iter_patients(fetch_ehr_records=False)
     for i, p in enumerate(patients):
-        logger.info('Cleaning data for patient %s (%d of %d)' % (p.record_id, i+1, len(patients)))
+        logger.info('Cleaning data for patient %s (%d)' % (p.record_id, i+1))
         db_service.delete_patient(p, cascade_delete=True)
     logger.info('Cleaning index')
-    db_service.index_service.connect()
-    db_service.index_service.basex_client.delete_database()
-    db_service.index_service.disconnect()
+    db_service.index_service.delete_index()
     logger.info('Cleanup completed')
 
 
@@ -127,11 +133,12 @@ def main(argv):
     dbservice, dbservice_cfg, index_service_cfg = get_db_service(args.pyehr_config)
     if args.clean_db:
         clean_database(dbservice, logger)
-    if args.parallel_processes == 1:
-        dump_records(args.datasets_file, args.compression_enabled, dbservice, logger)
-    else:
-        dump_records_multiprocess(args.datasets_file, args.compression_enabled, dbservice_cfg,
-                                  index_service_cfg, args.parallel_processes, logger)
+    with dbservice.bulk_ingest(replicas=args.ingest_replicas):
+        if args.parallel_processes == 1:
+            dump_records(args.datasets_file, args.compression_enabled, dbservice, logger)
+        else:
+            dump_records_multiprocess(args.datasets_file, args.compression_enabled, dbservice_cfg,
+                                      index_service_cfg, args.parallel_processes, logger)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
\ No newline at end of file
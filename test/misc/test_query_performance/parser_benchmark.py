@@ -0,0 +1,53 @@
+import argparse, sys, time, json
+
+from pyehr.aql.parser import Parser
+from pyehr.utils import get_logger, decode_dict
+
+
+def get_parser():
+    parser = argparse.ArgumentParser('Measure AQL parsing times')
+    parser.add_argument('--queries_file', type=str, required=True,
+                        help='The JSON file with queries definitions')
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='The number of times each query will be parsed (default 1000)')
+    parser.add_argument('--log_file', type=str, help='LOG file (default=stderr)')
+    parser.add_argument('--log_level', type=str, default='INFO',
+                        help='LOG level (default=INFO)')
+    return parser
+
+
+def load_queries(queries_file):
+    with open(queries_file) as f:
+        queries = decode_dict(json.loads(f.read()))
+    for q, conf in queries.iteritems():
+        if isinstance(conf['query'], list):
+            conf['query'] = ' '.join(conf['query'])
+    return queries
+
+
+def parse_query(query_parser, query, iterations):
+    start_time = time.time()
+    for _ in xrange(iterations):
+        query_parser.parse(query)
+    return (time.time() - start_time) / iterations
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    logger = get_logger('parser_benchmark', log_level=args.log_level, log_file=args.log_file)
+
+    logger.info('Loading queries from file %s' % args.queries_file)
+    queries = load_queries(args.queries_file)
+    logger.info('Loaded %d queries' % len(queries))
+
+    query_parser = Parser()
+    total_time = 0
+    for query_label, query_conf in sorted(queries.iteritems()):
+        parse_time = parse_query(query_parser, query_conf['query'], args.iterations)
+        total_time += parse_time
+        logger.info('Query "%s" parsed in %f microseconds' % (query_label, parse_time * 10**6))
+    logger.info('Average parsing time: %f microseconds' % ((total_time / len(queries)) * 10**6))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
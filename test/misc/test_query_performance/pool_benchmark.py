@@ -0,0 +1,83 @@
+import argparse, sys, time, json
+
+from pyehr.ehr.services.dbmanager.querymanager import QueryManager
+from pyehr.utils.services import get_service_configuration
+from pyehr.utils import get_logger, decode_dict
+
+
+def get_parser():
+    parser = argparse.ArgumentParser('Compare multi-process queries executed with a persistent pool '
+                                     'against queries that create a new pool each time and against '
+                                     'multi-thread queries')
+    parser.add_argument('--queries_file', type=str, required=True,
+                        help='The JSON file with queries definitions')
+    parser.add_argument('--pyehr_config', type=str, required=True,
+                        help='pyEHR config file')
+    parser.add_argument('--processes', type=str, default='1,2,4,8',
+                        help='A comma separated list with the numbers of processes that will be tested '
+                             '(default 1,2,4,8)')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='The number of times each query will be executed (default 10)')
+    parser.add_argument('--log_file', type=str, help='LOG file (default=stderr)')
+    parser.add_argument('--log_level', type=str, default='INFO',
+                        help='LOG level (default=INFO)')
+    return parser
+
+
+def get_query_manager(conf_file, persistent_pool):
+    cfg = get_service_configuration(conf_file)
+    dbcfg = cfg.get_db_configuration()
+    icfg = cfg.get_index_configuration()
+    qm = QueryManager(persistent_pool=persistent_pool, **dbcfg)
+    qm.set_index_service(**icfg)
+    return qm
+
+
+def load_queries(queries_file):
+    with open(queries_file) as f:
+        queries = decode_dict(json.loads(f.read()))
+    for q, conf in queries.iteritems():
+        if isinstance(conf['query'], list):
+            conf['query'] = ' '.join(conf['query'])
+    return queries
+
+
+def run_query(qmanager, query, query_params, query_processes, query_threads, iterations):
+    start_time = time.time()
+    for _ in xrange(iterations):
+        qmanager.execute_aql_query(query, query_params, query_processes=query_processes,
+                                   query_threads=query_threads)
+    return (time.time() - start_time) / iterations
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    logger = get_logger('pool_benchmark', log_level=args.log_level, log_file=args.log_file)
+
+    logger.info('Loading queries from file %s' % args.queries_file)
+    queries = load_queries(args.queries_file)
+    logger.info('Loaded %d queries' % len(queries))
+
+    processes = [int(p) for p in args.processes.split(',')]
+    query_managers = {
+        'persistent pool': get_query_manager(args.pyehr_config, True),
+        'new pool per query': get_query_manager(args.pyehr_config, False)
+    }
+    try:
+        for query_label, query_conf in sorted(queries.iteritems()):
+            for p in processes:
+                for pool_label, qm in sorted(query_managers.iteritems()):
+                    query_time = run_query(qm, query_conf['query'], query_conf.get('query_params'),
+                                           p, 1, args.iterations)
+                    logger.info('Query "%s" --- %d processes --- %s: %f seconds' %
+                                (query_label, p, pool_label, query_time))
+                query_time = run_query(query_managers['persistent pool'], query_conf['query'],
+                                       query_conf.get('query_params'), 1, p, args.iterations)
+                logger.info('Query "%s" --- %d threads: %f seconds' % (query_label, p, query_time))
+    finally:
+        for qm in query_managers.itervalues():
+            qm.shutdown()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
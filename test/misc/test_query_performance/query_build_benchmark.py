@@ -0,0 +1,84 @@
+import argparse, sys, time, json
+
+from pyehr.ehr.services.dbmanager.querymanager import QueryManager, Parser
+from pyehr.utils.services import get_service_configuration
+from pyehr.utils import get_logger, decode_dict
+
+
+def get_parser():
+    parser = argparse.ArgumentParser('Measure the time needed by the driver to build database queries '
+                                     'from AQL queries (queries are not executed)')
+    parser.add_argument('--queries_file', type=str, required=True,
+                        help='The JSON file with queries definitions')
+    parser.add_argument('--pyehr_config', type=str, required=True,
+                        help='pyEHR config file')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='The number of times each query will be built (default 100)')
+    parser.add_argument('--log_file', type=str, help='LOG file (default=stderr)')
+    parser.add_argument('--log_level', type=str, default='INFO',
+                        help='LOG level (default=INFO)')
+    return parser
+
+
+def get_query_manager(conf_file):
+    cfg = get_service_configuration(conf_file)
+    dbcfg = cfg.get_db_configuration()
+    icfg = cfg.get_index_configuration()
+    qm = QueryManager(**dbcfg)
+    qm.set_index_service(**icfg)
+    return qm
+
+
+def load_queries(queries_file):
+    with open(queries_file) as f:
+        queries = decode_dict(json.loads(f.read()))
+    for q, conf in queries.iteritems():
+        if isinstance(conf['query'], list):
+            conf['query'] = ' '.join(conf['query'])
+    return queries
+
+
+def get_index_service_time(driver, query_model, iterations):
+    start_time = time.time()
+    for _ in xrange(iterations):
+        driver.index_service.map_aql_contains(query_model.location.containers)
+    return (time.time() - start_time) / iterations
+
+
+def build_query(qmanager, driver, query_model, query_params, iterations):
+    start_time = time.time()
+    for _ in xrange(iterations):
+        queries = driver.build_queries(query_model, qmanager.patients_repository,
+                                       qmanager.ehr_repository, query_params)
+        driver._aggregate_queries(queries)
+    return (time.time() - start_time) / iterations
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    logger = get_logger('query_build_benchmark', log_level=args.log_level, log_file=args.log_file)
+
+    logger.info('Loading queries from file %s' % args.queries_file)
+    queries = load_queries(args.queries_file)
+    logger.info('Loaded %d queries' % len(queries))
+
+    qmanager = get_query_manager(args.pyehr_config)
+    query_parser = Parser()
+    drf = qmanager._get_drivers_factory(qmanager.ehr_repository)
+    # queries are only built, the driver doesn't need a connection
+    driver = drf.get_driver()
+    total_time = 0
+    for query_label, query_conf in sorted(queries.iteritems()):
+        query_model = query_parser.parse(query_conf['query'])
+        index_time = get_index_service_time(driver, query_model, args.iterations)
+        build_time = build_query(qmanager, driver, query_model, query_conf.get('query_params'),
+                                 args.iterations)
+        total_time += build_time - index_time
+        logger.info('Query "%s" built in %f microseconds (%f microseconds spent by the index service)' %
+                    (query_label, build_time * 10**6, index_time * 10**6))
+    logger.info('Average build time (index service excluded): %f microseconds' %
+                ((total_time / len(queries)) * 10**6))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
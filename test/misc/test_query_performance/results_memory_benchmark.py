@@ -0,0 +1,97 @@
+import argparse, sys
+from itertools import izip
+
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
+    ResultColumnDef, ResultRow, MissingValue
+from pyehr.utils import get_logger
+
+
+def get_parser():
+    parser = argparse.ArgumentParser('Measure the memory used to store query results')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='The number of rows of the result set (default 100000)')
+    parser.add_argument('--columns', type=int, default=4,
+                        help='The number of selected columns (default 4)')
+    parser.add_argument('--log_file', type=str, help='LOG file (default=stderr)')
+    parser.add_argument('--log_level', type=str, default='INFO',
+                        help='LOG level (default=INFO)')
+    return parser
+
+
+def get_size(obj, seen=None):
+    # approximate the memory used by obj and by all the objects it references
+    seen = seen or set()
+    if id(obj) in seen or obj is MissingValue:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(get_size(k, seen) + get_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(get_size(x, seen) for x in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(get_size(getattr(obj, s), seen) for s in obj.__slots__)
+    elif hasattr(obj, '__dict__'):
+        size += get_size(obj.__dict__, seen)
+    return size
+
+
+def build_document(columns, value):
+    doc = {'ehr_data': {'archetype_details': {}}}
+    for c in xrange(columns):
+        doc['ehr_data']['archetype_details']['at%04d' % c] = [{'value': {'magnitude': value + c}}]
+    return doc
+
+
+def split_results(query_result):
+    # the way rows were built before compact rows were introduced
+    for key, value in query_result.iteritems():
+        if isinstance(value, dict):
+            for k, v in split_results(value):
+                yield '{}.{}'.format(key, k), v
+        elif isinstance(value, list):
+            for element in value:
+                for k, v in split_results(element):
+                    yield '{}.{}'.format(key, k), v
+        else:
+            yield key, value
+
+
+def get_path_value(document, path_keys):
+    for k in path_keys:
+        if isinstance(document, list):
+            document = document[-1]
+        document = document[k]
+    return document
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    logger = get_logger('results_memory_benchmark', log_level=args.log_level, log_file=args.log_file)
+
+    paths = tuple('ehr_data.archetype_details.at%04d.value.magnitude' % c for c in xrange(args.columns))
+    paths_keys = [p.split('.') for p in paths]
+    logger.info('Building %d rows with %d columns' % (args.rows, args.columns))
+    dict_rows = list()
+    compact_rows = list()
+    for i in xrange(args.rows):
+        doc = build_document(args.columns, i)
+        dict_rows.append(dict(split_results(doc)))
+        compact_rows.append(ResultRow.from_values(paths, tuple(get_path_value(doc, pk) for pk in paths_keys)))
+    results = ResultSet()
+    for c, p in enumerate(paths):
+        results.add_column_definition(ResultColumnDef('col%d' % c, p))
+    for r in compact_rows:
+        results.add_row(r)
+    # safety check
+    for d, r in izip(dict_rows, compact_rows):
+        assert d == r.record
+
+    for label, obj in (('dict rows', dict_rows), ('compact rows', compact_rows),
+                       ('columnar result set', results)):
+        size = get_size(obj)
+        logger.info('%s: %d bytes (%.1f bytes per row)' % (label, size, float(size) / args.rows))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
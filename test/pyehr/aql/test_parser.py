@@ -0,0 +1,81 @@
+import unittest
+from pyehr.aql.parser import Parser
+from pyehr.aql.model import ArchetypePredicate, ConditionSequence, ConditionOperator, PredicateExpression
+from pyehr.aql.errors import ParsingError
+
+
+class TestParser(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestParser, self).__init__(label)
+
+    def setUp(self):
+        self.parser = Parser()
+
+    def test_parse_clauses(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        """
+        query_model = self.parser.parse(query)
+        self.assertEqual(' '.join(self.parser.selection.split()),
+                         'o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic')
+        self.assertEqual(' '.join(self.parser.location.split()),
+                         'Ehr e CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]')
+        self.assertEqual(' '.join(self.parser.condition.split()),
+                         'o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180')
+        self.assertIsNone(self.parser.order_rules)
+        self.assertIsNone(self.parser.time_constraints)
+        self.assertEqual(len(query_model.selection.variables), 1)
+        self.assertEqual(query_model.selection.variables[0].label, 'systolic')
+        self.assertEqual(query_model.selection.variables[0].variable.variable, 'o')
+
+    def test_parse_location(self):
+        query = """
+        select e/ehr_id/value
+        from Ehr e[ehr_id/value=$ehrUid]
+        contains Composition c[openEHR-EHR-COMPOSITION.encounter.v1]
+        contains Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        query_model = self.parser.parse(query)
+        self.assertEqual(query_model.location.class_expression.variable_name, 'e')
+        containers = query_model.location.containers
+        self.assertEqual([c.class_expression.variable_name for c in containers], ['c', 'o'])
+        for c in containers:
+            self.assertIsInstance(c.class_expression.predicate, ArchetypePredicate)
+        self.assertEqual([c.class_expression.predicate.archetype_id for c in containers],
+                         ['openEHR-EHR-COMPOSITION.encounter.v1', 'openEHR-EHR-OBSERVATION.blood_pressure.v1'])
+
+    def test_parse_condition(self):
+        query = """
+        SELECT e/ehr_id/value
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/value/magnitude >= 180 OR o/data[at0002]/value/magnitude != 110
+        """
+        condition = self.parser.parse(query).condition.condition
+        self.assertIsInstance(condition, ConditionSequence)
+        self.assertEqual([type(c) for c in condition.condition_sequence],
+                         [PredicateExpression, ConditionOperator, PredicateExpression])
+        self.assertEqual(condition.condition_sequence[1].op, 'OR')
+        self.assertEqual(condition.condition_sequence[2].operand, '!=')
+        self.assertEqual(condition.condition_sequence[2].right_operand, '110')
+
+    def test_invalid_statements(self):
+        self.assertRaises(ParsingError, self.parser.parse, 'e/ehr_id/value FROM Ehr e')
+        self.assertRaises(ParsingError, self.parser.parse, 'SELECT e/ehr_id/value')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestParser('test_parse_clauses'))
+    suite.addTest(TestParser('test_parse_location'))
+    suite.addTest(TestParser('test_parse_condition'))
+    suite.addTest(TestParser('test_invalid_statements'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
@@ -126,6 +126,28 @@ class TestDBServices(unittest.TestCase):
         # cleanup
         dbs.delete_patient(pat_rec, cascade_delete=True)
 
+    def test_iter_patients(self):
+        dbs = DBServices(**self.conf)
+        dbs.set_index_service(**self.index_conf)
+        patients = list()
+        for x in xrange(5):
+            pat_rec = dbs.save_patient(self.create_random_patient())
+            arch = ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                                     {'ehr_field': 'ehr_value%02d' % x})
+            _, pat_rec = dbs.save_ehr_record(ClinicalRecord(arch), pat_rec)
+            patients.append(pat_rec)
+        patients_ids = set(p.record_id for p in patients)
+        loaded_patients = [p for p in dbs.iter_patients(batch_size=2) if p.record_id in patients_ids]
+        self.assertEqual(len(loaded_patients), 5)
+        for p in loaded_patients:
+            self.assertEqual(len(p.ehr_records), 1)
+            self.assertNotEqual(len(p.ehr_records[0].ehr_data.archetype_details), 0)
+        self.assertEqual(sorted(p.record_id for p in loaded_patients),
+                         sorted(p.record_id for p in dbs.get_patients() if p.record_id in patients_ids))
+        # cleanup
+        for p in patients:
+            dbs.delete_patient(p, cascade_delete=True)
+
     def _get_active_records_count(self, patient_record, counter):
         for ehr in patient_record.ehr_records:
             if ehr.active:
@@ -228,6 +250,7 @@ def suite():
     suite.addTest(TestDBServices('test_save_ehr_records'))
     suite.addTest(TestDBServices('test_remove_ehr_record'))
     suite.addTest(TestDBServices('test_load_ehr_records'))
+    suite.addTest(TestDBServices('test_iter_patients'))
     suite.addTest(TestDBServices('test_hide_ehr_record'))
     suite.addTest(TestDBServices('test_move_ehr_record'))
     suite.addTest(TestDBServices('test_get_ehr_record'))
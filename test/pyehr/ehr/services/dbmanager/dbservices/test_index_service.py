@@ -1,10 +1,115 @@
-import unittest, os
+import unittest, sys, os, re, logging
+from uuid import uuid4
 from lxml import etree
+from hashlib import md5
+from copy import deepcopy
 from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+from pyehr.utils.services import get_service_configuration
+from pyehr.aql.parser import Parser
+import pybasex.errors as pbx_errors
 
 CONF_FILE = os.getenv('SERVICE_CONFIG_FILE')
 
 
+class StubIndexService(IndexService):
+    """
+    IndexService with an in-memory stand-in for the BaseX client, it only understands
+    the queries used to resolve and create structures, to update references counters
+    and to handle the index generation.
+    Services built with the same *documents* dictionary share the same database.
+    """
+
+    def __init__(self, documents, **kwargs):
+        super(StubIndexService, self).__init__('test_db', 'http://localhost:8984',
+                                               'admin', 'admin', **kwargs)
+        self.documents = documents
+        self.queries = list()
+
+    def _call_client(self, method_name, *args, **kwargs):
+        return getattr(self, '_stub_%s' % method_name)(*args, **kwargs)
+
+    def _stub_add_document(self, document, document_id):
+        if document_id in self.documents:
+            raise pbx_errors.OverwriteError('Document %s already exists' % document_id)
+        self.documents[document_id] = document
+
+    def _stub_delete_database(self):
+        self.documents.clear()
+
+    def _stub_bump_generation(self):
+        generation = self.documents.get(self.GENERATION_DOCUMENT)
+        if generation is not None:
+            generation.set('value', str(int(generation.get('value')) + 1))
+
+    def _stub_execute_query(self, query):
+        self.queries.append(query)
+        results = etree.Element('results')
+        if query == self._build_generation_query():
+            generation = self.documents.get(self.GENERATION_DOCUMENT)
+            if generation is not None:
+                results.text = '%s:%s' % (generation.get('epoch'), generation.get('value'))
+        elif query == self._build_generation_update():
+            self._stub_bump_generation()
+        elif query.startswith('(db:add('):
+            for document, document_id in re.findall(r'db:add\("%s", parse-xml\("([^"]*)"\), "(\w+)"\)' %
+                                                    self.db, query):
+                self.documents[document_id] = etree.fromstring(
+                    document.replace('&quot;', '"').replace('&amp;', '&')
+                )
+            if self._build_generation_update() in query:
+                self._stub_bump_generation()
+        elif query.startswith('(for $u in'):
+            # a batch of counters updates returning the missing structures, the updates
+            # are applied at the end of the query
+            for str_id in re.findall(r'"(\w+)"', query.split(' where ')[0]):
+                if str_id not in self.documents:
+                    etree.SubElement(results, 'structure', {'uid': str_id})
+            counter_updates = re.findall(r'db:open\("%s", "(\w+)"\)/archetype_structure\s+'
+                                         r'let \$hits := xs:integer\(\$s/references_counter/@hits\) '
+                                         r'\+ (-?\d+)' % self.db, query)
+            for str_id, delta in counter_updates:
+                doc = self.documents.get(str_id)
+                if doc is not None:
+                    hits = int(doc.find('references_counter').get('hits')) + int(delta)
+                    if hits <= 0:
+                        del self.documents[str_id]
+                    else:
+                        doc.find('references_counter').set('hits', str(hits))
+            if self._build_generation_update() in query:
+                self._stub_bump_generation()
+        elif query.startswith('/archetype_structure/structure_id[@str_hash=('):
+            hashes = re.findall(r'"(\w+)"', query)
+            for doc in self.documents.values():
+                structure_id = doc.find('structure_id')
+                if structure_id is not None and structure_id.get('str_hash') in hashes:
+                    results.append(deepcopy(structure_id))
+        elif query.startswith('/archetype_structure//'):
+            # CONTAINS statements are plain XPath queries evaluated on each structure
+            for doc in self.documents.values():
+                for node in etree.ElementTree(doc).xpath(query):
+                    results.append(deepcopy(node))
+        else:
+            raise AssertionError('Unexpected query %s' % query)
+        return results
+
+    def disconnect(self):
+        pass
+
+
+def get_ehr_record(archetype_class):
+    return {
+        'archetype_class': archetype_class,
+        'archetype_details': {
+            'data': {
+                'at0001': {
+                    'archetype_class': 'test-openehr-OBSERVATION.test02.v1',
+                    'archetype_details': {}
+                }
+            }
+        }
+    }
+
+
 class TestIndexService(unittest.TestCase):
 
     def __init__(self, label):
@@ -126,6 +231,296 @@ class TestIndexService(unittest.TestCase):
         ehr_structure_2 = etree.tostring(IndexService.get_structure(ehr_record_2))
         self.assertEqual(ehr_structure_1, ehr_structure_2)
 
+    def test_structure_serialization(self):
+        ehr_record = {
+            'archetype_class': 'test-openehr-COMPOSITION.test01.v1',
+            'archetype_details': {
+                'content': [
+                    {
+                        'archetype_class': 'test-openehr-OBSERVATION.test02.v1',
+                        'archetype_details': {
+                            'data': {
+                                'at0001': {
+                                    'archetype_class': 'test-openehr-CLUSTER.test%02d.v1' % (i % 3),
+                                    'archetype_details': {'at0002': i}
+                                }
+                            }
+                        }
+                    } for i in xrange(10)
+                ],
+                'context': {
+                    'at0003': {
+                        'archetype_class': 'test-openehr-CLUSTER.test&"special"<chars>.v1',
+                        'archetype_details': {}
+                    }
+                }
+            }
+        }
+        serialized_structure = IndexService.serialize_structure(ehr_record)
+        self.assertEqual(serialized_structure, etree.tostring(IndexService.get_structure(ehr_record)))
+        # duplicated structures in the list are removed
+        self.assertEqual(serialized_structure.count('test-openehr-OBSERVATION.test02.v1'), 3)
+        self.assertEqual(IndexService.get_structure_hash(serialized_structure),
+                         md5(etree.tostring(IndexService.get_structure(ehr_record))).hexdigest())
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = list()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def get_recording_logger():
+    logger = logging.getLogger('test_index_service_%s' % uuid4().hex)
+    logger.propagate = False
+    handler = ListHandler()
+    logger.addHandler(handler)
+    return logger, handler
+
+
+class TestIndexServiceCaches(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestIndexServiceCaches, self).__init__(label)
+
+    def test_structure_ids_cache(self):
+        documents = dict()
+        index_service = StubIndexService(documents)
+        ehr_record = get_ehr_record('test-openehr-OBSERVATION.test01.v1')
+        str_id = index_service.get_structure_id(ehr_record)
+        self.assertIn(str_id, documents)
+        self.assertEqual(index_service.get_structure_id(ehr_record), str_id)
+        self.assertEqual(index_service.cache_stats['hits'], 1)
+        # structures created by this instance don't invalidate the cache
+        index_service.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test03.v1'))
+        self.assertEqual(len(index_service.structures_cache), 2)
+        self.assertEqual(index_service.get_structure_id(ehr_record), str_id)
+        self.assertEqual(index_service.cache_stats['hits'], 2)
+        # cache hits within the generation check interval don't query BaseX
+        queries_count = len(index_service.queries)
+        for _ in xrange(10):
+            self.assertEqual(index_service.get_structure_id(ehr_record), str_id)
+        self.assertEqual(len(index_service.queries), queries_count)
+
+    def test_structure_ids_cache_invalidation(self):
+        documents = dict()
+        index_service = StubIndexService(documents, generation_check_interval=0)
+        other_index_service = StubIndexService(documents)
+        ehr_record = get_ehr_record('test-openehr-OBSERVATION.test01.v1')
+        str_id = index_service.get_structure_id(ehr_record)
+        # the structure is deleted by another process
+        del documents[str_id]
+        other_index_service._bump_index_generation()
+        new_str_id = index_service.get_structure_id(ehr_record)
+        self.assertNotEqual(new_str_id, str_id)
+        self.assertIn(new_str_id, documents)
+
+    def test_structure_ids_cache_missing_structure(self):
+        documents = dict()
+        index_service = StubIndexService(documents, generation_check_interval=60)
+        other_index_service = StubIndexService(documents)
+        ehr_record = get_ehr_record('test-openehr-OBSERVATION.test01.v1')
+        str_id = index_service.get_structure_id(ehr_record)
+        del documents[str_id]
+        other_index_service._bump_index_generation()
+        # the change is not detected within the interval...
+        self.assertEqual(index_service.get_structure_id(ehr_record), str_id)
+        # ...unless the structure is reported as missing
+        index_service.increase_structure_counter(str_id)
+        new_str_id = index_service.get_structure_id(ehr_record)
+        self.assertNotEqual(new_str_id, str_id)
+        self.assertIn(new_str_id, documents)
+
+    def test_index_generation_bump(self):
+        documents = dict()
+        reader = StubIndexService(documents)
+        reader._check_index_generation()
+        generation = reader._index_generation
+        # the generation is changed even if the CONTAINS cache of the writer is disabled
+        writer = StubIndexService(documents, contains_cache_size=0)
+        writer.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test01.v1'))
+        self.assertEqual(reader._read_index_generation(), '%s:1' % generation.split(':')[0])
+        # structures already known don't change the generation
+        writer.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test01.v1'))
+        self.assertEqual(reader._read_index_generation(), '%s:1' % generation.split(':')[0])
+
+    def test_index_generation_check(self):
+        documents = dict()
+        index_service = StubIndexService(documents, generation_check_interval=0)
+        other_index_service = StubIndexService(documents)
+        index_service.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test01.v1'))
+        index_service.contains_cache.put(('test-openehr-OBSERVATION.test01.v1',), {})
+        # changes made by this instance only invalidate the CONTAINS cache
+        index_service._bump_index_generation()
+        self.assertEqual(len(index_service.contains_cache), 0)
+        index_service.contains_cache.put(('test-openehr-OBSERVATION.test01.v1',), {})
+        index_service._check_index_generation()
+        self.assertEqual(len(index_service.contains_cache), 1)
+        self.assertEqual(len(index_service.structures_cache), 1)
+        # changes made by other processes invalidate both caches
+        other_index_service._bump_index_generation()
+        index_service._check_index_generation()
+        self.assertEqual(len(index_service.contains_cache), 0)
+        self.assertEqual(len(index_service.structures_cache), 0)
+
+    def test_contains_cache(self):
+        documents = dict()
+        index_service = StubIndexService(documents)
+        str_id = index_service.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test01.v1'))
+        containers = Parser().parse("""
+        SELECT o/data[at0001]/value AS value
+        FROM Ehr e
+        CONTAINS Observation o[test-openehr-OBSERVATION.test01.v1]
+        CONTAINS Observation o2[test-openehr-OBSERVATION.test02.v1]
+        """).location.containers
+        structures_map, variables_map = index_service.map_aql_contains(containers)
+        self.assertEqual(structures_map.keys(), [str_id])
+        # cached results within the generation check interval don't query BaseX
+        queries_count = len(index_service.queries)
+        for _ in xrange(10):
+            self.assertEqual(index_service.map_aql_contains(containers), (structures_map, variables_map))
+        self.assertEqual(len(index_service.queries), queries_count)
+        self.assertEqual(index_service.contains_cache_stats['hits'], 10)
+        # structures created by this instance are always taken into account
+        ehr_record = get_ehr_record('test-openehr-OBSERVATION.test01.v1')
+        ehr_record['archetype_details']['data']['at0002'] = ehr_record['archetype_details']['data'].pop('at0001')
+        other_str_id = index_service.get_structure_id(ehr_record)
+        self.assertEqual(sorted(index_service.map_aql_contains(containers)[0].keys()),
+                         sorted([str_id, other_str_id]))
+
+    def test_index_generation_check_interval(self):
+        documents = dict()
+        index_service = StubIndexService(documents, generation_check_interval=60)
+        other_index_service = StubIndexService(documents)
+        index_service.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test01.v1'))
+        other_index_service._bump_index_generation()
+        # the generation is not read again until the interval expires
+        index_service._check_index_generation()
+        self.assertEqual(len(index_service.structures_cache), 1)
+        index_service._generation_checked_at -= 60
+        index_service._check_index_generation()
+        self.assertEqual(len(index_service.structures_cache), 0)
+
+    def test_structure_counters(self):
+        documents = dict()
+        index_service = StubIndexService(documents)
+        str_id = index_service.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test01.v1'))
+        hits = lambda: int(documents[str_id].find('references_counter').get('hits'))
+        self.assertEqual(index_service.update_structure_counters({str_id: 2}), [])
+        self.assertEqual(hits(), 2)
+        index_service.decrease_structure_counter(str_id)
+        self.assertEqual(hits(), 1)
+        index_service.check_structure_counter(str_id)
+        self.assertEqual(hits(), 1)
+        index_service.decrease_structure_counter(str_id)
+        self.assertNotIn(str_id, documents)
+        self.assertEqual(len(index_service.structures_cache), 0)
+
+    def test_structure_counters_missing_id(self):
+        documents = dict()
+        logger, handler = get_recording_logger()
+        index_service = StubIndexService(documents, logger=logger)
+        str_id = index_service.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test01.v1'))
+        missing_id = uuid4().hex
+        del index_service.queries[:]
+        self.assertEqual(index_service.update_structure_counters({str_id: 1, missing_id: -1}), [missing_id])
+        # missing structures are returned by the update query itself
+        self.assertEqual(len(index_service.queries), 1)
+        self.assertEqual(handler.messages, ['There is no document with structure ID %s' % missing_id])
+        self.assertEqual(int(documents[str_id].find('references_counter').get('hits')), 1)
+        # checking a missing structure is not an error
+        self.assertEqual(index_service.update_structure_counters({missing_id: 0}), [missing_id])
+        self.assertEqual(len(handler.messages), 1)
+
+    def test_structures_insert(self):
+        documents = dict()
+        index_service = StubIndexService(documents)
+        ehr_records = [get_ehr_record('test-openehr-OBSERVATION.test01.v1'),
+                       get_ehr_record('test-openehr-OBSERVATION.test"01".v1 & <test02>')]
+        index_service._check_index_generation()
+        generation = index_service._index_generation
+        del index_service.queries[:]
+        str_ids = index_service.get_structure_ids(ehr_records)
+        # all the new structures are saved, and the generation changed, with a single query
+        self.assertEqual(len(index_service.queries), 2)
+        self.assertTrue(index_service.queries[1].startswith('(db:add('))
+        self.assertEqual(index_service._read_index_generation(), '%s:1' % generation.split(':')[0])
+        for ehr_record, str_id in zip(ehr_records, str_ids):
+            structure = documents[str_id].find('archetype')
+            self.assertEqual(etree.tostring(structure), IndexService.serialize_structure(ehr_record))
+            self.assertEqual(documents[str_id].find('references_counter').get('hits'), '0')
+
+    def test_delete_index(self):
+        documents = dict()
+        index_service = StubIndexService(documents)
+        ehr_record = get_ehr_record('test-openehr-OBSERVATION.test01.v1')
+        str_id = index_service.get_structure_id(ehr_record)
+        index_service.delete_index()
+        self.assertEqual(len(documents), 0)
+        self.assertEqual(len(index_service.structures_cache), 0)
+        self.assertNotEqual(index_service.get_structure_id(ehr_record), str_id)
+
+
+class TestIndexServiceServer(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestIndexServiceServer, self).__init__(label)
+
+    def setUp(self):
+        if CONF_FILE is None:
+            sys.exit('ERROR: no configuration file provided')
+        index_conf = get_service_configuration(CONF_FILE).get_index_configuration()
+        if index_conf['engine'] != 'basex':
+            self.skipTest('a BaseX index service is required')
+        self.index_service = IndexService('%s_%s' % (index_conf['database'], uuid4().hex[:8]),
+                                          index_conf['url'], index_conf['user'], index_conf['passwd'])
+        self.str_id = self.index_service.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test01.v1'))
+
+    def tearDown(self):
+        self.index_service.delete_index()
+
+    def _get_hits(self):
+        doc = self.index_service._get_structure_by_id(self.str_id)
+        self.index_service.disconnect()
+        if doc is None:
+            return None
+        return int(doc.find('references_counter').get('hits'))
+
+    def test_increase_structure_counter(self):
+        self.index_service.increase_structure_counter(self.str_id, 2)
+        self.assertEqual(self._get_hits(), 2)
+        self.index_service.update_structure_counters({self.str_id: 3})
+        self.assertEqual(self._get_hits(), 5)
+
+    def test_decrease_structure_counter(self):
+        self.index_service.increase_structure_counter(self.str_id, 2)
+        self.index_service.decrease_structure_counter(self.str_id)
+        self.assertEqual(self._get_hits(), 1)
+        self.index_service.decrease_structure_counter(self.str_id)
+        self.assertIsNone(self._get_hits())
+
+    def test_check_structure_counter(self):
+        self.index_service.increase_structure_counter(self.str_id)
+        self.index_service.check_structure_counter(self.str_id)
+        self.assertEqual(self._get_hits(), 1)
+        self.index_service.decrease_structure_counter(self.str_id)
+        self.index_service.check_structure_counter(self.str_id)
+        self.assertIsNone(self._get_hits())
+        # a structure with a counter equal to 0 is deleted by the check
+        str_id = self.index_service.get_structure_id(get_ehr_record('test-openehr-OBSERVATION.test03.v1'))
+        self.index_service.check_structure_counter(str_id)
+        self.assertEqual(self.index_service.update_structure_counters({str_id: 0}), [str_id])
+
+    def test_missing_structure(self):
+        missing_id = uuid4().hex
+        self.assertEqual(self.index_service.update_structure_counters({self.str_id: 1, missing_id: -1}),
+                         [missing_id])
+        self.assertEqual(self._get_hits(), 1)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -133,6 +528,22 @@ def suite():
     suite.addTest(TestIndexService('test_structure_dict'))
     suite.addTest(TestIndexService('test_structure_list'))
     suite.addTest(TestIndexService('test_structure_sorting'))
+    suite.addTest(TestIndexService('test_structure_serialization'))
+    suite.addTest(TestIndexServiceCaches('test_structure_ids_cache'))
+    suite.addTest(TestIndexServiceCaches('test_structure_ids_cache_invalidation'))
+    suite.addTest(TestIndexServiceCaches('test_structure_ids_cache_missing_structure'))
+    suite.addTest(TestIndexServiceCaches('test_index_generation_bump'))
+    suite.addTest(TestIndexServiceCaches('test_index_generation_check'))
+    suite.addTest(TestIndexServiceCaches('test_contains_cache'))
+    suite.addTest(TestIndexServiceCaches('test_index_generation_check_interval'))
+    suite.addTest(TestIndexServiceCaches('test_structure_counters'))
+    suite.addTest(TestIndexServiceCaches('test_structure_counters_missing_id'))
+    suite.addTest(TestIndexServiceCaches('test_structures_insert'))
+    suite.addTest(TestIndexServiceCaches('test_delete_index'))
+    suite.addTest(TestIndexServiceServer('test_increase_structure_counter'))
+    suite.addTest(TestIndexServiceServer('test_decrease_structure_counter'))
+    suite.addTest(TestIndexServiceServer('test_check_structure_counter'))
+    suite.addTest(TestIndexServiceServer('test_missing_structure'))
     return suite
 
 if __name__ == '__main__':
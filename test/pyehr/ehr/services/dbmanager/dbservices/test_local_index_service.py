@@ -0,0 +1,143 @@
+import unittest, os, shutil, tempfile
+from pyehr.ehr.services.dbmanager.dbservices.local_index_service import LocalIndexService
+from pyehr.aql.parser import Parser
+
+
+class TestLocalIndexService(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestLocalIndexService, self).__init__(label)
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.index_service = LocalIndexService(os.path.join(self.index_dir, 'test_index.json'))
+
+    def tearDown(self):
+        self.index_service.delete_index()
+        shutil.rmtree(self.index_dir)
+
+    def _get_record(self, leaf_class='openEHR-EHR-OBSERVATION.blood_pressure.v1'):
+        return {
+            'archetype_class': 'openEHR-EHR-COMPOSITION.encounter.v1',
+            'archetype_details': {
+                'content': [
+                    {
+                        'archetype_class': leaf_class,
+                        'archetype_details': {}
+                    }
+                ]
+            }
+        }
+
+    def _get_containers(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Composition c[openEHR-EHR-COMPOSITION.encounter.v1]
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        return Parser().parse(query).location.containers
+
+    def test_get_structure_id(self):
+        str_id_1 = self.index_service.get_structure_id(self._get_record())
+        str_id_2 = self.index_service.get_structure_id(self._get_record())
+        str_id_3 = self.index_service.get_structure_id(self._get_record('openEHR-EHR-OBSERVATION.heart_rate.v1'))
+        self.assertEqual(str_id_1, str_id_2)
+        self.assertNotEqual(str_id_1, str_id_3)
+        self.assertEqual(self.index_service.get_structure_ids([self._get_record()] * 3), [str_id_1] * 3)
+
+    def test_structure_counters(self):
+        str_id = self.index_service.get_structure_id(self._get_record())
+        self.index_service.increase_structure_counter(str_id, 2)
+        self.index_service.check_structure_counter(str_id)
+        self.assertIn(str_id, self.index_service.structures)
+        self.index_service.decrease_structure_counter(str_id)
+        self.assertIn(str_id, self.index_service.structures)
+        self.index_service.decrease_structure_counter(str_id)
+        self.assertNotIn(str_id, self.index_service.structures)
+        self.assertEqual(self.index_service.map_aql_contains(self._get_containers())[0], {})
+        # deleted structures are returned as missing
+        self.assertEqual(self.index_service.update_structure_counters({str_id: -1}), [str_id])
+
+    def test_unchanged_structure_counters(self):
+        index_service = LocalIndexService(self.index_service.index_file, max_pending_changes=100,
+                                          flush_interval=3600)
+        str_id = index_service.get_structure_id(self._get_record())
+        index_service.increase_structure_counter(str_id)
+        pending_changes = index_service._pending_changes
+        # checks of referenced structures and missing IDs don't change the index
+        index_service.check_structure_counter(str_id)
+        self.assertEqual(index_service.update_structure_counters({'a' * 32: -1, str_id: 0}), ['a' * 32])
+        self.assertEqual(index_service._pending_changes, pending_changes)
+        index_service.decrease_structure_counter(str_id)
+        self.assertEqual(index_service._pending_changes, pending_changes + 1)
+        index_service.disconnect()
+
+    def test_map_aql_contains(self):
+        str_id = self.index_service.get_structure_id(self._get_record())
+        _ = self.index_service.get_structure_id(self._get_record('openEHR-EHR-OBSERVATION.heart_rate.v1'))
+        structures_map, variables_map = self.index_service.map_aql_contains(self._get_containers())
+        self.assertEqual(structures_map, {
+            str_id: [{
+                'openEHR-EHR-COMPOSITION.encounter.v1': ['/'],
+                'openEHR-EHR-OBSERVATION.blood_pressure.v1': ['/', '/content']
+            }]
+        })
+        self.assertEqual(variables_map, {
+            'c': 'openEHR-EHR-COMPOSITION.encounter.v1',
+            'o': 'openEHR-EHR-OBSERVATION.blood_pressure.v1'
+        })
+
+    def test_persistence(self):
+        str_id = self.index_service.get_structure_id(self._get_record())
+        self.index_service.increase_structure_counter(str_id)
+        # pending changes are written on disconnect
+        self.index_service.disconnect()
+        index_service = LocalIndexService(self.index_service.index_file)
+        index_service.connect()
+        self.assertEqual(index_service.get_structure_id(self._get_record()), str_id)
+        self.assertEqual(index_service.structures[str_id].hits, 1)
+        self.assertEqual(index_service.map_aql_contains(self._get_containers()),
+                         self.index_service.map_aql_contains(self._get_containers()))
+
+
+    def test_batched_writes(self):
+        index_service = LocalIndexService(self.index_service.index_file, max_pending_changes=3,
+                                          flush_interval=3600)
+        str_id = index_service.get_structure_id(self._get_record())
+        index_service.increase_structure_counter(str_id)
+        self.assertFalse(os.path.exists(index_service.index_file))
+        index_service.increase_structure_counter(str_id)
+        self.assertTrue(os.path.exists(index_service.index_file))
+        index_service.increase_structure_counter(str_id)
+        self.index_service.connect()
+        self.assertEqual(self.index_service.structures[str_id].hits, 2)
+        index_service.disconnect()
+        self.index_service.connect()
+        self.assertEqual(self.index_service.structures[str_id].hits, 3)
+
+    def test_delete_index(self):
+        self.index_service.get_structure_id(self._get_record())
+        self.index_service.flush()
+        self.index_service.delete_index()
+        self.assertFalse(os.path.exists(self.index_service.index_file))
+        self.assertEqual(self.index_service.structures, {})
+        self.assertEqual(self.index_service.map_aql_contains(self._get_containers())[0], {})
+        # deleting an index never written is not an error
+        self.index_service.delete_index()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestLocalIndexService('test_get_structure_id'))
+    suite.addTest(TestLocalIndexService('test_structure_counters'))
+    suite.addTest(TestLocalIndexService('test_unchanged_structure_counters'))
+    suite.addTest(TestLocalIndexService('test_map_aql_contains'))
+    suite.addTest(TestLocalIndexService('test_persistence'))
+    suite.addTest(TestLocalIndexService('test_batched_writes'))
+    suite.addTest(TestLocalIndexService('test_delete_index'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
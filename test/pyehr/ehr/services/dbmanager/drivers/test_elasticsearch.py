@@ -51,6 +51,9 @@ class TestElasticSearchDriver(unittest.TestCase):
             for sid in saved_ids:
                 self.assertIn(sid, record_ids)
             self.assertEqual(driver.count(), 10)
+            # records are stored in the lookup table as well
+            for rid in record_ids:
+                self.assertEqual(driver._get_ids(rid)['ids'][0][0], rid)
             # cleanup
             for sid in saved_ids:
                 driver.delete_record(sid)
@@ -97,6 +100,72 @@ class TestElasticSearchDriver(unittest.TestCase):
             # cleanup
             driver.delete_record(rec_id)
 
+    def test_bulk_ingest(self):
+        records = [{'_id': str(x), 'field1': 'value1'} for x in xrange(0, 10)]
+        with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection') as driver:
+            with driver.bulk_ingest(replicas=0):
+                self.assertEqual(driver.refresh, 'false')
+                settings = driver.client.indices.get_settings(index=driver.database, flat_settings=True)
+                self.assertEqual(settings.values()[0]['settings']['index.refresh_interval'], '-1')
+                record_ids, _ = driver.add_records(records)
+            # settings restored and records available at exit
+            self.assertEqual(driver.refresh, 'true')
+            settings = driver.client.indices.get_settings(index=driver.database, flat_settings=True)
+            self.assertNotEqual(settings.values()[0]['settings'].get('index.refresh_interval'), '-1')
+            self.assertEqual(driver.count(), 10)
+            # cleanup
+            for rid in record_ids:
+                driver.delete_record(rid)
+
+    def _get_open_scrolls(self, driver):
+        stats = driver.client.nodes.stats(metric='indices', index_metric='search')
+        return sum(n['indices']['search']['scroll_current'] for n in stats['nodes'].itervalues())
+
+    def test_iter_records_by_query(self):
+        records = [{'_id': str(x), 'field1': 'value1'} for x in xrange(0, 25)]
+        query = {'query': {'match': {'field1': 'value1'}}}
+        with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection') as driver:
+            record_ids, _ = driver.add_records(records)
+            driver.threshold = 10
+            self.assertEqual(len(list(driver.iter_records_by_query(query))), 25)
+            self.assertEqual(self._get_open_scrolls(driver), 0)
+            # scroll contexts are released by generators closed before the last page as well
+            records_iter = driver.iter_records_by_query(query)
+            self.assertEqual(len([next(records_iter) for _ in xrange(0, 15)]), 15)
+            self.assertEqual(self._get_open_scrolls(driver), 1)
+            records_iter.close()
+            self.assertEqual(self._get_open_scrolls(driver), 0)
+            # cleanup
+            for rid in record_ids:
+                driver.delete_record(rid)
+
+    def test_bulk_chunks(self):
+        records = [{'_id': str(x), 'field1': 'value%d' % x} for x in xrange(0, 25)]
+        driver = ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection')
+        driver.BULK_CHUNK_SIZE = 10
+        chunks = list(driver._iter_bulk_chunks(records, False))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(''.join(chunks), driver.pack_records(records, False))
+        self.assertEqual(len(chunks[0].splitlines()), 20)
+        # chunks are limited by size as well
+        driver.BULK_MAX_CHUNK_BYTES = len(chunks[0]) / 2
+        self.assertEqual(len(list(driver._iter_bulk_chunks(records, False))), 6)
+
+    def test_bool_queries(self):
+        driver = ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection')
+        query = driver._map_operand('field1', '100', '=')
+        self.assertEqual(query, {'must': [{'match': {'field1': 100}}]})
+        driver._merge_bool_queries(query, driver._map_operand('field2', '10.5', '>='))
+        driver._merge_bool_queries(query, driver._map_operand('field3', 'value', '!='))
+        self.assertEqual(query, {
+            'must': [{'match': {'field1': 100}}, {'range': {'field2': {'gte': 10.5}}}],
+            'must_not': [{'match': {'field3': 'value'}}]
+        })
+        self.assertEqual(driver._get_structures_selector(['s1']),
+                         {'must': [{'term': {'ehr_structure_id': 's1'}}]})
+        self.assertEqual(driver._to_bool_clause(driver._map_operand('field3', 'value', '!=')),
+                         {'bool': {'must_not': [{'match': {'field3': 'value'}}]}})
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -107,6 +176,10 @@ def suite():
     suite.addTest(TestElasticSearchDriver('test_get_record_by_id'))
     suite.addTest(TestElasticSearchDriver('test_get_records_by_value'))
     suite.addTest(TestElasticSearchDriver('test_update_field'))
+    suite.addTest(TestElasticSearchDriver('test_bulk_ingest'))
+    suite.addTest(TestElasticSearchDriver('test_iter_records_by_query'))
+    suite.addTest(TestElasticSearchDriver('test_bulk_chunks'))
+    suite.addTest(TestElasticSearchDriver('test_bool_queries'))
     return suite
 
 if __name__ == '__main__':
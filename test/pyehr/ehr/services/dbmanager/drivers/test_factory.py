@@ -0,0 +1,107 @@
+import unittest, os, shutil, tempfile
+from multiprocessing import Pool
+
+from pyehr.ehr.services.dbmanager.drivers.factory import ClientsPool
+from pyehr.ehr.services.dbmanager.drivers.interface import get_worker_driver
+
+
+class TestClientsPool(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestClientsPool, self).__init__(label)
+
+    def setUp(self):
+        self.clients_pool = ClientsPool()
+        self.created_clients = list()
+
+    def _new_client(self):
+        client = object()
+        self.created_clients.append(client)
+        return client
+
+    def test_get_client(self):
+        client = self.clients_pool.get_client(('mongodb', 'localhost'), self._new_client)
+        self.assertIs(self.clients_pool.get_client(('mongodb', 'localhost'), self._new_client), client)
+        other_client = self.clients_pool.get_client(('mongodb', 'otherhost'), self._new_client)
+        self.assertIsNot(other_client, client)
+        self.assertEqual(len(self.created_clients), 2)
+        self.assertEqual(len(self.clients_pool), 2)
+
+    def test_discard_client(self):
+        client = self.clients_pool.get_client(('mongodb', 'localhost'), self._new_client)
+        self.assertTrue(self.clients_pool.discard_client(('mongodb', 'localhost')))
+        self.assertFalse(self.clients_pool.discard_client(('mongodb', 'localhost')))
+        self.assertIsNot(self.clients_pool.get_client(('mongodb', 'localhost'), self._new_client), client)
+
+    def test_forked_process(self):
+        client = self.clients_pool.get_client(('mongodb', 'localhost'), self._new_client)
+        # simulate a pool inherited from the parent process
+        self.clients_pool._pid = os.getpid() + 1
+        self.assertIsNot(self.clients_pool.get_client(('mongodb', 'localhost'), self._new_client), client)
+        self.assertEqual(len(self.clients_pool), 1)
+
+
+class FakeDriver(object):
+    """
+    A driver that records its disconnection creating a file named after its user in the
+    *host* directory
+    """
+
+    def __init__(self, host, database, collection, port, user, passwd):
+        self.host = host
+        self.user = user
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        open(os.path.join(self.host, self.user), 'w').close()
+
+
+def get_fake_worker_driver(args):
+    driver = get_worker_driver(FakeDriver, *args)
+    return id(driver), id(get_worker_driver(FakeDriver, *args)), os.getpid()
+
+
+class TestWorkerDrivers(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestWorkerDrivers, self).__init__(label)
+
+    def setUp(self):
+        self.drivers_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.drivers_dir)
+
+    def _get_args(self, user, passwd):
+        return self.drivers_dir, 'test_database', 'test_collection', None, user, passwd
+
+    def test_worker_drivers(self):
+        pool = Pool(1)
+        driver_id, cached_driver_id, pid = pool.apply(get_fake_worker_driver, (self._get_args('u1', 'p1'),))
+        self.assertEqual(driver_id, cached_driver_id)
+        self.assertNotEqual(pid, os.getpid())
+        # drivers with different credentials are not shared
+        other_driver_id = pool.apply(get_fake_worker_driver, (self._get_args('u2', 'p1'),))[0]
+        self.assertNotEqual(other_driver_id, driver_id)
+        self.assertNotEqual(pool.apply(get_fake_worker_driver, (self._get_args('u1', 'p2'),))[0], driver_id)
+        self.assertEqual(pool.apply(get_fake_worker_driver, (self._get_args('u1', 'p1'),))[0], driver_id)
+        self.assertEqual(os.listdir(self.drivers_dir), [])
+        # drivers are disconnected when the workers exit
+        pool.close()
+        pool.join()
+        self.assertEqual(sorted(os.listdir(self.drivers_dir)), ['u1', 'u2'])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestClientsPool('test_get_client'))
+    suite.addTest(TestClientsPool('test_discard_client'))
+    suite.addTest(TestClientsPool('test_forked_process'))
+    suite.addTest(TestWorkerDrivers('test_worker_drivers'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
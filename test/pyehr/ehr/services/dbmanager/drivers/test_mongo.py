@@ -1,6 +1,7 @@
 import sys, argparse, unittest, os
 
 from pyehr.ehr.services.dbmanager.dbservices import DBServices
+from pyehr.ehr.services.dbmanager.drivers.factory import DriversFactory
 from pyehr.utils.services import get_service_configuration
 from pyehr.ehr.services.dbmanager.errors import DuplicatedKeyError
 from uuid import uuid4
@@ -31,6 +32,29 @@ class TestMongoDBDriver(unittest.TestCase):
             self.assertTrue(driver.is_connected)
         self.assertFalse(driver.is_connected)
 
+    def test_shared_clients(self):
+        # drivers created by the same factory share the same client
+        with self.drf.get_driver() as driver:
+            client = driver.client
+            with self.drf.get_driver() as other_driver:
+                self.assertIs(other_driver.client, client)
+        with self.drf.get_driver() as driver:
+            self.assertIs(driver.client, client)
+        # a new client is created by a different process, i.e. after a fork
+        self.drf.clients_pool._pid = os.getpid() + 1
+        with self.drf.get_driver() as driver:
+            self.assertIsNot(driver.client, client)
+            client = driver.client
+        with self.drf.get_driver() as driver:
+            self.assertIs(driver.client, client)
+        # clients are not shared if shared_clients is False
+        drf = DriversFactory(self.drf.driver, self.drf.host, self.drf.database, self.drf.repository,
+                             self.drf.port, self.drf.user, self.drf.passwd, shared_clients=False)
+        with drf.get_driver() as driver:
+            self.assertIsNot(driver.client, client)
+            with drf.get_driver() as other_driver:
+                self.assertIsNot(other_driver.client, driver.client)
+
     def test_select_collection(self):
         with self.drf.get_driver() as driver:
             self.assertEqual(driver.collection.name, u'test_ehr')
@@ -89,6 +113,25 @@ class TestMongoDBDriver(unittest.TestCase):
             for sid in saved_ids:
                 driver.delete_record(sid)
 
+    def test_add_records_batches(self):
+        records = [{'_id': uuid4().hex, 'value': x} for x in xrange(0, 10)]
+        with self.drf.get_driver() as driver:
+            saved_ids, errors = driver.add_records(records[:5], batch_size=2)
+            self.assertEqual(sorted(saved_ids), sorted(r['_id'] for r in records[:5]))
+            # the duplicated record is in the last batch, records saved by the previous ones are removed
+            with self.assertRaises(DuplicatedKeyError) as context:
+                driver.add_records(records[5:] + records[:1], batch_size=2)
+            self.assertIn(records[0]['_id'], str(context.exception))
+            self.assertEqual(driver.documents_count, 5)
+            saved_ids, errors = driver.add_records(records[5:] + records[:1], skip_existing_duplicated=True,
+                                                   batch_size=2)
+            self.assertEqual(sorted(saved_ids), sorted(r['_id'] for r in records[5:]))
+            self.assertEqual(errors, records[:1])
+            self.assertEqual(driver.documents_count, 10)
+            # cleanup
+            for r in records:
+                driver.delete_record(r['_id'])
+
     def test_get_record_by_id(self):
         record = {
             '_id': uuid4().hex,
@@ -103,6 +146,22 @@ class TestMongoDBDriver(unittest.TestCase):
             # cleanup
             driver.delete_record(record_id)
 
+    def test_get_records_by_ids(self):
+        records = [
+            {'value': x, 'even': x % 2 == 0, '_id': uuid4().hex}
+            for x in xrange(0, 20)
+        ]
+        with self.drf.get_driver() as driver:
+            record_ids, _ = driver.add_records(records)
+            recs = driver.get_records_by_ids(record_ids[:10] + [uuid4().hex], batch_size=3)
+            self.assertEqual(sorted(recs), sorted(records[:10]))
+            recs = driver.get_records_by_ids(record_ids, fields=['value'])
+            self.assertEqual(sorted(r['value'] for r in recs), range(0, 20))
+            self.assertTrue(all('even' not in r for r in recs))
+            # cleanup
+            for rid in record_ids:
+                driver.delete_record(rid)
+
     def test_get_records_by_query(self):
         records = [
             {'value': x, 'even': x % 2 == 0, '_id': uuid4().hex}
@@ -135,10 +194,13 @@ class TestMongoDBDriver(unittest.TestCase):
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(TestMongoDBDriver('test_connection'))
+    suite.addTest(TestMongoDBDriver('test_shared_clients'))
     suite.addTest(TestMongoDBDriver('test_select_collection'))
     suite.addTest(TestMongoDBDriver('test_add_record'))
     suite.addTest(TestMongoDBDriver('test_add_records'))
+    suite.addTest(TestMongoDBDriver('test_add_records_batches'))
     suite.addTest(TestMongoDBDriver('test_get_record_by_id'))
+    suite.addTest(TestMongoDBDriver('test_get_records_by_ids'))
     suite.addTest(TestMongoDBDriver('test_get_records_by_query'))
     suite.addTest(TestMongoDBDriver('test_update_record'))
     return suite
@@ -28,7 +28,7 @@ class TestQueryManager(unittest.TestCase):
         for p in self.patients:
             self.dbs.delete_patient(p, cascade_delete=True)
         self.patients = None
-        pass
+        self.qmanager.shutdown()
 
     def _get_quantity(self, value, units):
         return {
@@ -287,6 +287,29 @@ class TestQueryManager(unittest.TestCase):
                     results_count += 1
         self.assertEqual(results_count, results)
 
+    def test_count_by_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        OR o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude >= 110
+        """
+        batch_details = self._build_patients_batch(10, 10, (0, 250), (0, 200))
+        results = self.qmanager.execute_aql_query(query, count_only=True, count_by='patient')
+        expected_results = dict()
+        for k, v in batch_details.iteritems():
+            for x in v:
+                if x['systolic'] >= 180 or x['diastolic'] >= 110:
+                    expected_results[k] = expected_results.get(k, 0) + 1
+        self.assertEqual(expected_results, results)
+        structures_results = self.qmanager.execute_aql_query(query, count_only=True, count_by='structure')
+        self.assertEqual(sum(structures_results.values()), sum(expected_results.values()))
+        self.assertEqual(self.qmanager.execute_aql_query(query, count_only=True),
+                         sum(expected_results.values()))
+        self.assertRaises(ValueError, self.qmanager.execute_aql_query, query,
+                          count_only=True, count_by='composition')
+
     def test_multiprocess_query(self):
         query = """
         SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
@@ -301,6 +324,83 @@ class TestQueryManager(unittest.TestCase):
         mp_results = self.qmanager.execute_aql_query(query, query_processes=2)
         self.assertEqual(sorted(sp_results.to_json()), sorted(mp_results.to_json()))
 
+    def test_persistent_pool_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        OR o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude >= 110
+        """
+        _ = self._build_patients_batch_mixed(10, 10, (0, 250), (0, 200))
+        sp_results = self.qmanager.execute_aql_query(query)
+        mp_results = self.qmanager.execute_aql_query(query, query_processes=2)
+        queries_pool = self.qmanager._queries_pools[2]
+        mp_results_2 = self.qmanager.execute_aql_query(query, query_processes=2)
+        self.assertIs(self.qmanager._queries_pools[2], queries_pool)
+        self.assertEqual(sorted(sp_results.to_json()), sorted(mp_results.to_json()))
+        self.assertEqual(sorted(mp_results.to_json()), sorted(mp_results_2.to_json()))
+        # a different number of processes doesn't replace the pool, it may be in use
+        mp_results_4 = self.qmanager.execute_aql_query(query, query_processes=3)
+        self.assertIs(self.qmanager._queries_pools[2], queries_pool)
+        self.assertEqual(sorted(mp_results.to_json()), sorted(mp_results_4.to_json()))
+        self.qmanager.shutdown()
+        self.assertEqual(self.qmanager._queries_pools, {})
+        mp_results_3 = self.qmanager.execute_aql_query(query, query_processes=2)
+        self.assertEqual(sorted(mp_results.to_json()), sorted(mp_results_3.to_json()))
+
+    def test_multithread_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        OR o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude >= 110
+        """
+        _ = self._build_patients_batch_mixed(10, 10, (0, 250), (0, 200))
+        st_results = self.qmanager.execute_aql_query(query)
+        mt_results = self.qmanager.execute_aql_query(query, query_threads=4)
+        self.assertEqual(sorted(st_results.to_json()), sorted(mt_results.to_json()))
+        with self.assertRaises(ValueError):
+            self.qmanager.execute_aql_query(query, query_processes=2, query_threads=2)
+
+    def test_stream_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        OR o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude >= 110
+        """
+        _ = self._build_patients_batch_mixed(10, 10, (0, 250), (0, 200))
+        results = self.qmanager.execute_aql_query(query)
+        stream_results = self.qmanager.execute_aql_query(query, stream=True)
+        self.assertEqual(results.total_results, stream_results.total_results)
+        self.assertEqual(sorted(results.results), sorted(stream_results.results))
+
+    def test_aggregate_query_mode(self):
+        if self.qmanager.driver != 'mongodb':
+            self.skipTest('aggregation pipelines are supported only by MongoDB drivers')
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        OR o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude >= 110
+        """
+        _ = self._build_patients_batch_mixed(10, 10, (0, 250), (0, 200))
+        sconf = get_service_configuration(CONF_FILE)
+        aggr_qmanager = QueryManager(driver_options={'query_mode': 'aggregate'},
+                                     **sconf.get_db_configuration())
+        aggr_qmanager.set_index_service(**sconf.get_index_configuration())
+        results = self.qmanager.execute_aql_query(query)
+        aggr_results = aggr_qmanager.execute_aql_query(query)
+        self.assertEqual(sorted(results.results), sorted(aggr_results.results))
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -315,7 +415,12 @@ def suite():
     suite.addTest(TestQueryManager('test_simple_patients_selection'))
     suite.addTest(TestQueryManager('test_deep_select_query'))
     suite.addTest(TestQueryManager('test_count_query'))
+    suite.addTest(TestQueryManager('test_count_by_query'))
     suite.addTest(TestQueryManager('test_multiprocess_query'))
+    suite.addTest(TestQueryManager('test_persistent_pool_query'))
+    suite.addTest(TestQueryManager('test_multithread_query'))
+    suite.addTest(TestQueryManager('test_stream_query'))
+    suite.addTest(TestQueryManager('test_aggregate_query_mode'))
     return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,178 @@
+import unittest
+import cPickle as pickle
+from pyehr.ehr.services.dbmanager.errors import InvalidFieldError
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
+    ResultColumnDef, ResultRow, StreamingResultSet, MissingValue
+
+
+class TestResultsWrappers(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestResultsWrappers, self).__init__(label)
+
+    def _get_rows(self, count):
+        return [ResultRow({'data.at0004.value.magnitude': x}) for x in xrange(count)]
+
+    def _get_result_set(self, rows):
+        rs = ResultSet()
+        rs.add_column_definition(ResultColumnDef('systolic', 'bp1.at0004.value.magnitude'))
+        rs.add_column_definition(ResultColumnDef('systolic', 'bp2.at0004.value.magnitude'))
+        rs.add_column_definition(ResultColumnDef('diastolic', 'bp1.at0005.value.magnitude'))
+        for r in rows:
+            rs.add_row(ResultRow(r))
+        return rs
+
+    def test_columns_definition(self):
+        rs = self._get_result_set([])
+        rs.add_column_definition(ResultColumnDef('systolic', 'bp1.at0004.value.magnitude'))
+        self.assertEqual(len(rs.columns), 3)
+        self.assertEqual(rs._get_alias('bp2.at0004.value.magnitude'), 'systolic')
+        self.assertRaises(KeyError, rs._get_alias, 'bp2.at0005.value.magnitude')
+
+    def test_results(self):
+        rows = [
+            {'bp1.at0004.value.magnitude': 120, 'bp1.at0005.value.magnitude': 80},
+            {'bp2.at0004.value.magnitude': 130},
+            {'bp1.at0004.value.magnitude': 120, 'bp1.at0005.value.magnitude': 90}
+        ]
+        rs = self._get_result_set(rows)
+        self.assertEqual(rs.total_results, 3)
+        self.assertEqual(list(rs.results), [{'systolic': 120, 'diastolic': 80}, {'systolic': 130},
+                                            {'systolic': 120, 'diastolic': 90}])
+        self.assertEqual(list(rs.rows), [ResultRow(r) for r in rows])
+        self.assertEqual(rs.get_column('systolic'), [120, 130, 120])
+        self.assertEqual(sorted(rs.get_distinct_results('systolic')), [120, 130])
+        # the second row has no diastolic value
+        self.assertRaises(KeyError, rs.get_column, 'diastolic')
+        self.assertRaises(InvalidFieldError, list, rs.get_distinct_results('diastolic'))
+        self.assertRaises(InvalidFieldError, list, rs.get_distinct_results('pulse'))
+        rs.add_row(ResultRow({'bp1.at0006.value.magnitude': 60}))
+        self.assertRaises(KeyError, list, rs.results)
+
+    def test_extend(self):
+        rs = self._get_result_set([{'bp1.at0004.value.magnitude': 120, 'bp1.at0005.value.magnitude': 80}])
+        other = ResultSet()
+        other.add_column_definition(ResultColumnDef('pulse', 'bp1.at1007.value.magnitude'))
+        other.add_row(ResultRow({'bp1.at1007.value.magnitude': 70}))
+        rs.extend(other)
+        self.assertEqual(rs.total_results, 2)
+        self.assertEqual(len(rs.columns), 4)
+        self.assertEqual(list(rs.results), [{'systolic': 120, 'diastolic': 80}, {'pulse': 70}])
+        rs = pickle.loads(pickle.dumps(rs))
+        self.assertEqual(list(rs.results), [{'systolic': 120, 'diastolic': 80}, {'pulse': 70}])
+        self.assertRaises(KeyError, rs.get_column, 'pulse')
+
+    def test_add_rows(self):
+        paths = ('bp1.at0004.value.magnitude', 'bp1.at0005.value.magnitude')
+        values = [(120, 80), (130, MissingValue), (120, 90)]
+        rs = self._get_result_set([])
+        rs.add_rows(paths, iter(values), chunk_size=2)
+        expected_rs = self._get_result_set([])
+        for v in values:
+            expected_rs.add_row(ResultRow.from_values(paths, v))
+        self.assertEqual(rs.total_results, 3)
+        self.assertEqual(list(rs.results), list(expected_rs.results))
+        rs.add_rows(paths, [])
+        self.assertEqual(rs.total_results, 3)
+
+    def test_batches(self):
+        rs = self._get_result_set([{'bp1.at0004.value.magnitude': 120, 'bp1.at0005.value.magnitude': 80}])
+        other = ResultSet()
+        other.add_column_definition(ResultColumnDef('pulse', 'bp1.at1007.value.magnitude'))
+        other.add_row(ResultRow({'bp1.at1007.value.magnitude': 70}))
+        batch = pickle.loads(pickle.dumps(other.to_batch(), pickle.HIGHEST_PROTOCOL))
+        rs.extend_batch(batch)
+        self.assertEqual(rs.total_results, 2)
+        self.assertEqual(len(rs.columns), 4)
+        self.assertEqual(list(rs.results), [{'systolic': 120, 'diastolic': 80}, {'pulse': 70}])
+
+    def test_compact_rows(self):
+        paths = ('bp1.at0004.value.magnitude', 'bp1.at0005.value.magnitude')
+        row = ResultRow.from_values(paths, (120, MissingValue))
+        self.assertEqual(row.record, {'bp1.at0004.value.magnitude': 120})
+        self.assertEqual(row, ResultRow({'bp1.at0004.value.magnitude': 120}))
+        self.assertFalse(hasattr(row, '__dict__'))
+        for protocol in (0, 2):
+            self.assertEqual(pickle.loads(pickle.dumps(row, protocol)), row)
+        rs = self._get_result_set([])
+        rs.add_row(row)
+        rs.add_row(ResultRow.from_values(paths, (130, 90)))
+        self.assertEqual(list(rs.results), [{'systolic': 120}, {'systolic': 130, 'diastolic': 90}])
+        self.assertEqual([r.record for r in rs.rows], [{'bp1.at0004.value.magnitude': 120},
+                                                       dict(zip(paths, (130, 90)))])
+
+    def test_streaming_result_set(self):
+        fetched = list()
+
+        def rows_source():
+            for r in self._get_rows(5):
+                fetched.append(r)
+                yield r
+
+        rs = StreamingResultSet()
+        rs.add_column_definition(ResultColumnDef('systolic', 'data.at0004.value.magnitude'))
+        rs.add_rows_source(rows_source)
+        results = rs.results
+        self.assertEqual(len(fetched), 0)
+        self.assertEqual(next(results), {'systolic': 0})
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(list(results), [{'systolic': x} for x in xrange(1, 5)])
+        self.assertEqual(rs.total_results, 5)
+        # rows consumed entirely are counted without running the sources again
+        self.assertEqual(len(fetched), 5)
+        self.assertEqual(rs.to_json()['results_count'], 5)
+        # rows consumed partially must be counted running the sources
+        rs.add_rows_source(lambda: self._get_rows(2))
+        del fetched[:]
+        next(rs.rows)
+        self.assertEqual(rs.total_results, 7)
+        self.assertEqual(len(fetched), 6)
+
+    def test_streaming_result_set_count(self):
+        counter = list()
+
+        def count_function():
+            counter.append(1)
+            return 3
+
+        rs = StreamingResultSet(count_function)
+        rs.add_rows_source(lambda: self._get_rows(3))
+        self.assertEqual(rs.total_results, 3)
+        self.assertEqual(rs.total_results, 3)
+        self.assertEqual(len(counter), 1)
+        # extending a result set updates the count
+        other = ResultSet()
+        for r in self._get_rows(2):
+            other.add_row(r)
+        rs.extend(other)
+        self.assertEqual(rs.total_results, 5)
+        self.assertEqual(len(list(rs.rows)), 5)
+
+    def test_extend_with_streaming_result_set(self):
+        rs = ResultSet()
+        rs.add_column_definition(ResultColumnDef('systolic', 'data.at0004.value.magnitude'))
+        srs = StreamingResultSet(lambda: 4)
+        srs.add_column_definition(ResultColumnDef('systolic', 'data.at0004.value.magnitude'))
+        srs.add_rows_source(lambda: self._get_rows(4))
+        rs.extend(srs)
+        self.assertEqual(rs.total_results, 4)
+        self.assertEqual(len(rs.columns), 1)
+        self.assertEqual(sorted(r['systolic'] for r in rs.results), range(4))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestResultsWrappers('test_columns_definition'))
+    suite.addTest(TestResultsWrappers('test_results'))
+    suite.addTest(TestResultsWrappers('test_extend'))
+    suite.addTest(TestResultsWrappers('test_add_rows'))
+    suite.addTest(TestResultsWrappers('test_batches'))
+    suite.addTest(TestResultsWrappers('test_compact_rows'))
+    suite.addTest(TestResultsWrappers('test_streaming_result_set'))
+    suite.addTest(TestResultsWrappers('test_streaming_result_set_count'))
+    suite.addTest(TestResultsWrappers('test_extend_with_streaming_result_set'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
@@ -0,0 +1,59 @@
+import unittest
+from pyehr.utils.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestLRUCache, self).__init__(label)
+
+    def test_get_and_put(self):
+        cache = LRUCache(10)
+        self.assertIsNone(cache.get('foo'))
+        cache.put('foo', 'bar')
+        self.assertEqual(cache.get('foo'), 'bar')
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # 'a' becomes the most recently used element, 'b' will be evicted
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+        self.assertNotIn('b', cache)
+
+    def test_invalidation(self):
+        cache = LRUCache(10)
+        cache.put('a', 'x')
+        cache.put('b', 'x')
+        cache.put('c', 'y')
+        self.assertTrue(cache.invalidate('c'))
+        self.assertFalse(cache.invalidate('c'))
+        self.assertEqual(cache.invalidate_value('x'), 2)
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled_cache(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestLRUCache('test_get_and_put'))
+    suite.addTest(TestLRUCache('test_eviction'))
+    suite.addTest(TestLRUCache('test_invalidation'))
+    suite.addTest(TestLRUCache('test_disabled_cache'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
@@ -20,6 +20,7 @@ class TestQueryService(unittest.TestCase):
                                               sconf.get_query_service_configuration()['port'])
         self.query_path = 'query/execute'
         self.query_count_path = 'query/execute_count'
+        self.query_cache_stats_path = 'query/cache/stats'
 
     def setUp(self):
         sconf = get_service_configuration(CONF_FILE)
@@ -242,6 +243,24 @@ class TestQueryService(unittest.TestCase):
                     details_results.append({'patient_identifier': k})
         self.assertEqual(sorted(results_set['results']), sorted(details_results))
 
+    def test_query_cache_stats(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        stats = requests.get(self._get_path(self.query_cache_stats_path)).json()['QUERY_CACHE']
+        query_request = self._build_query_request(query)
+        for _ in xrange(2):
+            results = requests.post(self._get_path(self.query_count_path), query_request)
+            self.assertEqual(results.status_code, requests.codes.ok)
+        results = requests.get(self._get_path(self.query_cache_stats_path))
+        self.assertEqual(results.status_code, requests.codes.ok)
+        self.assertTrue(results.json()['SUCCESS'])
+        new_stats = results.json()['QUERY_CACHE']
+        # the second execution of the query doesn't parse it again
+        self.assertGreaterEqual(new_stats['hits'], stats['hits'] + 1)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -252,6 +271,7 @@ def suite():
     suite.addTest(TestQueryService('test_deep_where_query'))
     suite.addTest(TestQueryService('test_simple_parametric_query'))
     suite.addTest(TestQueryService('test_simple_patients_selection'))
+    suite.addTest(TestQueryService('test_query_cache_stats'))
     return suite
 
 if __name__ == '__main__':
@@ -19,9 +19,7 @@ class IndexBuilder(object):
 
     def _cleanup_index(self):
         self.logger.info('Cleaning index service database')
-        self.db_service.index_service.connect()
-        self.db_service.index_service.basex_client.delete_database(self.db_service.index_service.db)
-        self.db_service.index_service.disconnect()
+        self.db_service.index_service.delete_index()
 
     def _get_structure_ids(self):
         drf = self.db_service._get_drivers_factory(self.db_service.ehr_repository)